@@ -0,0 +1,78 @@
+"""
+    Wall-clock time of optimize with a slow oracle, scored synchronously and in a background
+    thread while the next batch is generated. The model is a SyntheticGenerator that sleeps
+    to mimic generation on an accelerator.
+
+    python -m benchmarks.async_oracle --generation_time 0.5 --seconds_per_molecule 0.005
+"""
+import argparse
+import os
+import tempfile
+import time
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import set_seed
+from chemlactica.mol_opt.featurization import featurization_cache
+from benchmarks.synthetic import SyntheticGenerator, SlowOracle
+
+
+def create_config(args, log_dir):
+    return {
+        "log_dir": log_dir,
+        "pool_size": 10,
+        "validation_perc": 0.2,
+        "num_mols": 0,
+        "num_similars": 5,
+        "num_gens_per_iter": args.num_gens_per_iter,
+        "generation_batch_size": args.generation_batch_size,
+        "sim_range": [0.4, 0.9],
+        "num_processes": args.num_processes,
+        "eos_token": "</s>",
+        "generation_temperature": [1.0, 1.5],
+        "generation_config": {"max_new_tokens": 100, "do_sample": True, "eos_token_id": 20},
+        "strategy": ["default"],
+        "max_possible_oracle_score": 200,
+        "async_oracle": args.async_oracle,
+    }
+
+
+def time_optimize(args, tokenizer, async_oracle):
+    set_seed(args.seed)
+    featurization_cache.clear()
+    args.async_oracle = async_oracle
+    model = SyntheticGenerator(tokenizer, generation_time=args.generation_time, seed=args.seed)
+    oracle = SlowOracle(args.max_oracle_calls, args.seconds_per_molecule)
+    with tempfile.TemporaryDirectory() as log_dir:
+        config = create_config(args, os.path.join(log_dir, "results.log"))
+        config["max_possible_oracle_score"] = oracle.max_possible_oracle_score
+        start_time = time.perf_counter()
+        optimize(model, tokenizer, oracle, config)
+        elapsed = time.perf_counter() - start_time
+    return elapsed, len(oracle)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--max_oracle_calls", type=int, default=1000)
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--generation_batch_size", type=int, default=100)
+    parser.add_argument("--generation_time", type=float, default=0.5)
+    parser.add_argument("--seconds_per_molecule", type=float, default=0.005)
+    parser.add_argument("--num_processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    results = {}
+    for async_oracle in [False, True]:
+        results[async_oracle] = time_optimize(args, tokenizer, async_oracle)
+    for async_oracle, (elapsed, num_oracle_calls) in results.items():
+        mode = "async" if async_oracle else "sync"
+        print(f"{mode:>6}: {elapsed:.2f} s, {num_oracle_calls} oracle calls")
+    print(f"speedup: {results[False][0] / results[True][0]:.2f}x")
@@ -0,0 +1,143 @@
+"""
+    Molecules per second of the ContinuousBatchingEngine against fixed-batch model.generate,
+    on CPU with the small_opt model. An EndSmilesBias processor makes the random model end
+    its molecules with [END_SMILES] after ~30 tokens on average, like a trained model would
+    (top-k is disabled, it would make [END_SMILES] the likeliest token).
+
+    python -m benchmarks.continuous_batching --num_prompts 400 --batch_size 50
+"""
+import argparse
+import math
+import time
+import torch
+import yaml
+from transformers import (
+    AutoTokenizer, LogitsProcessor, LogitsProcessorList, OPTConfig, OPTForCausalLM
+)
+from chemlactica.generation.continuous_batching import ContinuousBatchingEngine, list_prompt_source
+from chemlactica.mol_opt.utils import set_seed
+from benchmarks.synthetic import synthetic_smiles
+
+END_SMILES_TOKEN_ID = 20
+
+
+class EndSmilesBias(LogitsProcessor):
+    def __init__(self, end_probability):
+        self.log_odds = math.log(end_probability / (1 - end_probability))
+
+    def __call__(self, input_ids, scores):
+        # leaves [END_SMILES] blocked where an earlier processor masked it
+        end_scores = torch.logsumexp(scores, dim=-1) + self.log_odds
+        blocked = scores[:, END_SMILES_TOKEN_ID] == -float("inf")
+        scores[:, END_SMILES_TOKEN_ID] = end_scores.masked_fill(blocked, -float("inf"))
+        return scores
+
+
+def small_opt(vocab_size):
+    # the small_opt branch of chemlactica.utils.model_utils.load_model
+    model_config = yaml.safe_load(open("chemlactica/config/models_train_config.yaml"))["small_opt"]
+    return OPTForCausalLM(OPTConfig(
+        vocab_size=vocab_size,
+        hidden_size=model_config["hidden_size"],
+        num_hidden_layers=model_config["num_hidden_layers"],
+        ffn_dim=model_config["ffn_dim"],
+        max_position_embeddings=model_config["max_position_embeddings"],
+        num_attention_heads=model_config["num_attention_heads"],
+        word_embed_proj_dim=model_config["word_embed_proj_dim"],
+    )).eval()
+
+
+def create_prompts(tokenizer, num_prompts, num_similars, seed):
+    smiles_list = synthetic_smiles(num_prompts * num_similars, seed=seed)
+    prompts = []
+    for i in range(num_prompts):
+        similars = smiles_list[i * num_similars:(i + 1) * num_similars]
+        prompts.append(
+            "</s>"
+            + "".join(
+                f"[SIMILAR]{smiles} 0.{50 + j}[/SIMILAR]" for j, smiles in enumerate(similars)
+            )
+            + "[START_SMILES]"
+        )
+    return tokenizer(prompts)["input_ids"]
+
+
+def time_fixed_batches(model, prompts_ids, args, processors, pad_token_id):
+    start_time = time.perf_counter()
+    num_generated_tokens = 0
+    for batch_start in range(0, len(prompts_ids), args.batch_size):
+        batch = prompts_ids[batch_start:batch_start + args.batch_size]
+        max_length = max(len(prompt_ids) for prompt_ids in batch)
+        input_ids = torch.full((len(batch), max_length), pad_token_id)
+        attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
+        for i, prompt_ids in enumerate(batch):
+            input_ids[i, max_length - len(prompt_ids):] = torch.tensor(prompt_ids)
+            attention_mask[i, max_length - len(prompt_ids):] = 1
+        output = model.generate(
+            input_ids=input_ids, attention_mask=attention_mask,
+            max_new_tokens=args.max_new_tokens, do_sample=True, top_k=0,
+            eos_token_id=END_SMILES_TOKEN_ID,
+            pad_token_id=pad_token_id, logits_processor=processors
+        )
+        num_generated_tokens += (output[:, max_length:] != pad_token_id).sum().item()
+    return time.perf_counter() - start_time, num_generated_tokens
+
+
+def time_continuous_batching(model, prompts_ids, args, processors, pad_token_id):
+    engine = ContinuousBatchingEngine(
+        model, pad_token_id, num_slots=args.batch_size,
+        max_prompt_length=max(len(prompt_ids) for prompt_ids in prompts_ids),
+        max_new_tokens=args.max_new_tokens
+    )
+    generation_config = {
+        "max_new_tokens": args.max_new_tokens, "do_sample": True, "top_k": 0,
+        "eos_token_id": END_SMILES_TOKEN_ID
+    }
+    start_time = time.perf_counter()
+    num_generated_tokens = 0
+    prompt_source = list_prompt_source(prompts_ids)
+    for _, generated in engine.generate(prompt_source, generation_config, processors):
+        num_generated_tokens += len(generated)
+    return time.perf_counter() - start_time, num_generated_tokens
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--num_prompts", type=int, default=400)
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--num_similars", type=int, default=3)
+    parser.add_argument("--max_new_tokens", type=int, default=100)
+    parser.add_argument("--end_probability", type=float, default=1 / 30)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+    set_seed(args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    model = small_opt(len(tokenizer))
+    prompts_ids = create_prompts(tokenizer, args.num_prompts, args.num_similars, args.seed)
+    processors = LogitsProcessorList([EndSmilesBias(args.end_probability)])
+    with torch.no_grad():
+        fixed_time, fixed_tokens = time_fixed_batches(
+            model, prompts_ids, args, processors, tokenizer.pad_token_id
+        )
+        continuous_time, continuous_tokens = time_continuous_batching(
+            model, prompts_ids, args, processors, tokenizer.pad_token_id
+        )
+    print(
+        f"fixed batches:       {args.num_prompts / fixed_time:8.1f} molecules/s, "
+        f"{fixed_tokens / fixed_time:8.1f} tokens/s"
+    )
+    print(
+        f"continuous batching: {args.num_prompts / continuous_time:8.1f} molecules/s, "
+        f"{continuous_tokens / continuous_time:8.1f} tokens/s"
+    )
+    print(f"speedup: {fixed_time / continuous_time:.2f}x")
@@ -0,0 +1,126 @@
+"""
+    Generation on CPU with the float32 model against its int8 dynamically quantized copy:
+    generated tokens per second, the validity rate of the generated SMILES, the error of
+    the TPSA of molecules generated for a target [TPSA] and the agreement of the greedy
+    next tokens. The quality numbers need a trained `--checkpoint_path`, without one the
+    model is a random OPT with the shape of chemlactica-125m and only the throughput and
+    the agreement mean something.
+
+    python -m benchmarks.cpu_int8 --checkpoint_path yerevann/chemlactica-125m --num_prompts 64
+"""
+import argparse
+import copy
+import time
+import numpy as np
+import torch
+from rdkit import Chem, RDLogger
+from rdkit.Chem import rdMolDescriptors
+from transformers import AutoModelForCausalLM, AutoTokenizer, OPTConfig, OPTForCausalLM
+from chemlactica.mol_opt.optimization import extract_generated_smiles
+from chemlactica.mol_opt.utils import set_seed
+from chemlactica.utils.cpu_inference import configure_cpu_threads, quantize_int8
+
+RDLogger.DisableLog("rdApp.*")
+
+END_SMILES_TOKEN_ID = 20
+
+
+def load_float32_model(args, vocab_size):
+    if args.checkpoint_path:
+        return AutoModelForCausalLM.from_pretrained(
+            args.checkpoint_path, torch_dtype=torch.float32
+        ).eval()
+    # the shape of chemlactica-125m (galactica-125m)
+    return OPTForCausalLM(OPTConfig(
+        vocab_size=vocab_size, hidden_size=768, num_hidden_layers=12, ffn_dim=3072,
+        num_attention_heads=12, word_embed_proj_dim=768, max_position_embeddings=2048
+    )).eval()
+
+
+def create_prompts(num_prompts, seed):
+    rng = np.random.default_rng(seed)
+    targets = rng.uniform(20, 120, num_prompts).round(2)
+    prompts = ["</s>[START_SMILES]"] * num_prompts + [
+        f"</s>[TPSA]{target:.2f}[/TPSA][START_SMILES]" for target in targets
+    ]
+    return prompts, targets
+
+
+def generate_smiles(model, tokenizer, prompts, args):
+    set_seed(args.seed)
+    generated_texts, num_generated_tokens = [], 0
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(prompts), args.batch_size):
+        data = tokenizer(
+            prompts[batch_start:batch_start + args.batch_size],
+            return_tensors="pt", padding=True, return_token_type_ids=False
+        )
+        with torch.no_grad():
+            output = model.generate(
+                **data, max_new_tokens=args.max_new_tokens, do_sample=True,
+                eos_token_id=END_SMILES_TOKEN_ID, pad_token_id=tokenizer.pad_token_id
+            )
+        generated = output[:, data["input_ids"].shape[1]:]
+        num_generated_tokens += int((generated != tokenizer.pad_token_id).sum())
+        generated_texts.extend(tokenizer.batch_decode(generated))
+    elapsed = time.perf_counter() - start_time
+    molecules = []
+    for generated_text in generated_texts:
+        smiles = extract_generated_smiles(generated_text)
+        molecules.append(Chem.MolFromSmiles(smiles) if smiles else None)
+    return molecules, num_generated_tokens / elapsed
+
+
+def quality(molecules, targets):
+    num_prompts = len(targets)
+    validity = np.mean([molecule is not None for molecule in molecules])
+    errors = [
+        abs(rdMolDescriptors.CalcTPSA(molecule) - target)
+        for molecule, target in zip(molecules[num_prompts:], targets)
+        if molecule is not None
+    ]
+    return validity, np.mean(errors) if errors else float("nan")
+
+
+def next_token_agreement(model, quantized, tokenizer, prompts):
+    data = tokenizer(prompts, return_tensors="pt", padding=True, return_token_type_ids=False)
+    with torch.no_grad():
+        expected = model(**data).logits[:, -1].argmax(dim=-1)
+        predicted = quantized(**data).logits[:, -1].argmax(dim=-1)
+    return (expected == predicted).float().mean().item()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--checkpoint_path", type=str, default=None)
+    parser.add_argument("--num_prompts", type=int, default=32)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_new_tokens", type=int, default=64)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    num_threads = configure_cpu_threads(args.num_threads)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    set_seed(args.seed)
+    model = load_float32_model(args, len(tokenizer))
+    quantized = quantize_int8(copy.deepcopy(model), num_threads=num_threads)
+    prompts, targets = create_prompts(args.num_prompts, args.seed)
+    print(f"{num_threads} threads")
+    results = {}
+    for name, generator in [("float32", model), ("int8", quantized)]:
+        molecules, tokens_per_second = generate_smiles(generator, tokenizer, prompts, args)
+        validity, tpsa_error = quality(molecules, targets)
+        results[name] = tokens_per_second
+        print(
+            f"{name:>8}: {tokens_per_second:.1f} tokens/s, validity {validity:.3f}, "
+            f"TPSA MAE {tpsa_error:.2f}"
+        )
+    print(f"greedy next token agreement: {next_token_agreement(model, quantized, tokenizer, prompts):.3f}")  # noqa: E501
+    print(f"speedup: {results['int8'] / results['float32']:.2f}x")
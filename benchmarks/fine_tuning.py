@@ -0,0 +1,162 @@
+"""
+    Wall-clock time of the rejection-sampling fine-tuning rounds of optimize, a new
+    SFTTrainer per round against the FineTuningEngine created once, on CPU with the
+    small_opt model. Every round trains on a pool where `--num_new_entries` entries changed.
+
+    python -m benchmarks.fine_tuning --pool_size 10 --num_rounds 5
+"""
+import argparse
+import tempfile
+import time
+from datasets import Dataset
+from transformers import AutoTokenizer
+from trl import SFTTrainer
+from chemlactica.mol_opt.tunning import (
+    CustomModelSelectionCallback, FineTuningEngine, ModelSnapshot,
+    get_optimizer_and_lr_scheduler, get_training_arguments
+)
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool, set_seed
+from benchmarks.continuous_batching import small_opt
+from benchmarks.synthetic import synthetic_smiles
+
+
+def create_config(args, checkpoints_dir):
+    return {
+        "strategy": ["rej-sample-v2"],
+        "eos_token": "</s>",
+        "max_possible_oracle_score": 1.0,
+        "rej_sample_config": {
+            "checkpoints_dir": checkpoints_dir,
+            "max_learning_rate": 1e-4,
+            "lr_end": 0,
+            "train_batch_size": 2,
+            "gradient_accumulation_steps": 2,
+            "weight_decay": 0.1,
+            "adam_beta1": 0.9,
+            "adam_beta2": 0.999,
+            "warmup_steps": 1,
+            "global_gradient_norm": 1.0,
+            "dataloader_num_workers": args.dataloader_num_workers,
+            "max_seq_length": 512,
+            "num_train_epochs": args.num_train_epochs,
+            "packing": False,
+        },
+    }
+
+
+def create_pools(args):
+    smiles_list = synthetic_smiles(args.pool_size + args.num_rounds * args.num_new_entries)
+    pool = Pool(args.pool_size, validation_perc=0.2)
+    pools = []
+    for round_index in range(args.num_rounds):
+        num_entries = args.pool_size if round_index == 0 else args.num_new_entries
+        offset = 0
+        if round_index > 0:
+            offset = args.pool_size + (round_index - 1) * args.num_new_entries
+        pool.add([
+            OptimEntry(MoleculeEntry(smiles, score=1.0 + round_index), [])
+            for smiles in smiles_list[offset:offset + num_entries]
+        ])
+        pools.append(pool.get_train_valid_entries())
+    return pools
+
+
+def sft_trainer_round(model, tokenizer, config, training_args, optimizer, lr_scheduler,
+                      snapshot, train_entries, validation_entries):
+    datasets = [
+        Dataset.from_dict({"sample": [
+            optim_entry.to_prompt(
+                is_generation=False, include_oracle_score=True,
+                config=config, max_score=config["max_possible_oracle_score"]
+            )
+            for optim_entry in entries
+        ]})
+        for entries in [train_entries, validation_entries]
+    ]
+    model_selection_callback = CustomModelSelectionCallback(snapshot)
+    model.train()
+    trainer = SFTTrainer(
+        model=model,
+        train_dataset=datasets[0],
+        eval_dataset=datasets[1],
+        formatting_func=lambda x: x["sample"],
+        args=training_args,
+        packing=False,
+        tokenizer=tokenizer,
+        max_seq_length=config["rej_sample_config"]["max_seq_length"],
+        callbacks=[model_selection_callback],
+        optimizers=[optimizer, lr_scheduler],
+    )
+    trainer.train()
+    model_selection_callback.restore_best_model(model)
+
+
+def engine_round(engine, config, train_entries, validation_entries):
+    engine.model.train()
+    engine.train(*[
+        [
+            optim_entry.to_prompt_segments(
+                is_generation=False, include_oracle_score=True,
+                config=config, max_score=config["max_possible_oracle_score"]
+            )
+            for optim_entry in entries
+        ]
+        for entries in [train_entries, validation_entries]
+    ])
+
+
+def time_rounds(name, pools, run_round):
+    round_times = []
+    for train_entries, validation_entries in pools:
+        start_time = time.perf_counter()
+        run_round(train_entries, validation_entries)
+        round_times.append(time.perf_counter() - start_time)
+    print(
+        f"{name:>12}: first round {round_times[0]:.3f} s, "
+        f"later rounds {sum(round_times[1:]) / max(len(round_times) - 1, 1):.3f} s on average"
+    )
+    return round_times
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--pool_size", type=int, default=10)
+    parser.add_argument("--num_new_entries", type=int, default=3)
+    parser.add_argument("--num_rounds", type=int, default=5)
+    parser.add_argument("--num_train_epochs", type=int, default=5)
+    parser.add_argument("--dataloader_num_workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    pools = create_pools(args)
+    results = {}
+    with tempfile.TemporaryDirectory() as checkpoints_dir:
+        config = create_config(args, checkpoints_dir)
+        for name in ["SFTTrainer", "engine"]:
+            set_seed(args.seed)
+            model = small_opt(len(tokenizer))
+            optimizer, lr_scheduler = get_optimizer_and_lr_scheduler(
+                model, config["rej_sample_config"], max_train_steps=1000
+            )
+            snapshot = ModelSnapshot()
+            if name == "SFTTrainer":
+                training_args = get_training_arguments(config["rej_sample_config"])
+                results[name] = time_rounds(name, pools, lambda train, valid: sft_trainer_round(
+                    model, tokenizer, config, training_args, optimizer, lr_scheduler,
+                    snapshot, train, valid
+                ))
+            else:
+                engine = FineTuningEngine(
+                    model, tokenizer, optimizer, lr_scheduler, config["rej_sample_config"], snapshot
+                )
+                results[name] = time_rounds(
+                    name, pools, lambda train, valid: engine_round(engine, config, train, valid)
+                )
+    print(f"speedup per round: {sum(results['SFTTrainer']) / sum(results['engine']):.2f}x")
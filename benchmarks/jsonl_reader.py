@@ -0,0 +1,109 @@
+"""
+    Lines per second per dataloader worker of the resumable jsonl reader: the former
+    text mode reader that writes the state of every line to a Manager dict against
+    samples_generator with a JsonlPositions block (the state of every line in shared
+    memory) and with a Manager dict updated every `--publish_every` lines. Each of
+    `--num_workers` processes reads its own synthetic file, like the dataloader workers
+    that get a shard of the files, and all of them share the states.
+
+    python -m benchmarks.jsonl_reader --num_lines 200000 --num_workers 2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from chemlactica.jsonl_dataset import (
+    JsonlPositions, distributed_state, format_sample, samples_generator,
+    should_yield_on_current_rank
+)
+from benchmarks.synthetic import synthetic_smiles
+
+
+def legacy_samples_generator(files, shared_jsonl_files):
+    file_states = {f: {"position": 0, "line_number": 0} for f in files}
+    returned = True
+    while returned:
+        returned = False
+        for file, state in file_states.items():
+            with open(file) as f:
+                f.seek(state["position"])
+                line = f.readline()
+                counter = 0
+                while line:
+                    state["position"] = f.tell()
+                    if should_yield_on_current_rank(
+                        counter,
+                        distributed_state.num_processes,
+                        distributed_state.process_index,
+                    ):
+                        returned = True
+                        yield format_sample(line)
+                    counter = counter + 1
+                    shared_jsonl_files[file] = state
+                    line = f.readline()
+
+
+def read_file(reader, file, states, publish_every, results):
+    if reader == "legacy":
+        generator = legacy_samples_generator([file], states)
+    else:
+        generator = samples_generator([file], states, publish_every=publish_every)
+    start_time = time.perf_counter()
+    num_lines = sum(1 for _ in generator)
+    results.put(num_lines / (time.perf_counter() - start_time))
+
+
+def write_files(directory, num_files, num_lines):
+    smiles_list = synthetic_smiles(1000, seed=0)
+    files = []
+    for i in range(num_files):
+        file = os.path.join(directory, f"train_{i}.jsonl")
+        with open(file, "w") as f:
+            for j in range(num_lines):
+                sample = {"SMILES": smiles_list[j % len(smiles_list)], "CID": j, "QED": 0.5}
+                f.write(json.dumps(sample) + "\n")
+        files.append(file)
+    return files
+
+
+def lines_per_second(reader, files, states, publish_every):
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=read_file, args=(reader, file, states, publish_every, results)
+        )
+        for file in files
+    ]
+    for process in processes:
+        process.start()
+    rates = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return sum(rates) / len(rates)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_lines", type=int, default=200000)
+    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--publish_every", type=int, default=1000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    with tempfile.TemporaryDirectory() as directory, multiprocessing.Manager() as manager:
+        files = write_files(directory, args.num_workers, args.num_lines)
+        rates = {}
+        rates["legacy, Manager dict"] = lines_per_second("legacy", files, manager.dict(), 1)
+        rates[f"Manager dict every {args.publish_every}"] = lines_per_second(
+            "binary", files, manager.dict(), args.publish_every
+        )
+        with JsonlPositions(files) as positions:
+            rates["JsonlPositions"] = lines_per_second("binary", files, positions, 1)
+    baseline = rates["legacy, Manager dict"]
+    for name, rate in rates.items():
+        print(f"{name:>26}: {rate:12.0f} lines/s per worker, {rate / baseline:6.1f}x")
@@ -0,0 +1,114 @@
+"""
+    Cost of keeping the best weights during a fine-tuning round: the former
+    CustomModelSelectionCallback (a fresh clone of the state dict on every improvement,
+    load_state_dict and gc.collect at the end) against ModelSnapshot buffers that are
+    allocated once. Every improvement is preceded by a fake optimizer step.
+
+    python -m benchmarks.model_snapshot --num_rounds 5 --num_improvements 5
+"""
+import argparse
+import gc
+import time
+from collections import OrderedDict
+import torch
+from chemlactica.mol_opt.tunning import ModelSnapshot
+from benchmarks.continuous_batching import small_opt
+
+
+def device_bytes_in_use(device):
+    if device.type == "cuda":
+        return torch.cuda.memory_allocated(device)
+    return 0
+
+
+def reset_peak(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_bytes(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    return 0
+
+
+@torch.no_grad()
+def perturb(model):
+    for param in model.parameters():
+        param.add_(1e-3)
+
+
+def clone_round(model, num_improvements):
+    best_model_state_dict = OrderedDict()
+    copy_time = 0.0
+    for _ in range(num_improvements):
+        perturb(model)
+        start_time = time.perf_counter()
+        for key, value in model.state_dict().items():
+            best_model_state_dict[key] = value.detach().clone()
+        copy_time += time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    model.load_state_dict(best_model_state_dict)
+    del best_model_state_dict
+    gc.collect()
+    return copy_time, time.perf_counter() - start_time
+
+
+def snapshot_round(model, snapshot, num_improvements):
+    snapshot.clear()
+    copy_time = 0.0
+    for _ in range(num_improvements):
+        perturb(model)
+        start_time = time.perf_counter()
+        snapshot.save(model)
+        copy_time += time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    snapshot.restore(model)
+    return copy_time, time.perf_counter() - start_time
+
+
+def run(name, model, device, args, round_fn):
+    copy_times, restore_times = [], []
+    reset_peak(device)
+    baseline = device_bytes_in_use(device)
+    for _ in range(args.num_rounds):
+        copy_time, restore_time = round_fn()
+        copy_times.append(copy_time)
+        restore_times.append(restore_time)
+    peak = "n/a on cpu"
+    if device.type == "cuda":
+        peak = f"{(peak_bytes(device) - baseline) / 2 ** 20:.1f} MiB"
+    print(
+        f"{name:>24}: copy {1000 * sum(copy_times) / args.num_rounds:.1f} ms/round, "
+        f"restore {1000 * sum(restore_times) / args.num_rounds:.1f} ms/round, "
+        f"peak extra device memory {peak}"
+    )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_rounds", type=int, default=5)
+    parser.add_argument("--num_improvements", type=int, default=5)
+    parser.add_argument("--vocab_size", type=int, default=50066)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    device = torch.device(args.device)
+    model = small_opt(args.vocab_size).to(device)
+    model_bytes = sum(p.numel() * p.element_size() for p in model.state_dict().values())
+    print(f"model state dict: {model_bytes / 2 ** 20:.1f} MiB on {device}")
+
+    run("clone", model, device, args, lambda: clone_round(model, args.num_improvements))
+    for snapshot_device in [None, "cpu"]:
+        snapshot = ModelSnapshot(device=snapshot_device)
+        run(
+            f"snapshot ({snapshot_device or 'model device'})", model, device, args,
+            lambda: snapshot_round(model, snapshot, args.num_improvements)
+        )
+        print(f"{'':>24}  buffers: {snapshot.nbytes / 2 ** 20:.1f} MiB, allocated once")
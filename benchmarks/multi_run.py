@@ -0,0 +1,66 @@
+"""
+    Wall-clock time of several optimize runs (one per seed) one after another against
+    optimize_runs, which merges their generation batches. The model is a SyntheticGenerator
+    that sleeps a fixed time per generate call, like an accelerator that is not saturated
+    by the batch of a single run.
+
+    python -m benchmarks.multi_run --num_runs 4 --generation_time 0.2
+"""
+import argparse
+import copy
+import os
+import tempfile
+import time
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.multi_run import optimize_runs
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import set_seed
+from benchmarks.async_oracle import create_config
+from benchmarks.synthetic import SyntheticGenerator, SlowOracle
+
+
+def create_runs(args, log_dir):
+    args.async_oracle = False
+    runs = []
+    for seed in range(args.num_runs):
+        config = create_config(args, os.path.join(log_dir, f"results_{seed}.log"))
+        runs.append({"oracle": SlowOracle(args.max_oracle_calls), "config": config, "seed": seed})
+    return runs
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--num_runs", type=int, default=4)
+    parser.add_argument("--max_oracle_calls", type=int, default=500)
+    parser.add_argument("--num_gens_per_iter", type=int, default=100)
+    parser.add_argument("--generation_batch_size", type=int, default=50)
+    parser.add_argument("--generation_time", type=float, default=0.2)
+    parser.add_argument("--num_processes", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    model = SyntheticGenerator(tokenizer, generation_time=args.generation_time)
+    with tempfile.TemporaryDirectory() as log_dir:
+        runs = create_runs(args, log_dir)
+        start_time = time.perf_counter()
+        for run in runs:
+            set_seed(run["seed"])
+            optimize(model, tokenizer, run["oracle"], copy.deepcopy(run["config"]))
+        sequential_time = time.perf_counter() - start_time
+
+        runs = create_runs(args, log_dir)
+        start_time = time.perf_counter()
+        scheduler = optimize_runs(model, tokenizer, runs)
+        batched_time = time.perf_counter() - start_time
+    print(f"sequential: {sequential_time:.2f} s")
+    print(
+        f"   batched: {batched_time:.2f} s, {scheduler.num_generate_calls} generate calls "
+        f"for {scheduler.num_requests} requests"
+    )
+    print(f"speedup: {sequential_time / batched_time:.2f}x")
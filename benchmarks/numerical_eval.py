@@ -0,0 +1,68 @@
+"""
+    Wall-clock time of the SFT numerical evaluation: the former loop that generates for
+    one validation molecule at a time against the length-bucketed batches of
+    generate_property_texts, on CPU with the small_opt model. The random model rarely
+    writes [/PROPERTY], so most rows run to max_new_tokens.
+
+    python -m benchmarks.numerical_eval --num_samples 200 --batch_size 32
+"""
+import argparse
+import time
+import torch
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.utils import set_seed
+from chemlactica.utils.numerical_eval import (
+    END_PROPERTY_TAG, generate_property_texts, property_prompt
+)
+from benchmarks.continuous_batching import small_opt
+from benchmarks.synthetic import synthetic_smiles
+
+
+@torch.no_grad()
+def legacy_texts(model, tokenizer, prompts, max_new_tokens):
+    texts = []
+    for prompt in prompts:
+        eos_token_id = tokenizer.encode(END_PROPERTY_TAG)[0]
+        data = tokenizer(prompt, return_tensors="pt")
+        output = model.generate(
+            data.input_ids, do_sample=False, eos_token_id=eos_token_id,
+            max_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id
+        )
+        texts.append(tokenizer.batch_decode(output)[0])
+    return texts
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--num_samples", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_new_tokens", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    set_seed(args.seed)
+    model = small_opt(len(tokenizer))
+    prompts = [
+        property_prompt(smiles, "</s>")
+        for smiles in synthetic_smiles(args.num_samples, seed=args.seed)
+    ]
+    start_time = time.perf_counter()
+    expected = legacy_texts(model, tokenizer, prompts, args.max_new_tokens)
+    legacy_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    texts = generate_property_texts(
+        model, tokenizer, prompts, batch_size=args.batch_size, max_new_tokens=args.max_new_tokens
+    )
+    batched_time = time.perf_counter() - start_time
+    num_equal = sum(text == expected_text for text, expected_text in zip(texts, expected))
+    print(f"one at a time: {legacy_time:.2f} s")
+    print(f"      batched: {batched_time:.2f} s, {num_equal}/{len(texts)} identical completions")
+    print(f"speedup: {legacy_time / batched_time:.2f}x")
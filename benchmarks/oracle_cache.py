@@ -0,0 +1,73 @@
+"""
+    Wall-clock time of several optimize runs (seeds or hyperparameter trials) with a slow
+    oracle, each run scoring everything itself against runs sharing an on-disk OracleCache.
+    The SyntheticGenerator draws from `--num_molecules` molecules, so runs generate
+    overlapping molecules like seeds of the same model do.
+
+    python -m benchmarks.oracle_cache --num_runs 4 --seconds_per_molecule 0.01
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import set_seed
+from benchmarks.async_oracle import create_config
+from benchmarks.synthetic import SyntheticGenerator, SlowOracle
+
+
+class CountingOracle(SlowOracle):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.num_scored = 0
+
+    def __call__(self, smiles_list):
+        self.num_scored += sum(smiles not in self.mol_buffer for smiles in set(smiles_list))
+        return super().__call__(smiles_list)
+
+
+def run_all(args, tokenizer, log_dir, oracle_cache_path=None):
+    args.async_oracle = False
+    num_scored = []
+    start_time = time.perf_counter()
+    for seed in range(args.num_runs):
+        set_seed(seed)
+        # the same molecules for every run, drawn in a different order
+        model = SyntheticGenerator(tokenizer, num_molecules=args.num_molecules)
+        model.rng = random.Random(seed)
+        oracle = CountingOracle(args.max_oracle_calls, args.seconds_per_molecule)
+        config = create_config(args, os.path.join(log_dir, f"results_{seed}.log"))
+        config["oracle_cache_path"] = oracle_cache_path
+        optimize(model, tokenizer, oracle, config)
+        num_scored.append(oracle.num_scored)
+    return time.perf_counter() - start_time, num_scored
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--num_runs", type=int, default=4)
+    parser.add_argument("--num_molecules", type=int, default=3000)
+    parser.add_argument("--max_oracle_calls", type=int, default=500)
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--generation_batch_size", type=int, default=100)
+    parser.add_argument("--seconds_per_molecule", type=float, default=0.01)
+    parser.add_argument("--num_processes", type=int, default=1)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    with tempfile.TemporaryDirectory() as log_dir:
+        uncached_time, uncached_scored = run_all(args, tokenizer, log_dir)
+        cached_time, cached_scored = run_all(
+            args, tokenizer, log_dir, os.path.join(log_dir, "oracle_cache.sqlite")
+        )
+    print(f"no cache: {uncached_time:.2f} s, molecules scored per run {uncached_scored}")
+    print(f"   cache: {cached_time:.2f} s, molecules scored per run {cached_scored}")
+    print(f"speedup: {uncached_time / cached_time:.2f}x")
@@ -0,0 +1,67 @@
+"""
+    Phase timings of an optimize run with a SyntheticGenerator and a SlowOracle, and the
+    overhead of the instrumentation: the cost of an empty phase times the number of phases
+    the run entered, relative to its wall-clock time.
+
+    python -m benchmarks.phase_timings --max_oracle_calls 1000 --generation_time 0.05
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.instrumentation import PhaseTimer
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import set_seed
+from benchmarks.async_oracle import create_config
+from benchmarks.synthetic import SyntheticGenerator, SlowOracle
+
+
+def phase_cost(num_phases=100000):
+    timer = PhaseTimer()
+    start_time = time.perf_counter()
+    for _ in range(num_phases):
+        with timer.phase("empty"):
+            pass
+    return (time.perf_counter() - start_time) / num_phases
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--max_oracle_calls", type=int, default=1000)
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--generation_batch_size", type=int, default=50)
+    parser.add_argument("--generation_time", type=float, default=0.05)
+    parser.add_argument("--seconds_per_molecule", type=float, default=0.0)
+    parser.add_argument("--num_processes", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    args.async_oracle = False
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    set_seed(args.seed)
+    model = SyntheticGenerator(tokenizer, generation_time=args.generation_time, seed=args.seed)
+    oracle = SlowOracle(args.max_oracle_calls, args.seconds_per_molecule)
+    with tempfile.TemporaryDirectory() as log_dir:
+        config = create_config(args, os.path.join(log_dir, "results.log"))
+        config["max_possible_oracle_score"] = oracle.max_possible_oracle_score
+        config["timings_path"] = os.path.join(log_dir, "timings.jsonl")
+        start_time = time.perf_counter()
+        optimize(model, tokenizer, oracle, config)
+        wall_time = time.perf_counter() - start_time
+        with open(config["timings_path"]) as file:
+            records = [json.loads(line) for line in file]
+    num_phases = sum(sum(record["calls"].values()) for record in records)
+    cost = phase_cost()
+    print(f"{len(records)} iterations, {num_phases} phases in {wall_time:.2f} s")
+    print(
+        f"phase cost: {1e6 * cost:.2f} us, "
+        f"overhead: {100 * num_phases * cost / wall_time:.4f}% of the run"
+    )
@@ -0,0 +1,102 @@
+"""
+    Per-iteration cost of Pool.add at different pool sizes.
+
+    python -m benchmarks.pool_add --pool_sizes 10 100 1000 10000 100000
+"""
+import argparse
+import random
+import time
+from typing import List
+import numpy as np
+from chemlactica.mol_opt.utils import (
+    MoleculeEntry, OptimEntry, Pool, EntryStatus, tanimoto_dist_func
+)
+from benchmarks.synthetic import synthetic_smiles
+
+
+class LegacyPool(Pool):
+    """
+        Pool.add as it was before the sorted index: full re-sort and pairwise deduplication.
+    """
+
+    def add(self, entries: List, diversity_score=1.0):
+        self.optim_entries.extend(entries)
+        self.optim_entries.sort(key=lambda x: x.last_entry, reverse=True)
+        new_optim_entries = []
+        for entry in self.optim_entries:
+            insert = True
+            for e in new_optim_entries:
+                if (
+                    entry.last_entry == e.last_entry
+                    or tanimoto_dist_func(
+                        entry.last_entry.fingerprint, e.last_entry.fingerprint
+                    )
+                    > diversity_score
+                ):
+                    insert = False
+                    break
+            if insert:
+                new_optim_entries.append(entry)
+        self.optim_entries = new_optim_entries[: min(len(new_optim_entries), self.size)]
+        curr_num_validation_entries = sum(
+            [entry.entry_status == EntryStatus.valid for entry in self.optim_entries]
+        )
+        i = 0
+        while curr_num_validation_entries < self.num_validation_entries:
+            if self.optim_entries[i].entry_status == EntryStatus.none:
+                self.optim_entries[i].entry_status = EntryStatus.valid
+                curr_num_validation_entries += 1
+            i += 1
+        for j in range(i, len(self.optim_entries)):
+            if self.optim_entries[j].entry_status == EntryStatus.none:
+                self.optim_entries[j].entry_status = EntryStatus.train
+
+
+def create_entries(smiles_list, rng):
+    return [OptimEntry(MoleculeEntry(smiles, score=rng.random()), []) for smiles in smiles_list]
+
+
+def time_pool_add(pool_class, pool_size, batches, initial_entries, diversity_score):
+    pool = pool_class(pool_size, validation_perc=0.2)
+    pool.add(list(initial_entries), diversity_score=diversity_score)
+    timings = []
+    for batch in batches:
+        start_time = time.perf_counter()
+        pool.add(list(batch), diversity_score=diversity_score)
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pool_sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--num_iters", type=int, default=10)
+    parser.add_argument("--diversity_score", type=float, default=1.0)
+    parser.add_argument("--legacy_max_size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    rng = random.Random(args.seed)
+    print(f"{'pool size':>10} | {'Pool.add ms/iter':>16} | {'legacy ms/iter':>14}")
+    for pool_size in args.pool_sizes:
+        num_new = args.num_gens_per_iter * args.num_iters
+        entries = create_entries(synthetic_smiles(pool_size + num_new, seed=args.seed), rng)
+        initial_entries = entries[:pool_size]
+        batches = [
+            entries[pool_size + i:pool_size + i + args.num_gens_per_iter]
+            for i in range(0, num_new, args.num_gens_per_iter)
+        ]
+        timings = time_pool_add(Pool, pool_size, batches, initial_entries, args.diversity_score)
+        legacy = "-"
+        if pool_size <= args.legacy_max_size:
+            for entry in entries:
+                entry.entry_status = EntryStatus.none
+            legacy_timings = time_pool_add(
+                LegacyPool, pool_size, batches, initial_entries, args.diversity_score
+            )
+            legacy = f"{np.mean(legacy_timings) * 1000:.2f}"
+        print(f"{pool_size:>10} | {np.mean(timings) * 1000:>16.2f} | {legacy:>14}")
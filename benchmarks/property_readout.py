@@ -0,0 +1,59 @@
+"""
+    Wall-clock time of reading a numeric property from the number-token distribution
+    (read_properties, a prompt pass and max_tokens constrained beam steps) against the
+    greedy batched generation of generate_property_texts, on CPU with the small_opt model.
+    The random model rarely writes [/PROPERTY], so the generation runs to max_new_tokens
+    while the readout always stops after max_tokens steps.
+
+    python -m benchmarks.property_readout --num_samples 200 --batch_size 32
+"""
+import argparse
+import time
+import numpy as np
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.utils import set_seed
+from chemlactica.utils.numerical_eval import (
+    generate_property_texts, property_prompt, read_properties
+)
+from benchmarks.continuous_batching import small_opt
+from benchmarks.synthetic import synthetic_smiles
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--num_samples", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_new_tokens", type=int, default=100)
+    parser.add_argument("--num_beams", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    set_seed(args.seed)
+    model = small_opt(len(tokenizer))
+    smiles_list = synthetic_smiles(args.num_samples, seed=args.seed)
+
+    start_time = time.perf_counter()
+    generate_property_texts(
+        model, tokenizer, [property_prompt(smiles, "</s>") for smiles in smiles_list],
+        batch_size=args.batch_size, max_new_tokens=args.max_new_tokens
+    )
+    generation_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    distributions = read_properties(
+        model, tokenizer, smiles_list, "</s>", batch_size=args.batch_size,
+        num_beams=args.num_beams, max_tokens=args.max_tokens
+    )
+    readout_time = time.perf_counter() - start_time
+    num_values = np.mean([len(distribution.values) for distribution in distributions])
+    print(f"greedy generation: {generation_time:.2f} s")
+    print(f"          readout: {readout_time:.2f} s, {num_values:.1f} values per molecule")
+    print(f"speedup: {generation_time / readout_time:.2f}x")
@@ -0,0 +1,83 @@
+"""
+    Time spent in the optimize loop on the run log and the size of the log, the former
+    per-molecule file.write against the RunLogWriter with the text and the jsonl format.
+    Every iteration logs `--num_gens_per_iter` scored molecules and the pool.
+
+    python -m benchmarks.run_log --num_iters 200 --pool_size 1000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from chemlactica.mol_opt.run_log import RunLogWriter
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool
+from benchmarks.synthetic import synthetic_smiles
+
+
+def create_iterations(args):
+    rng = random.Random(args.seed)
+    smiles_list = synthetic_smiles(args.num_iters * args.num_gens_per_iter, seed=args.seed)
+    pool = Pool(args.pool_size, validation_perc=0.2)
+    iterations = []
+    for i in range(args.num_iters):
+        entries = [
+            OptimEntry(MoleculeEntry(smiles, score=rng.random()), [])
+            for smiles in smiles_list[i * args.num_gens_per_iter:(i + 1) * args.num_gens_per_iter]
+        ]
+        pool.add(entries)
+        iterations.append((entries, list(pool.optim_entries)))
+    return iterations
+
+
+def write_legacy(path, iterations):
+    start_time = time.perf_counter()
+    file = open(path, "w")
+    for entries, pool_entries in iterations:
+        for optim_entry in entries:
+            file.write(f"generated smiles: {optim_entry.last_entry.smiles}, score: {optim_entry.last_entry.score:.4f}\n")  # noqa: E501
+        file.write("Pool\n")
+        for i, optim_entry in enumerate(pool_entries):
+            file.write(f"\t{i} smiles: {optim_entry.last_entry.smiles}, score: {optim_entry.last_entry.score:.4f}\n")  # noqa: E501
+    loop_time = time.perf_counter() - start_time
+    file.close()
+    return loop_time, time.perf_counter() - start_time
+
+
+def write_run_log(path, iterations, log_format):
+    start_time = time.perf_counter()
+    run_log = RunLogWriter(path, log_format=log_format)
+    for iteration, (entries, pool_entries) in enumerate(iterations):
+        run_log.generated([
+            (optim_entry.last_entry.smiles, optim_entry.last_entry.score) for optim_entry in entries
+        ])
+        run_log.pool(pool_entries, iteration)
+    loop_time = time.perf_counter() - start_time
+    run_log.close()
+    return loop_time, time.perf_counter() - start_time
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_iters", type=int, default=200)
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--pool_size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    iterations = create_iterations(args)
+    with tempfile.TemporaryDirectory() as log_dir:
+        for name, write in [
+            ("file.write", write_legacy),
+            ("text", lambda path, iterations: write_run_log(path, iterations, "text")),
+            ("jsonl", lambda path, iterations: write_run_log(path, iterations, "jsonl")),
+        ]:
+            path = os.path.join(log_dir, name)
+            loop_time, total_time = write(path, iterations)
+            print(
+                f"{name:>10}: {1000 * loop_time / args.num_iters:.3f} ms/iter in the loop, "
+                f"{total_time:.2f} s until closed, {os.path.getsize(path) / 2 ** 20:.1f} MiB"
+            )
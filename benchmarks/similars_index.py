@@ -0,0 +1,62 @@
+"""
+    Cost of choosing the nearest scored molecules as [SIMILAR] molecules for a generation
+    batch: a bulk_tanimoto scan of the whole history per prompt molecule against one
+    batched FingerprintIndex search. The history grows by `--scored_per_batch` molecules
+    between batches, which are added to the index incrementally.
+
+    python -m benchmarks.similars_index --history_sizes 1000 10000 50000 --num_queries 250
+"""
+import argparse
+import time
+import numpy as np
+from chemlactica.mol_opt.featurization import featurize
+from chemlactica.mol_opt.fingerprints import FingerprintIndex, bulk_tanimoto, popcount
+from benchmarks.synthetic import synthetic_smiles
+
+
+def brute_force(history, history_counts, queries, query_rows, k):
+    rows = []
+    for query, query_row in zip(queries, query_rows):
+        similarities = bulk_tanimoto(query, history, counts=history_counts)
+        similarities[query_row] = -1
+        rows.append(np.argpartition(-similarities, k)[:k])
+    return rows
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history_sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--num_queries", type=int, default=250)
+    parser.add_argument("--num_similars", type=int, default=5)
+    parser.add_argument("--scored_per_batch", type=int, default=200)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    smiles_list = synthetic_smiles(max(args.history_sizes) + args.scored_per_batch)
+    fingerprints = np.stack([featurize(smiles).packed_fingerprint for smiles in smiles_list])
+    rng = np.random.default_rng(0)
+    for history_size in args.history_sizes:
+        history = fingerprints[:history_size]
+        query_rows = rng.choice(history_size, args.num_queries)
+        queries = history[query_rows]
+
+        start_time = time.perf_counter()
+        brute_force(history, popcount(history), queries, query_rows, args.num_similars)
+        scan_time = time.perf_counter() - start_time
+
+        index = FingerprintIndex()
+        index.add(history)
+        start_time = time.perf_counter()
+        index.search(queries, args.num_similars, exclude_rows=query_rows)
+        search_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        index.add(fingerprints[history_size:history_size + args.scored_per_batch])
+        add_time = time.perf_counter() - start_time
+
+        print(
+            f"history {history_size:>6}: scan {1000 * scan_time:8.1f} ms, "
+            f"index search {1000 * search_time:6.1f} ms ({scan_time / search_time:.0f}x), "
+            f"adding {args.scored_per_batch} molecules {1000 * add_time:.2f} ms"
+        )
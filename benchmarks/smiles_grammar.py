@@ -0,0 +1,98 @@
+"""
+    Valid molecules per 1k generated tokens with and without the SMILES grammar processor.
+    Uses the randomly initialized small_opt model unless --checkpoint_path is given, with an
+    EndSmilesBias processor so that the random model ends its molecules.
+
+    python -m benchmarks.smiles_grammar --num_prompts 200
+"""
+import argparse
+import time
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
+from chemlactica.mol_opt.optimization import extract_generated_smiles
+from chemlactica.mol_opt.featurization import featurize
+from chemlactica.mol_opt.utils import set_seed
+from chemlactica.utils.logits_processors import SMILESGrammarLogitsProcessor
+from benchmarks.continuous_batching import EndSmilesBias, small_opt, create_prompts
+
+END_SMILES_TOKEN_ID = 20
+
+
+def count_valid_molecules(generated_texts):
+    num_valid = 0
+    for generated_text in generated_texts:
+        smiles = extract_generated_smiles(generated_text)
+        if not smiles:
+            continue
+        try:
+            featurize(smiles)
+            num_valid += 1
+        except ValueError:
+            pass
+    return num_valid
+
+
+def measure_yield(model, tokenizer, prompts_ids, args, processors):
+    num_valid, num_generated_tokens = 0, 0
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(prompts_ids), args.batch_size):
+        batch = prompts_ids[batch_start:batch_start + args.batch_size]
+        max_length = max(len(prompt_ids) for prompt_ids in batch)
+        input_ids = torch.full((len(batch), max_length), tokenizer.pad_token_id)
+        attention_mask = torch.zeros((len(batch), max_length), dtype=torch.long)
+        for i, prompt_ids in enumerate(batch):
+            input_ids[i, max_length - len(prompt_ids):] = torch.tensor(prompt_ids)
+            attention_mask[i, max_length - len(prompt_ids):] = 1
+        output = model.generate(
+            input_ids=input_ids.to(model.device), attention_mask=attention_mask.to(model.device),
+            max_new_tokens=args.max_new_tokens, do_sample=True, top_k=0,
+            eos_token_id=END_SMILES_TOKEN_ID, pad_token_id=tokenizer.pad_token_id,
+            logits_processor=processors
+        )
+        generated = output[:, max_length:]
+        num_generated_tokens += (generated != tokenizer.pad_token_id).sum().item()
+        num_valid += count_valid_molecules(tokenizer.batch_decode(generated))
+    return num_valid, num_generated_tokens, time.perf_counter() - start_time
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument("--checkpoint_path", type=str, default=None)
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--num_prompts", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--num_similars", type=int, default=3)
+    parser.add_argument("--max_new_tokens", type=int, default=100)
+    parser.add_argument("--end_probability", type=float, default=1 / 30)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    set_seed(args.seed)
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    if args.checkpoint_path:
+        model = AutoModelForCausalLM.from_pretrained(args.checkpoint_path).to(args.device).eval()
+        base_processors = []
+    else:
+        model = small_opt(len(tokenizer))
+        base_processors = [EndSmilesBias(args.end_probability)]
+    prompts_ids = create_prompts(tokenizer, args.num_prompts, args.num_similars, args.seed)
+    grammar_processor = SMILESGrammarLogitsProcessor(tokenizer=tokenizer)
+    for name, processors in [
+            ("unconstrained", base_processors),
+            ("smiles grammar", [grammar_processor] + base_processors),
+    ]:
+        set_seed(args.seed)
+        with torch.no_grad():
+            num_valid, num_tokens, elapsed = measure_yield(
+                model, tokenizer, prompts_ids, args, LogitsProcessorList(processors)
+            )
+        print(
+            f"{name:>15}: {num_valid} valid molecules, {num_tokens} generated tokens, "
+            f"{1000 * num_valid / max(num_tokens, 1):.2f} valid per 1k tokens, {elapsed:.1f} s"
+        )
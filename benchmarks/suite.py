@@ -0,0 +1,286 @@
+"""
+    Benchmark suite of the mol_opt hot paths that runs on CPU without network access:
+    Pool.add, OptimEntry.to_prompt, create_molecule_entry and top_auc on synthetic pools and
+    oracle buffers, and an end-to-end optimize with a random small_opt model and a TPSA oracle.
+    The results are written as JSON, `--baseline` compares them to saved results and exits
+    with 1 when a benchmark got slower than the threshold.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json --threshold 0.2
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+from transformers import AutoTokenizer, LogitsProcessor, LogitsProcessorList
+from chemlactica.mol_opt.featurization import featurization_cache
+from chemlactica.mol_opt.metrics import top_auc
+from chemlactica.mol_opt.optimization import create_molecule_entry, optimize
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool, set_seed
+from benchmarks.continuous_batching import END_SMILES_TOKEN_ID, small_opt
+from benchmarks.synthetic import SlowOracle, synthetic_smiles
+
+
+class ChainSmilesProcessor(LogitsProcessor):
+    """
+        Restricts a random model to tokens made of C, N and O atoms, so every generated
+        SMILES is a valid chain, and makes it end the molecule with `end_probability`
+        at every step.
+    """
+
+    def __init__(self, tokenizer, end_probability):
+        atom_token_ids = [
+            token_id for token, token_id in tokenizer.get_vocab().items()
+            if re.fullmatch("[CNO]+", token)
+        ]
+        self.allowed_token_ids = torch.tensor(atom_token_ids + [END_SMILES_TOKEN_ID])
+        self.end_log_odds = np.log(end_probability / (1 - end_probability))
+
+    def __call__(self, input_ids, scores):
+        allowed_scores = scores[:, self.allowed_token_ids]
+        scores = torch.full_like(scores, -float("inf"))
+        scores[:, self.allowed_token_ids] = allowed_scores
+        scores[:, END_SMILES_TOKEN_ID] = torch.logsumexp(allowed_scores, dim=-1) + self.end_log_odds
+        return scores
+
+
+def constrain_generation(model, processor):
+    generate = model.generate
+
+    def constrained_generate(*args, logits_processor=None, **kwargs):
+        logits_processor = LogitsProcessorList(list(logits_processor or []) + [processor])
+        return generate(*args, logits_processor=logits_processor, **kwargs)
+    model.generate = constrained_generate
+    return model
+
+
+def time_repeats(run, num_repeats, setup=None):
+    timings = []
+    for _ in range(num_repeats):
+        state = setup() if setup is not None else None
+        start_time = time.perf_counter()
+        run(state)
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def create_entries(smiles_list, rng):
+    return [OptimEntry(MoleculeEntry(smiles, score=rng.random()), []) for smiles in smiles_list]
+
+
+def bench_pool_add(args):
+    rng = random.Random(args.seed)
+    smiles_list = synthetic_smiles(args.pool_size + args.num_gens_per_iter, seed=args.seed)
+    initial_smiles = smiles_list[:args.pool_size]
+    new_smiles = smiles_list[args.pool_size:]
+
+    def setup():
+        pool = Pool(args.pool_size, validation_perc=0.2)
+        pool.add(create_entries(initial_smiles, rng))
+        return pool, create_entries(new_smiles, rng)
+
+    timings = time_repeats(lambda state: state[0].add(state[1]), args.repeats, setup)
+    return timings, {"pool_size": args.pool_size, "num_new_entries": args.num_gens_per_iter}
+
+
+def bench_to_prompt(args):
+    rng = random.Random(args.seed)
+    num_similars = 5
+    smiles_list = synthetic_smiles(args.num_prompts * (num_similars + 1), seed=args.seed)
+    mol_entries = [MoleculeEntry(smiles, score=rng.random()) for smiles in smiles_list]
+    optim_entries = []
+    for i in range(args.num_prompts):
+        mol_entry = mol_entries[i]
+        mol_entry.similar_mol_entries = mol_entries[
+            args.num_prompts + i * num_similars:args.num_prompts + (i + 1) * num_similars
+        ]
+        last_entry = MoleculeEntry(smiles="")
+        last_entry.similar_mol_entries = mol_entry.similar_mol_entries
+        optim_entries.append(OptimEntry(last_entry, [mol_entry]))
+    config = {
+        "eos_token": "</s>", "sim_range": [0.4, 0.9],
+        "max_possible_oracle_score": 1.0, "strategy": ["default"],
+    }
+
+    def run(state):
+        for optim_entry in optim_entries:
+            optim_entry.to_prompt(
+                is_generation=True, include_oracle_score=True, config=config, max_score=1.0
+            )
+
+    return time_repeats(run, args.repeats), {"num_prompts": args.num_prompts}
+
+
+def bench_create_molecule_entry(args):
+    smiles_list = synthetic_smiles(args.num_prompts, seed=args.seed + 1)
+    output_texts = [
+        f"</s>[SIMILAR]c1ccccc1 0.70[/SIMILAR][START_SMILES]{smiles}[END_SMILES]"
+        for smiles in smiles_list
+    ]
+
+    def run(state):
+        for output_text in output_texts:
+            create_molecule_entry(output_text, lambda smiles: True)
+
+    # featurizes every molecule, as the generated molecules of optimize are new
+    timings = time_repeats(run, args.repeats, setup=featurization_cache.clear)
+    return timings, {"num_molecules": args.num_prompts}
+
+
+def bench_top_auc(args):
+    rng = np.random.default_rng(args.seed)
+    buffer = {
+        f"mol{i}": [score, i + 1]
+        for i, score in enumerate(rng.random(args.buffer_size).tolist())
+    }
+    timings = time_repeats(
+        lambda state: top_auc(buffer, 10, True, 100, args.buffer_size), args.repeats
+    )
+    return timings, {"buffer_size": args.buffer_size}
+
+
+def bench_optimize(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path, padding_side="left")
+    processor = ChainSmilesProcessor(tokenizer, end_probability=0.1)
+
+    def run(state):
+        set_seed(args.seed)
+        featurization_cache.clear()
+        model = constrain_generation(small_opt(len(tokenizer)), processor)
+        with tempfile.TemporaryDirectory() as log_dir:
+            config = {
+                "log_dir": os.path.join(log_dir, "results.log"),
+                "pool_size": 10,
+                "validation_perc": 0.2,
+                "num_mols": 1,
+                "num_similars": 2,
+                "num_gens_per_iter": 50,
+                "generation_batch_size": 50,
+                "sim_range": [0.4, 0.9],
+                "eos_token": "</s>",
+                "generation_temperature": [1.0, 1.5],
+                "generation_config": {
+                    "max_new_tokens": 50, "do_sample": True, "top_k": 0,
+                    "eos_token_id": END_SMILES_TOKEN_ID,
+                },
+                "strategy": ["default"],
+                "max_possible_oracle_score": 200,
+            }
+            # optimize reports its progress on stdout
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                optimize(model, tokenizer, SlowOracle(args.max_oracle_calls), config)
+
+    timings = time_repeats(run, args.optimize_repeats)
+    return timings, {"max_oracle_calls": args.max_oracle_calls, "model": "small_opt"}
+
+
+BENCHMARKS = {
+    "pool_add": bench_pool_add,
+    "to_prompt": bench_to_prompt,
+    "create_molecule_entry": bench_create_molecule_entry,
+    "top_auc": bench_top_auc,
+    "optimize": bench_optimize,
+}
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+        "git_commit": commit,
+    }
+
+
+def run_benchmarks(args):
+    results = {}
+    for name in args.benchmarks:
+        timings, params = BENCHMARKS[name](args)
+        results[name] = {
+            "median": statistics.median(timings),
+            "min": min(timings),
+            "timings": timings,
+            "params": params,
+        }
+        print(f"{name:>22}: median {results[name]['median'] * 1000:10.2f} ms, "
+              f"min {results[name]['min'] * 1000:10.2f} ms", flush=True)
+    return {"environment": environment(), "results": results}
+
+
+def compare(results, baseline, threshold):
+    """
+        Ratios of the median times to the baseline, the benchmarks slower by more than
+        `threshold` are regressions. Benchmarks with other parameters are not compared.
+    """
+    regressions = []
+    print(f"{'benchmark':>22} | {'baseline ms':>11} | {'current ms':>10} | {'ratio':>6}")
+    for name, result in results["results"].items():
+        baseline_result = baseline["results"].get(name)
+        if baseline_result is None or baseline_result["params"] != result["params"]:
+            print(f"{name:>22} | {'-':>11} | {result['median'] * 1000:>10.2f} | {'-':>6}")
+            continue
+        ratio = result["median"] / baseline_result["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:>22} | {baseline_result['median'] * 1000:>11.2f} | "
+            f"{result['median'] * 1000:>10.2f} | {ratio:>6.2f}{flag}"
+        )
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tokenizer_path", type=str, default="chemlactica/tokenizer/ChemLacticaTokenizer66"
+    )
+    parser.add_argument(
+        "--benchmarks", type=str, nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS)
+    )
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--threshold", type=float, default=0.2)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--optimize_repeats", type=int, default=1)
+    parser.add_argument("--pool_size", type=int, default=1000)
+    parser.add_argument("--num_gens_per_iter", type=int, default=200)
+    parser.add_argument("--num_prompts", type=int, default=1000)
+    parser.add_argument("--buffer_size", type=int, default=100000)
+    parser.add_argument("--max_oracle_calls", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,108 @@
+import random
+import time
+import torch
+from rdkit import Chem, RDLogger
+from rdkit.Chem import rdMolDescriptors
+
+RDLogger.DisableLog("rdApp.*")
+
+
+RING_CORES = [
+    "c1ccccc1", "C1CCCCC1", "c1ccncc1", "C1CCNCC1",
+    "c1ccoc1", "C1CCOC1", "c1ccsc1", "c1ccc2ccccc2c1",
+]
+LINKERS = ["C", "O", "N", "S", "C(=O)", "C(C)", "N(C)", "C(F)", "C(O)", "CC"]
+
+
+def synthetic_smiles(num_molecules: int, seed: int = 0):
+    """
+        Generates `num_molecules` distinct valid canonical SMILES by joining ring cores with
+        random linker chains, so benchmarks can build pools of any size without network access.
+    """
+    rng = random.Random(seed)
+    seen = set()
+    smiles_list = []
+    while len(smiles_list) < num_molecules:
+        smiles = rng.choice(RING_CORES)
+        smiles += "".join(rng.choice(LINKERS) for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.5:
+            smiles += rng.choice(RING_CORES)
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            continue
+        smiles = Chem.MolToSmiles(mol, canonical=True)
+        if smiles not in seen:
+            seen.add(smiles)
+            smiles_list.append(smiles)
+    return smiles_list
+
+
+class SyntheticGenerator(torch.nn.Module):
+    """
+        Stand-in for a causal LM in optimize benchmarks. `generate` appends a random synthetic
+        molecule followed by [END_SMILES] to every prompt, after sleeping `generation_time`
+        seconds to mimic the accelerator.
+    """
+
+    def __init__(self, tokenizer, num_molecules=20000, generation_time=0.0, seed=0):
+        super().__init__()
+        self.molecule_token_ids = [
+            tokenizer.encode(smiles + "[END_SMILES]", add_special_tokens=False)
+            for smiles in synthetic_smiles(num_molecules, seed)
+        ]
+        self.pad_token_id = tokenizer.pad_token_id
+        self.generation_time = generation_time
+        self.rng = random.Random(seed)
+        self.register_buffer("dummy", torch.zeros(0))
+
+    @property
+    def device(self):
+        return self.dummy.device
+
+    def generate(self, input_ids, max_new_tokens=100, **kwargs):
+        time.sleep(self.generation_time)
+        generated = [
+            self.rng.choice(self.molecule_token_ids)[:max_new_tokens]
+            for _ in range(len(input_ids))
+        ]
+        max_length = max(len(token_ids) for token_ids in generated)
+        new_tokens = torch.full(
+            (len(input_ids), max_length), self.pad_token_id, dtype=input_ids.dtype
+        )
+        for i, token_ids in enumerate(generated):
+            new_tokens[i, :len(token_ids)] = torch.tensor(token_ids)
+        return torch.cat([input_ids, new_tokens.to(input_ids.device)], dim=1)
+
+
+class SlowOracle:
+    """
+        TPSA oracle that sleeps `seconds_per_molecule` for every new molecule,
+        a local stand-in for docking-style oracles.
+    """
+
+    def __init__(self, max_oracle_calls: int, seconds_per_molecule: float = 0.0):
+        self.max_oracle_calls = max_oracle_calls
+        self.seconds_per_molecule = seconds_per_molecule
+        self.mol_buffer = {}
+        self.max_possible_oracle_score = 200
+
+    def __call__(self, smiles_list):
+        oracle_scores = []
+        for smiles in smiles_list:
+            if smiles not in self.mol_buffer:
+                time.sleep(self.seconds_per_molecule)
+                oracle_score = rdMolDescriptors.CalcTPSA(Chem.MolFromSmiles(smiles))
+                self.mol_buffer[smiles] = [oracle_score, len(self.mol_buffer) + 1]
+            oracle_scores.append(self.mol_buffer[smiles][0])
+        return oracle_scores
+
+    def __len__(self):
+        return len(self.mol_buffer)
+
+    @property
+    def budget(self):
+        return self.max_oracle_calls
+
+    @property
+    def finish(self):
+        return len(self.mol_buffer) >= self.max_oracle_calls
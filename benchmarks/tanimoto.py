@@ -0,0 +1,79 @@
+"""
+    Novelty (max similarity of generated molecules to a stock library) and internal
+    diversity (mean similarity within the generated molecules) with the dense torch
+    implementation of average_agg_tanimoto against the tiled kernels on packed
+    fingerprints. The stock is also read from a memory-mapped .npy file.
+
+    python -m benchmarks.tanimoto --num_stock 200000 --num_generated 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from chemlactica.mol_opt.fingerprints import pack_bit_vectors, tanimoto_aggregate
+from chemlactica.mol_opt.metrics import _agg_tanimoto_dense
+
+
+def random_bit_vectors(num_vectors, num_bits, rng, chunk_size=10000):
+    # about 45 of 2048 bits set, like radius 2 Morgan fingerprints of drug-like molecules
+    vectors = np.empty((num_vectors, num_bits), dtype=np.uint8)
+    for start in range(0, num_vectors, chunk_size):
+        chunk = vectors[start:start + chunk_size]
+        chunk[:] = rng.random(chunk.shape) < 45 / num_bits
+    return vectors
+
+
+def timed(function):
+    start_time = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start_time
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_stock", type=int, default=200000)
+    parser.add_argument("--num_generated", type=int, default=2000)
+    parser.add_argument("--num_bits", type=int, default=2048)
+    parser.add_argument("--tile_size", type=int, default=1024)
+    parser.add_argument("--num_threads", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    rng = np.random.default_rng(0)
+    stock = random_bit_vectors(args.num_stock, args.num_bits, rng)
+    generated = random_bit_vectors(args.num_generated, args.num_bits, rng)
+    packed_stock, packed_generated = pack_bit_vectors(stock), pack_bit_vectors(generated)
+    print(
+        f"stock: {stock.nbytes / 2 ** 20:.0f} MiB as uint8 bits, "
+        f"{packed_stock.nbytes / 2 ** 20:.0f} MiB packed"
+    )
+
+    for name, dense_args, kernel_args in [
+        ("novelty", (stock, generated, "max"), (packed_generated, packed_stock, "max")),
+        ("diversity", (generated, generated, "mean"), (packed_generated, packed_generated, "mean")),
+    ]:
+        dense, dense_time = timed(lambda: _agg_tanimoto_dense(
+            dense_args[0], dense_args[1], 5000, dense_args[2], "cpu", 1
+        ))
+        tiled, tiled_time = timed(lambda: tanimoto_aggregate(
+            kernel_args[0], kernel_args[1], agg=kernel_args[2],
+            tile_size=args.tile_size, num_threads=args.num_threads
+        ))
+        print(
+            f"{name:>9}: dense torch {dense_time:.2f} s, packed tiles {tiled_time:.2f} s "
+            f"({dense_time / tiled_time:.2f}x), max abs difference "
+            f"{np.abs(dense - tiled).max():.1e}"
+        )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stock.npy")
+        np.save(path, packed_stock)
+        mapped_stock = np.load(path, mmap_mode="r")
+        _, mapped_time = timed(lambda: tanimoto_aggregate(
+            packed_generated, mapped_stock, tile_size=args.tile_size, num_threads=args.num_threads
+        ))
+        del mapped_stock
+    print(f"  novelty: memory-mapped packed stock {mapped_time:.2f} s")
@@ -0,0 +1,71 @@
+"""
+    Cost of top_auc on saved oracle buffers, the former implementation (a full sort of the
+    prefix at every freq_log step) against top_auc_scores, and the per-call cost of the
+    streaming TopAUC.
+
+    python -m benchmarks.top_auc --buffer_sizes 1000 10000 50000 1000000
+"""
+import argparse
+import time
+import numpy as np
+from chemlactica.mol_opt.metrics import TopAUC, top_auc
+
+
+def legacy_top_auc(buffer, top_n, finish, freq_log, max_oracle_calls):
+    sum = 0
+    prev = 0
+    called = 0
+    ordered_results = list(sorted(buffer.items(), key=lambda kv: kv[1][1], reverse=False))
+    for idx in range(freq_log, min(len(buffer), max_oracle_calls), freq_log):
+        temp_result = ordered_results[:idx]
+        temp_result = list(sorted(temp_result, key=lambda kv: kv[1][0], reverse=True))[:top_n]
+        top_n_now = np.mean([item[1][0] for item in temp_result])
+        sum += freq_log * (top_n_now + prev) / 2
+        prev = top_n_now
+        called = idx
+    temp_result = list(sorted(ordered_results, key=lambda kv: kv[1][0], reverse=True))[:top_n]
+    top_n_now = np.mean([item[1][0] for item in temp_result])
+    sum += (len(buffer) - called) * (top_n_now + prev) / 2
+    if finish and len(buffer) < max_oracle_calls:
+        sum += (max_oracle_calls - len(buffer)) * top_n_now
+    return sum / max_oracle_calls
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--buffer_sizes", type=int, nargs="+", default=[1000, 10000, 50000, 1000000]
+    )
+    parser.add_argument("--top_n", type=int, default=10)
+    parser.add_argument("--freq_log", type=int, default=100)
+    parser.add_argument("--max_legacy_size", type=int, default=50000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    rng = np.random.default_rng(0)
+    for buffer_size in args.buffer_sizes:
+        scores = rng.random(buffer_size)
+        buffer = {f"mol{i}": [score, i + 1] for i, score in enumerate(scores.tolist())}
+        start_time = time.perf_counter()
+        auc = top_auc(buffer, args.top_n, True, args.freq_log, buffer_size)
+        batch_time = time.perf_counter() - start_time
+
+        stream = TopAUC(args.top_n, args.freq_log, buffer_size)
+        start_time = time.perf_counter()
+        for score, call_index in buffer.values():
+            stream.add(score, call_index)
+        stream_time = time.perf_counter() - start_time
+        assert np.isclose(stream.value(True), auc)
+
+        legacy = "skipped"
+        if buffer_size <= args.max_legacy_size:
+            start_time = time.perf_counter()
+            legacy_auc = legacy_top_auc(buffer, args.top_n, True, args.freq_log, buffer_size)
+            assert np.isclose(legacy_auc, auc)
+            legacy = f"{time.perf_counter() - start_time:.3f} s"
+        print(
+            f"{buffer_size:>8} calls: legacy {legacy}, top_auc {batch_time:.3f} s, "
+            f"streaming {1e6 * stream_time / buffer_size:.2f} us/call"
+        )
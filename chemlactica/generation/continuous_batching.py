@@ -0,0 +1,295 @@
+import inspect
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+import torch
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+def list_prompt_source(prompts: List[List[int]]):
+    """
+        Prompt source serving a fixed list of tokenized prompts,
+        the request of a prompt is its index.
+    """
+    next_index = 0
+
+    def next_prompts(num_prompts):
+        nonlocal next_index
+        requests = [
+            (i, prompts[i])
+            for i in range(next_index, min(next_index + num_prompts, len(prompts)))
+        ]
+        next_index += len(requests)
+        return requests
+    return next_prompts
+
+
+class ContinuousBatchingEngine:
+    """
+        Decodes a stream of prompts with a fixed number of slots. A row is retired as soon
+        as it samples an eos token (e.g. [END_SMILES]) or reaches max_new_tokens, and its slot
+        is refilled with a new prompt before the next decoding step, so the batch does not
+        wait for its slowest sequence.
+
+        Keys and values are kept in buffers preallocated per slot, all the active rows end at
+        the same buffer position and start wherever their prompt was placed (the positions in
+        front of a row are masked out). New prompts are prefilled as a separate batch and
+        copied into the free slots. The model still receives the cache as legacy
+        (key, value) tuples, so its attention concatenates the new keys to a view of the buffer.
+    """
+
+    def __init__(
+            self, model, pad_token_id: int,
+            num_slots: int, max_prompt_length: int, max_new_tokens: int
+    ):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.num_slots = num_slots
+        self.max_prompt_length = max_prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.capacity = max_prompt_length + max_new_tokens
+        self.device = model.device
+        self.accepts_position_ids = "position_ids" in inspect.signature(model.forward).parameters
+
+        self.key_buffers = None
+        self.value_buffers = None
+        self.tokens = torch.full(
+            (num_slots, self.capacity), pad_token_id, dtype=torch.long, device=self.device
+        )
+        self.mask = torch.zeros((num_slots, self.capacity), dtype=torch.long, device=self.device)
+        self.num_steps = 0
+        self.num_row_steps = 0
+        self.reset()
+
+    def reset(self):
+        self.cur_len = 0
+        self.row_start = [0] * self.num_slots
+        self.requests = [None] * self.num_slots
+        self.generated: List[List[int]] = [[] for _ in range(self.num_slots)]
+        self.next_tokens = torch.full((self.num_slots,), self.pad_token_id, dtype=torch.long)
+        self.tokens.fill_(self.pad_token_id)
+        self.mask.zero_()
+
+    def _allocate_buffers(self, past_key_values):
+        self.key_buffers, self.value_buffers = [], []
+        for key, value in past_key_values:
+            self.key_buffers.append(key.new_zeros(
+                (self.num_slots, key.shape[1], self.capacity, key.shape[3])
+            ))
+            self.value_buffers.append(value.new_zeros(
+                (self.num_slots, value.shape[1], self.capacity, value.shape[3])
+            ))
+
+    def _active_slots(self):
+        return [slot for slot in range(self.num_slots) if self.requests[slot] is not None]
+
+    def _move_window(self, new_end: int):
+        """
+            Moves the positions used by the active rows so that they end at `new_end`.
+        """
+        active_slots = self._active_slots()
+        window_start = min([self.row_start[slot] for slot in active_slots], default=self.cur_len)
+        length = self.cur_len - window_start
+        source = slice(window_start, self.cur_len)
+        target = slice(new_end - length, new_end)
+        for buffers in [self.key_buffers or [], self.value_buffers or []]:
+            for buffer in buffers:
+                buffer[:, :, target] = buffer[:, :, source].clone()
+        self.tokens[:, target] = self.tokens[:, source].clone()
+        self.mask[:, target] = self.mask[:, source].clone()
+        self.tokens[:, :new_end - length] = self.pad_token_id
+        self.mask[:, :new_end - length] = 0
+        self.tokens[:, new_end:] = self.pad_token_id
+        self.mask[:, new_end:] = 0
+        for slot in active_slots:
+            self.row_start[slot] += new_end - self.cur_len
+        self.cur_len = new_end
+
+    def _position_ids(self, attention_mask, num_new_tokens):
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+        return position_ids[:, -num_new_tokens:]
+
+    def _logits_processors(self, generation_config, logits_processor):
+        processors = LogitsProcessorList()
+        repetition_penalty = generation_config.get("repetition_penalty", 1.0)
+        if repetition_penalty is not None and repetition_penalty != 1.0:
+            processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if logits_processor is not None:
+            processors.extend(logits_processor)
+        if generation_config.get("do_sample", False):
+            defaults = self.model.generation_config
+            temperature = generation_config.get("temperature", defaults.temperature)
+            top_k = generation_config.get("top_k", defaults.top_k)
+            top_p = generation_config.get("top_p", defaults.top_p)
+            if temperature is not None and temperature != 1.0:
+                processors.append(TemperatureLogitsWarper(temperature))
+            if top_k is not None and top_k != 0:
+                processors.append(TopKLogitsWarper(top_k))
+            if top_p is not None and top_p < 1.0:
+                processors.append(TopPLogitsWarper(top_p))
+        return processors
+
+    def _sample(self, input_ids, logits, generation_config, logits_processor):
+        scores = self._logits_processors(generation_config, logits_processor)(
+            input_ids, logits.float()
+        )
+        if generation_config.get("do_sample", False):
+            probs = torch.softmax(scores, dim=-1)
+            return torch.multinomial(probs, num_samples=1).squeeze(1)
+        return scores.argmax(dim=-1)
+
+    def _finish_or_keep(self, slot, token, eos_token_ids):
+        self.generated[slot].append(token)
+        if token in eos_token_ids or len(self.generated[slot]) >= self.max_new_tokens:
+            result = (self.requests[slot], self.generated[slot])
+            self.requests[slot] = None
+            self.generated[slot] = []
+            self.tokens[slot] = self.pad_token_id
+            self.mask[slot] = 0
+            return result
+        self.next_tokens[slot] = token
+        return None
+
+    def _prefill(self, slots, requests, generation_config, logits_processor, eos_token_ids):
+        prompts = [prompt_ids[-self.max_prompt_length:] for _, prompt_ids in requests]
+        prompt_length = max(len(prompt_ids) for prompt_ids in prompts)
+        input_ids = torch.full((len(prompts), prompt_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(prompts), prompt_length), dtype=torch.long)
+        for i, prompt_ids in enumerate(prompts):
+            input_ids[i, prompt_length - len(prompt_ids):] = torch.tensor(prompt_ids)
+            attention_mask[i, prompt_length - len(prompt_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        model_inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "use_cache": True}
+        if self.accepts_position_ids:
+            model_inputs["position_ids"] = self._position_ids(attention_mask, prompt_length)
+        outputs = self.model(**model_inputs)
+        if self.key_buffers is None:
+            self._allocate_buffers(outputs.past_key_values)
+        first_tokens = self._sample(
+            input_ids, outputs.logits[:, -1], generation_config, logits_processor
+        ).tolist()
+
+        if not self._active_slots():
+            self.cur_len = 0
+        if self.cur_len < prompt_length:
+            self._move_window(prompt_length)
+        positions = slice(self.cur_len - prompt_length, self.cur_len)
+        slot_index = torch.tensor(slots, device=self.device)
+        for layer, (key, value) in enumerate(outputs.past_key_values):
+            self.key_buffers[layer][slot_index, :, positions] = key
+            self.value_buffers[layer][slot_index, :, positions] = value
+        self.tokens[slot_index, positions] = input_ids
+        self.mask[slot_index, positions] = attention_mask
+
+        finished = []
+        for i, slot in enumerate(slots):
+            self.requests[slot] = requests[i][0]
+            self.row_start[slot] = self.cur_len - len(prompts[i])
+            result = self._finish_or_keep(slot, first_tokens[i], eos_token_ids)
+            if result is not None:
+                finished.append(result)
+        return finished
+
+    def _decode_step(self, generation_config, logits_processor, eos_token_ids):
+        if self.cur_len + 1 > self.capacity:
+            self._move_window(self.cur_len - min(
+                self.row_start[slot] for slot in self._active_slots()
+            ))
+        active_slots = self._active_slots()
+        window_start = min(self.row_start[slot] for slot in active_slots)
+        if len(active_slots) == self.num_slots:
+            rows = slice(None)
+        else:
+            rows = torch.tensor(active_slots, device=self.device)
+        window = slice(window_start, self.cur_len)
+
+        next_tokens = self.next_tokens[active_slots].to(self.device)
+        self.tokens[rows, self.cur_len] = next_tokens
+        self.mask[rows, self.cur_len] = 1
+        attention_mask = self.mask[rows, window_start:self.cur_len + 1]
+        past_key_values = tuple(
+            (key_buffer[rows, :, window], value_buffer[rows, :, window])
+            for key_buffer, value_buffer in zip(self.key_buffers, self.value_buffers)
+        )
+        model_inputs = {
+            "input_ids": next_tokens[:, None], "attention_mask": attention_mask,
+            "past_key_values": past_key_values, "use_cache": True
+        }
+        if self.accepts_position_ids:
+            model_inputs["position_ids"] = self._position_ids(attention_mask, 1)
+        outputs = self.model(**model_inputs)
+        for layer, (key, value) in enumerate(outputs.past_key_values):
+            self.key_buffers[layer][rows, :, self.cur_len] = key[:, :, -1]
+            self.value_buffers[layer][rows, :, self.cur_len] = value[:, :, -1]
+        self.cur_len += 1
+        self.num_steps += 1
+        self.num_row_steps += len(active_slots)
+
+        sampled_tokens = self._sample(
+            self.tokens[rows, window_start:self.cur_len], outputs.logits[:, -1],
+            generation_config, logits_processor
+        ).tolist()
+        finished = []
+        for slot, token in zip(active_slots, sampled_tokens):
+            result = self._finish_or_keep(slot, token, eos_token_ids)
+            if result is not None:
+                finished.append(result)
+        return finished
+
+    @torch.no_grad()
+    def generate(
+            self, next_prompts: Callable[[int], List[Tuple[Any, List[int]]]],
+            generation_config: Dict, logits_processor=None
+    ) -> Iterator[Tuple[Any, List[int]]]:
+        """
+            Yields (request, generated token ids) in the order the rows finish.
+            `next_prompts(n)` returns up to n new (request, prompt token ids) pairs and is called
+            whenever slots are free, an empty list means there are no more prompts.
+            `generation_config` is read at every step, so e.g. a changed temperature applies
+            to the rows that are being decoded. Stopping the iteration drops the unfinished rows.
+        """
+        eos_token_ids = generation_config.get(
+            "eos_token_id", self.model.generation_config.eos_token_id
+        )
+        if isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        eos_token_ids = set(eos_token_ids or [])
+        self.reset()
+        self.num_steps = 0
+        self.num_row_steps = 0
+        prompts_exhausted = False
+        try:
+            while True:
+                free_slots = [slot for slot in range(self.num_slots) if self.requests[slot] is None]
+                while free_slots and not prompts_exhausted:
+                    requests = next_prompts(len(free_slots))
+                    if not requests:
+                        prompts_exhausted = True
+                        break
+                    slots = free_slots[:len(requests)]
+                    yield from self._prefill(
+                        slots, requests, generation_config, logits_processor, eos_token_ids
+                    )
+                    free_slots = [
+                        slot for slot in range(self.num_slots) if self.requests[slot] is None
+                    ]
+                if not self._active_slots():
+                    break
+                yield from self._decode_step(generation_config, logits_processor, eos_token_ids)
+        finally:
+            self.reset()
+
+    def stats(self):
+        return {
+            "steps": self.num_steps,
+            "slot_occupancy": (
+                self.num_row_steps / (self.num_steps * self.num_slots) if self.num_steps else 0.0
+            ),
+        }
@@ -1,15 +1,16 @@
 from argparse import ArgumentParser
 from typing import List
-import torch
 
-from model_utils import load_model
-from utils import get_tokenizer
+from chemlactica.config.default_train_config import ModelConfig
+from chemlactica.utils.utils import get_tokenizer
+from chemlactica.generation.continuous_batching import ContinuousBatchingEngine, list_prompt_source
 
 
-def generate(prompts: List[str], model, **gen_kwargs):
-    if type(prompts) == str:
+def generate(prompts: List[str], model, tokenizer=None, **gen_kwargs):
+    if isinstance(prompts, str):
         prompts = [prompts]
-    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        tokenizer = get_tokenizer(ModelConfig().tokenizer_path)
 
     generation_dict = {}
     for prompt in prompts:
@@ -21,11 +22,32 @@ def generate(prompts: List[str], model, **gen_kwargs):
         if not generation_dict.get(prompt):
             generation_dict[prompt] = []
         for out in outputs:
-            generation_dict[prompt].append(tokenizer.decode(out[len(data):]))
+            generation_dict[prompt].append(tokenizer.decode(out[data.input_ids.shape[1]:]))
     return generation_dict
 
 
-if __name__ == "__main__":
+def generate_continuous(prompts: List[str], model, tokenizer, num_slots: int = 32, **gen_kwargs):
+    """
+        Same output as generate, with every prompt decoded once by a ContinuousBatchingEngine.
+    """
+    if isinstance(prompts, str):
+        prompts = [prompts]
+    prompts_ids = tokenizer(prompts)["input_ids"]
+    max_new_tokens = gen_kwargs.get("max_new_tokens", model.generation_config.max_length)
+    engine = ContinuousBatchingEngine(
+        model, tokenizer.pad_token_id, num_slots=num_slots,
+        max_prompt_length=max(len(prompt_ids) for prompt_ids in prompts_ids),
+        max_new_tokens=max_new_tokens
+    )
+    generation_dict = {}
+    for i, generated in engine.generate(list_prompt_source(prompts_ids), gen_kwargs):
+        if not generation_dict.get(prompts[i]):
+            generation_dict[prompts[i]] = []
+        generation_dict[prompts[i]].append(tokenizer.decode(generated))
+    return generation_dict
+
+
+def parse_arguments(argv=None):
     parser = ArgumentParser()
 
     parser.add_argument(
@@ -110,11 +132,48 @@ if __name__ == "__main__":
         default=None,
     )
 
-    args = parser.parse_args()
-    args = {key: value for key, value in args.__dict__.items() if value != None}
-    
-    # generate(
-    #     args.pop("prompts"), args.pop("checkpoint_path"),
-    #     args.pop("use_flash_attn"), device=args.pop("device"),
-    #     **args
-    # )
\ No newline at end of file
+    parser.add_argument(
+        "--cpu_int8",
+        action="store_true",
+        help="int8 dynamic quantization of the linear layers for generation on CPU",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        required=False,
+        default=None,
+        help="CPU threads of the int8 model, all the available CPUs by default",
+    )
+
+    parser.add_argument(
+        "--tokenizer_path",
+        type=str,
+        required=False,
+        default=ModelConfig().tokenizer_path,
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    args = {key: value for key, value in args.__dict__.items() if value is not None}
+
+    # model_utils needs bitsandbytes, which only loading a model requires
+    from chemlactica.utils.model_utils import load_model
+
+    cpu_int8 = args.pop("cpu_int8")
+    model = load_model(
+        args.pop("checkpoint_path"), use_flash_attn=args.pop("use_flash_attn"),
+        cpu_int8=cpu_int8, num_threads=args.pop("num_threads", None)
+    )
+    device = args.pop("device")
+    if not cpu_int8:
+        model = model.to(device)
+    tokenizer = get_tokenizer(args.pop("tokenizer_path"))
+    generation_dict = generate(args.pop("prompts"), model, tokenizer, **args)
+    print(generation_dict)
+    return generation_dict
+
+
+if __name__ == "__main__":
+    main()
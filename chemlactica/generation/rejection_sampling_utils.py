@@ -20,24 +20,23 @@ import numpy as np
 import pandas as pd
 import torch
 from rdkit import DataStructs, Chem
-from rdkit.Chem import AllChem
 from rdkit.Chem.QED import qed
-from rdkit.Chem import MACCSkeys
+from chemlactica.mol_opt.featurization import featurize
 
 from rdkit import RDLogger
 RDLogger.DisableLog('rdApp.*')
 
 
 def get_inchi(smiles: str):
-    return Chem.MolToInchi(Chem.MolFromSmiles(smiles))
+    return Chem.MolToInchi(featurize(smiles).mol)
 
 
 def get_morgan_fingerprint(smiles: str):
-    return AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smiles), 2, nBits=2048)
+    return featurize(smiles).morgan_fingerprint
 
 
 def get_maccs_fingerprint(smiles: str):
-    return MACCSkeys.GenMACCSKeys(Chem.MolFromSmiles(smiles))
+    return featurize(smiles).maccs_fingerprint
 
 
 class FingerprintType(Enum):
@@ -45,15 +44,15 @@ class FingerprintType(Enum):
     MACCS=2
 
 
-def tanimoto_dist_func(smiles1: str, smiles2: str, fingerprint: FingerprintType=FingerprintType.Morgan):
+def tanimoto_dist_func(smiles1: str, smiles2: str, fingerprint: FingerprintType=FingerprintType.MORGAN):
     return DataStructs.TanimotoSimilarity(
-        get_morgan_fingerprint(smiles1) if fingerprint == FingerprintType.Morgan else get_maccs_fingerprint(smiles1),
-        get_morgan_fingerprint(smiles2) if fingerprint == fingerprint == FingerprintType.Morgan else get_maccs_fingerprint(smiles2),
+        get_morgan_fingerprint(smiles1) if fingerprint == FingerprintType.MORGAN else get_maccs_fingerprint(smiles1),
+        get_morgan_fingerprint(smiles2) if fingerprint == FingerprintType.MORGAN else get_maccs_fingerprint(smiles2),
     )
 
 
 def compute_qed(smiles: str):
-    return qed(Chem.MolFromSmiles(smiles))
+    return qed(featurize(smiles).mol)
 
 
 def find(string: str, start: str, end: str="\n"):
@@ -114,7 +113,7 @@ def generate_dataset(
 
     tokenizer = get_tokenizer()
     
-    lead_molecule = Chem.MolToSmiles(Chem.MolFromSmiles(lead_molecule), canonical=True)
+    lead_molecule = featurize(lead_molecule).smiles
     lead_molecule = Chem.MolToSmiles(Chem.MolFromSmiles(lead_molecule), kekuleSmiles=True)
     print("some molecule", lead_molecule)
 
@@ -146,7 +145,6 @@ def generate_dataset(
                 for out in outputs:
                     smiles = find(out, "[START_SMILES]", "[END_SMILES]")
                     try:
-                        mol = Chem.MolFromSmiles(smiles)
                         gen_molecule_entry = MoleculeEntry(
                             smiles=smiles,
                             qed=compute_qed(smiles),
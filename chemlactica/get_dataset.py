@@ -4,7 +4,7 @@ from datasets import load_dataset, interleave_datasets
 from datasets.iterable_dataset import IterableDataset
 
 from chemlactica.utils.dataset_utils import process_dataset, DIR_DATA_TYPES
-from chemlactica.jsonl_dataset import samples_generator
+from chemlactica.jsonl_dataset import jsonl_files, samples_generator
 
 
 def get_dataset(
@@ -31,7 +31,7 @@ def get_dataset(
                     f"""Unknown data type {dir_data_type},
                     the following data types are supported: {DIR_DATA_TYPES}"""
                 )
-            training_data_files = glob.glob(training_data_dir + "/*.jsonl")
+            training_data_files = jsonl_files(training_data_dir)
             ds_name = f"{dir_data_type}_{i}"
             is_assay_split = "assay" in dir_data_type
             dataset = IterableDataset.from_generator(
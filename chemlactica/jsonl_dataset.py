@@ -1,11 +1,119 @@
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import glob
 import os
+from multiprocessing import shared_memory
 from accelerate.state import PartialState
 
 distributed_state = PartialState()
 
 
+def jsonl_files(directory: str) -> List[str]:
+    return glob.glob(directory + "/*.jsonl")
+
+
+class JsonlPositions:
+    """
+        The states ({"position", "line_number"}) of the jsonl files read by samples_generator
+        in a shared memory block, with the interface of the Manager dict it replaces: the
+        readers in the dataloader workers write the state of every line with a store to the
+        block instead of a round trip to the manager, JsonlDatasetResumeCallback reads it at
+        checkpoint time. Pickling passes the name of the block, so the dataset can be sent to
+        spawned workers. The creating process owns the block and unlinks it in `close`.
+
+        Each file has a row of [version, position, line_number], the version is odd while a
+        row is written, so a reader retries instead of returning a torn state. A file
+        without a written state (version 0) is absent, like in a fresh dict. A row that
+        stays odd (a worker died while writing it) is read as the last consistent state
+        this process saw after `max_read_retries`, or raises if there is none.
+    """
+
+    max_read_retries = 10000
+
+    def __init__(self, files: List[str], name: Optional[str] = None):
+        self.files = list(files)
+        self.indices = {file: i for i, file in enumerate(self.files)}
+        self.owner = name is None
+        self.last_states: Dict[str, Optional[Dict[str, int]]] = {}
+        self.memory = shared_memory.SharedMemory(
+            name=name, create=self.owner, size=max(len(self.files), 1) * 3 * 8
+        )
+        # int64 stores through a memoryview are cheaper than numpy item assignments
+        self.values = self.memory.buf.cast("q")
+        if self.owner:
+            self.memory.buf[:] = bytes(len(self.memory.buf))
+
+    def __getstate__(self):
+        return {"files": self.files, "name": self.memory.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["files"], name=state["name"])
+
+    def write(self, file: str, position: int, line_number: int):
+        values, start = self.values, 3 * self.indices[file]
+        # even, also after a writer that died in the middle of a write
+        version = values[start] + values[start] % 2
+        values[start] = version + 1
+        values[start + 1] = position
+        values[start + 2] = line_number
+        values[start] = version + 2
+
+    def __setitem__(self, file: str, state: Dict[str, int]):
+        if file not in self.indices:
+            print(f"{file} is not read by this run, its state is dropped")
+            return
+        self.write(file, state["position"], state["line_number"])
+
+    def get(self, file: str, default=None) -> Optional[Dict[str, int]]:
+        index = self.indices.get(file)
+        if index is None:
+            return default
+        for _ in range(self.max_read_retries):
+            version, position, line_number = self.values[3 * index:3 * index + 3].tolist()
+            if version % 2 == 0 and self.values[3 * index] == version:
+                break
+        else:
+            if file not in self.last_states:
+                raise RuntimeError(f"The state of {file} was left half written")
+            print(f"The state of {file} was left half written, using the last consistent one")
+            state = self.last_states[file]
+            return default if state is None else dict(state)
+        state = None if version == 0 else {"position": position, "line_number": line_number}
+        self.last_states[file] = state
+        return default if state is None else dict(state)
+
+    def __getitem__(self, file: str) -> Dict[str, int]:
+        state = self.get(file)
+        if state is None:
+            raise KeyError(file)
+        return state
+
+    def items(self) -> Iterator[Tuple[str, Dict[str, int]]]:
+        for file in self.files:
+            state = self.get(file)
+            if state is not None:
+                yield file, state
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def __repr__(self):
+        return f"JsonlPositions({dict(self.items())})"
+
+    def close(self):
+        self.values.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+            self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def generator_init_print(shared_jsonl_files, files):
     print("sharded_jsonl_files", shared_jsonl_files)
     print(f"TOK_PAR: {os.environ['TOKENIZERS_PARALLELISM']}")
@@ -35,29 +143,60 @@ def format_sample(line):
 
 
 def samples_generator(
-    files: List[str], shared_jsonl_files, chunk_size=25000, return_line_info=False
+    files: List[str],
+    shared_jsonl_files,
+    chunk_size=25000,
+    return_line_info=False,
+    publish_every=1000,
 ):
+    """
+        Yields the lines of `files` of the current rank and records the state of each file
+        up to the last line passed to the consumer. The files are read in binary mode and the
+        positions are counted locally. With a JsonlPositions the state of every line is
+        stored in shared memory. Any other mapping (a Manager dict) is updated every
+        `publish_every` lines and at the end of a file, so a resume from such a mapping can
+        repeat up to `publish_every` lines per file.
+    """
     file_states = setup_generator(shared_jsonl_files, files)
+    num_processes = distributed_state.num_processes
+    process_index = distributed_state.process_index
+    if isinstance(shared_jsonl_files, JsonlPositions):
+        publish_every = 1
+
+        def publish(file, state):
+            shared_jsonl_files.write(file, state["position"], state["line_number"])
+    else:
+
+        def publish(file, state):
+            shared_jsonl_files[file] = dict(state)
 
     # TODO: there should be a more elegant way to do this without per line conditions
     returned = True
     while returned:
         returned = False
         for file, state in file_states.items():
-            with open(file) as f:
+            with open(file, "rb") as f:
                 f.seek(state["position"])
-                line = f.readline()
-                counter = 0
-                while line:
-                    state["position"] = f.tell()
-                    if should_yield_on_current_rank(
-                        counter,
-                        distributed_state.num_processes,
-                        distributed_state.process_index,
-                    ):
-                        returned = True
-                        ret = format_sample(line)
-                        yield ret
-                    counter = counter + 1
-                    shared_jsonl_files[file] = state
-                    line = f.readline()
+                unpublished = 0
+                try:
+                    for counter, line in enumerate(f):
+                        state["position"] += len(line)
+                        state["line_number"] += 1
+                        unpublished += 1
+                        if unpublished == publish_every:
+                            publish(file, state)
+                            unpublished = 0
+                        if should_yield_on_current_rank(
+                            counter, num_processes, process_index
+                        ):
+                            returned = True
+                            ret = format_sample(line.decode("utf-8"))
+                            if return_line_info:
+                                ret["line_info"] = {
+                                    "file": file,
+                                    "line_number": state["line_number"],
+                                }
+                            yield ret
+                finally:
+                    if unpublished:
+                        publish(file, state)
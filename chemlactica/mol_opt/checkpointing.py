@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import numpy as np
+import torch
+
+
+STATE_FILE_NAME = "state.pt"
+
+
+def get_rng_state():
+    rng_state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state["python"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if "cuda" in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["cuda"])
+
+
+def cpu_copy(state):
+    """
+        Copies the tensors of a (nested) state dict to the cpu, so the copy can be written
+        in the background while the originals are updated.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: cpu_copy(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpu_copy(value) for value in state)
+    return state
+
+
+def atomic_save(obj, path):
+    """
+        Writes to a temporary file in the same directory and renames it over `path`,
+        so a job killed while writing leaves the previous file intact.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        torch.save(obj, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+class OptimizationCheckpointer:
+    """
+        Writes snapshots of an optimization run to `checkpoint_dir` in a background thread.
+        The state of the run goes to state.pt, the model/optimizer/lr_scheduler state dicts go
+        to a weights-<version>.pt file which is only written when the version changes
+        (i.e. after fine-tuning) and is referenced from state.pt. Files are replaced atomically,
+        so the directory always holds the last complete snapshot.
+    """
+
+    def __init__(self, checkpoint_dir: str):
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.weights_version = None
+        self.weights_file_name = None
+
+    def needs_weights(self, weights_version) -> bool:
+        return weights_version != self.weights_version
+
+    def save(self, state, weights=None, weights_version=None):
+        """
+            `state` and `weights` are written as they are, the caller passes copies which are
+            not modified afterwards (see cpu_copy). `weights` is None when the weights did not
+            change since the last snapshot.
+        """
+        self.wait()
+        if weights is not None:
+            self.weights_version = weights_version
+        self.pending = self.executor.submit(self._write, state, weights, weights_version)
+
+    def _write(self, state, weights, weights_version):
+        previous_weights_file_name = self.weights_file_name
+        if weights is not None:
+            self.weights_file_name = f"weights-{weights_version}.pt"
+            atomic_save(weights, os.path.join(self.checkpoint_dir, self.weights_file_name))
+        state["weights_file_name"] = self.weights_file_name
+        atomic_save(state, os.path.join(self.checkpoint_dir, STATE_FILE_NAME))
+        if previous_weights_file_name not in [None, self.weights_file_name]:
+            os.remove(os.path.join(self.checkpoint_dir, previous_weights_file_name))
+
+    def wait(self):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown(wait=True)
+
+
+def load_checkpoint(checkpoint_dir: str):
+    """
+        Returns the state and the weights (None if the run was not fine-tuned yet)
+        of the last snapshot written by OptimizationCheckpointer.
+    """
+    state = torch.load(
+        os.path.join(checkpoint_dir, STATE_FILE_NAME), map_location="cpu", weights_only=False
+    )
+    weights = None
+    if state["weights_file_name"] is not None:
+        weights = torch.load(
+            os.path.join(checkpoint_dir, state["weights_file_name"]),
+            map_location="cpu", weights_only=False
+        )
+    return state, weights
@@ -1,13 +1,17 @@
 from typing import List
 import yaml
 import argparse
+import copy
 import os
 from transformers import AutoModelForCausalLM, AutoTokenizer
 import torch
 import numpy as np
 from rdkit.Chem import rdMolDescriptors
 from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.multi_run import optimize_runs
 from chemlactica.mol_opt.utils import set_seed, MoleculeEntry
+from chemlactica.mol_opt.metrics import TopAUC
+from chemlactica.utils.cpu_inference import quantize_int8
 
 
 class TPSA_Weight_Oracle:
@@ -24,6 +28,9 @@ class TPSA_Weight_Oracle:
         # the maximum possible oracle score or an upper bound
         self.max_possible_oracle_score = 800
 
+        # area under the top-10 curve, updated as the molecules are scored
+        self.auc_top10 = TopAUC(10, self.freq_log, max_oracle_calls)
+
         # if True the __call__ function takes list of MoleculeEntry objects
         # if False (or unspecified) the __call__ function takes list of SMILES strings
         self.takes_entry = True
@@ -51,12 +58,18 @@ class TPSA_Weight_Oracle:
                     print(e)
                     oracle_score = 0
                 self.mol_buffer[molecule.smiles] = [oracle_score, len(self.mol_buffer) + 1]
+                self.auc_top10.add(*self.mol_buffer[molecule.smiles])
                 if len(self.mol_buffer) % 100 == 0:
                     self.log_intermediate()
                 oracle_scores.append(oracle_score)
         return oracle_scores
     
     def log_intermediate(self):
+        if self.auc_top10.num_calls != len(self.mol_buffer):
+            # molecules restored from a checkpoint did not go through __call__
+            self.auc_top10 = TopAUC(10, self.freq_log, self.max_oracle_calls)
+            for oracle_score, call_index in self.mol_buffer.values():
+                self.auc_top10.add(oracle_score, call_index)
         scores = [v[0] for v in self.mol_buffer.values()][-self.max_oracle_calls:]
         scores_sorted = sorted(scores, reverse=True)[:100]
         n_calls = len(self.mol_buffer)
@@ -68,7 +81,8 @@ class TPSA_Weight_Oracle:
         print(f"{n_calls}/{self.max_oracle_calls} | ",
                 f'avg_top1: {score_avg_top1:.3f} | '
                 f'avg_top10: {score_avg_top10:.3f} | '
-                f'avg_top100: {score_avg_top100:.3f}')
+                f'avg_top100: {score_avg_top100:.3f} | '
+                f'auc_top10: {self.auc_top10.value(self.finish):.3f}')
 
     def __len__(self):
         return len(self.mol_buffer)
@@ -88,24 +102,62 @@ def parse_arguments():
     parser.add_argument("--output_dir", type=str, required=True)
     parser.add_argument("--config_default", type=str, required=True)
     parser.add_argument("--n_runs", type=int, required=False, default=1)
+    parser.add_argument("--batched_runs", action="store_true")
+    # snapshots in output_dir/checkpoint_{seed}, with --resume a rerun continues from them
+    parser.add_argument("--checkpoint", action="store_true")
+    parser.add_argument("--resume", action="store_true")
     args = parser.parse_args()
     return args
 
 
+def create_run(config, output_dir, seed, checkpoint=False, resume=False):
+    config = copy.deepcopy(config)
+    oracle = TPSA_Weight_Oracle(max_oracle_calls=1000)
+    config["log_dir"] = os.path.join(
+        output_dir, f"results_chemlactica_tpsa+weight+num_rungs_{seed}.log"
+    )
+    config["max_possible_oracle_score"] = oracle.max_possible_oracle_score
+    if checkpoint or resume:
+        config["checkpoint_dir"] = os.path.join(output_dir, f"checkpoint_{seed}")
+    if resume:
+        # a preempted job picks the run up from its last snapshot
+        if os.path.exists(os.path.join(config["checkpoint_dir"], "state.pt")):
+            config["resume_from"] = config["checkpoint_dir"]
+            print(f"Seed {seed}: resuming from {config['resume_from']}")
+        else:
+            print(f"Seed {seed}: no snapshot in {config['checkpoint_dir']}, starting from scratch")
+    return {"oracle": oracle, "config": config, "seed": seed}
+
+
 if __name__ == "__main__":
     args = parse_arguments()
     config = yaml.safe_load(open(args.config_default))
 
-    model = AutoModelForCausalLM.from_pretrained(config["checkpoint_path"], torch_dtype=torch.bfloat16).to(config["device"])
+    if config.get("cpu_int8", False):
+        model = quantize_int8(
+            AutoModelForCausalLM.from_pretrained(
+                config["checkpoint_path"], torch_dtype=torch.float32
+            ),
+            num_threads=config.get("cpu_threads")
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            config["checkpoint_path"], torch_dtype=torch.bfloat16
+        ).to(config["device"])
     tokenizer = AutoTokenizer.from_pretrained(config["tokenizer_path"], padding_side="left")
 
     seeds = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31]
-    for i in range(args.n_runs):
-        set_seed(seeds[i])
-        oracle = TPSA_Weight_Oracle(max_oracle_calls=1000)
-        config["log_dir"] = os.path.join(args.output_dir, f"results_chemlactica_tpsa+weight+num_rungs_{seeds[i]}.log")
-        config["max_possible_oracle_score"] = oracle.max_possible_oracle_score
-        optimize(
-            model, tokenizer,
-            oracle, config
-        )
\ No newline at end of file
+    runs = [
+        create_run(config, args.output_dir, seed, checkpoint=args.checkpoint, resume=args.resume)
+        for seed in seeds[:args.n_runs]
+    ]
+    if args.batched_runs:
+        # the seeds advance together and share the generation batches
+        optimize_runs(model, tokenizer, runs)
+    else:
+        for run in runs:
+            set_seed(run["seed"])
+            optimize(
+                model, tokenizer,
+                run["oracle"], run["config"]
+            )
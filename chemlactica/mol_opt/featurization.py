@@ -0,0 +1,143 @@
+from collections import OrderedDict
+import threading
+import numpy as np
+from rdkit import Chem, DataStructs, RDLogger
+from rdkit.Chem import AllChem, MACCSkeys
+from chemlactica.mol_opt.fingerprints import NUM_MORGAN_BITS, pack_fingerprint
+
+# Disable RDKit logs
+RDLogger.DisableLog("rdApp.*")
+
+
+def unpack_fingerprint(packed_fingerprint: np.ndarray):
+    bits = np.unpackbits(packed_fingerprint.view(np.uint8), bitorder="little")
+    return DataStructs.CreateFromBitString((bits + ord("0")).tobytes().decode())
+
+
+class MoleculeFeatures:
+    """
+        Canonical SMILES of a molecule with its RDKit molecule and fingerprints.
+        Everything except the SMILES is computed on first access, so features built from
+        a packed fingerprint (e.g. sent back by a worker process) never parse the SMILES
+        unless the molecule itself is needed.
+    """
+    __slots__ = (
+        "smiles", "_mol", "_morgan_fingerprint",
+        "_maccs_fingerprint", "_packed_fingerprint"
+    )
+
+    def __init__(self, smiles, mol=None, morgan_fingerprint=None, packed_fingerprint=None):
+        self.smiles = smiles
+        self._mol = mol
+        self._morgan_fingerprint = morgan_fingerprint
+        self._maccs_fingerprint = None
+        self._packed_fingerprint = packed_fingerprint
+
+    @property
+    def mol(self):
+        if self._mol is None:
+            self._mol = Chem.MolFromSmiles(self.smiles)
+        return self._mol
+
+    @property
+    def morgan_fingerprint(self):
+        if self._morgan_fingerprint is None:
+            if self._packed_fingerprint is not None:
+                self._morgan_fingerprint = unpack_fingerprint(self._packed_fingerprint)
+            else:
+                self._morgan_fingerprint = AllChem.GetMorganFingerprintAsBitVect(
+                    self.mol, 2, nBits=NUM_MORGAN_BITS
+                )
+        return self._morgan_fingerprint
+
+    @property
+    def maccs_fingerprint(self):
+        if self._maccs_fingerprint is None:
+            self._maccs_fingerprint = MACCSkeys.GenMACCSKeys(self.mol)
+        return self._maccs_fingerprint
+
+    @property
+    def packed_fingerprint(self):
+        if self._packed_fingerprint is None:
+            self._packed_fingerprint = pack_fingerprint(self.morgan_fingerprint)
+        return self._packed_fingerprint
+
+
+class FeaturizationCache:
+    """
+        LRU cache of MoleculeFeatures keyed by SMILES, both the SMILES a molecule was
+        requested with and its canonical form point to the same features.
+        Invalid SMILES are cached as well, so they are only parsed once.
+    """
+
+    def __init__(self, maxsize: int = 200000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _put(self, smiles, features):
+        self.entries[smiles] = features
+        self.entries.move_to_end(smiles)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def featurize(self, smiles: str) -> MoleculeFeatures:
+        with self.lock:
+            if smiles in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(smiles)
+                features = self.entries[smiles]
+                if features is None:
+                    raise ValueError(f"Invalid SMILES {smiles}")
+                return features
+            self.misses += 1
+
+        mol = Chem.MolFromSmiles(smiles)
+        if mol is None:
+            with self.lock:
+                self._put(smiles, None)
+            raise ValueError(f"Invalid SMILES {smiles}")
+        canonical_smiles = Chem.MolToSmiles(mol, canonical=True)
+        with self.lock:
+            features = self.entries.get(canonical_smiles)
+            if features is None:
+                features = MoleculeFeatures(canonical_smiles, mol=mol)
+                self._put(canonical_smiles, features)
+            self._put(smiles, features)
+        return features
+
+    def add(self, features: MoleculeFeatures, *aliases):
+        """
+            Registers features computed elsewhere, under their canonical SMILES and `aliases`.
+            Features already cached for the same canonical SMILES are kept.
+        """
+        with self.lock:
+            features = self.entries.get(features.smiles) or features
+            self._put(features.smiles, features)
+            for alias in aliases:
+                self._put(alias, features)
+        return features
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.entries),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+featurization_cache = FeaturizationCache()
+
+
+def featurize(smiles: str) -> MoleculeFeatures:
+    return featurization_cache.featurize(smiles)
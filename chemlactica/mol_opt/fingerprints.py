@@ -0,0 +1,465 @@
+from typing import Iterable, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+import warnings
+import numpy as np
+import torch
+
+
+NUM_MORGAN_BITS = 2048
+WORD_BITS = 64
+
+
+if hasattr(np, "bitwise_count"):
+    def popcount(words: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+else:
+    # numpy < 2.0 has no popcount ufunc, count set bits 16 at a time with a lookup table
+    _POPCOUNT_TABLE_16 = np.array(
+        [bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8
+    )
+
+    def popcount(words: np.ndarray) -> np.ndarray:
+        words = np.ascontiguousarray(words)
+        halfwords = words.view(np.uint16).reshape(words.shape[:-1] + (4 * words.shape[-1],))
+        return _POPCOUNT_TABLE_16[halfwords].sum(axis=-1, dtype=np.int64)
+
+
+def pack_fingerprint(fingerprint) -> np.ndarray:
+    """
+        Packs an RDKit ExplicitBitVect into a row of uint64 words.
+    """
+    bits = np.frombuffer(fingerprint.ToBitString().encode(), dtype=np.uint8) - ord("0")
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def pack_fingerprints(fingerprints: Iterable, num_bits: int = NUM_MORGAN_BITS) -> np.ndarray:
+    fingerprints = list(fingerprints)
+    packed = np.zeros((len(fingerprints), num_bits // WORD_BITS), dtype=np.uint64)
+    for i, fingerprint in enumerate(fingerprints):
+        packed[i] = pack_fingerprint(fingerprint)
+    return packed
+
+
+def bulk_tanimoto(
+        query: np.ndarray, words: np.ndarray,
+        query_count=None, counts=None
+) -> np.ndarray:
+    """
+        Tanimoto similarities between one packed fingerprint and every row of `words`.
+        Two empty fingerprints have similarity 1, as in DataStructs.TanimotoSimilarity.
+    """
+    if query_count is None:
+        query_count = popcount(query)
+    if counts is None:
+        counts = popcount(words)
+    intersection = popcount(words & query)
+    union = counts + query_count - intersection
+    similarities = np.ones(len(words), dtype=np.float64)
+    np.divide(intersection, union, out=similarities, where=union > 0)
+    return similarities
+
+
+class FingerprintMatrix:
+    """
+        Packed fingerprints stored as rows of a growable uint64 matrix.
+        Rows are addressed by slot indices which stay valid until the row is removed,
+        so callers can keep a slot per molecule and compare new molecules against
+        the stored ones without repacking anything.
+    """
+
+    def __init__(self, num_bits: int = NUM_MORGAN_BITS, capacity: int = 1024):
+        self.num_words = num_bits // WORD_BITS
+        self.num_bits = num_bits
+        self.words = np.zeros((capacity, self.num_words), dtype=np.uint64)
+        self.counts = np.zeros(capacity, dtype=np.int64)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.free_slots: List[int] = list(range(capacity - 1, -1, -1))
+        # every slot at or above this one has never been used
+        self.num_used_slots = 0
+
+    def _grow(self):
+        capacity = len(self.words)
+        self.words = np.concatenate([self.words, np.zeros_like(self.words)])
+        self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+        self.active = np.concatenate([self.active, np.zeros_like(self.active)])
+        self.free_slots.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def add(self, packed_fingerprint: np.ndarray) -> int:
+        if not self.free_slots:
+            self._grow()
+        slot = self.free_slots.pop()
+        self.words[slot] = packed_fingerprint
+        self.counts[slot] = popcount(packed_fingerprint)
+        self.active[slot] = True
+        self.num_used_slots = max(self.num_used_slots, slot + 1)
+        return slot
+
+    def remove(self, slot: int):
+        self.words[slot] = 0
+        self.counts[slot] = 0
+        self.active[slot] = False
+        self.free_slots.append(slot)
+
+    def __len__(self):
+        return len(self.words) - len(self.free_slots)
+
+    def tanimoto(self, slot: int, slots: np.ndarray) -> np.ndarray:
+        """
+            Similarities between the fingerprint stored at `slot` and the ones at `slots`.
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        return bulk_tanimoto(
+            self.words[slot], self.words[slots],
+            query_count=self.counts[slot], counts=self.counts[slots]
+        )
+
+    def tanimoto_all(self, slot: int) -> np.ndarray:
+        """
+            Similarities between the fingerprint stored at `slot` and every used slot,
+            the entries of the removed slots are set to 0.
+        """
+        num_slots = self.num_used_slots
+        similarities = bulk_tanimoto(
+            self.words[slot], self.words[:num_slots],
+            query_count=self.counts[slot], counts=self.counts[:num_slots]
+        )
+        similarities[~self.active[:num_slots]] = 0.0
+        return similarities
+
+    def tanimoto_matrix(self, query_slots, slots) -> np.ndarray:
+        query_slots = np.asarray(query_slots, dtype=np.int64)
+        slots = np.asarray(slots, dtype=np.int64)
+        words = self.words[slots]
+        counts = self.counts[slots]
+        similarities = np.empty((len(query_slots), len(slots)), dtype=np.float64)
+        for i, query_slot in enumerate(query_slots):
+            similarities[i] = bulk_tanimoto(
+                self.words[query_slot], words,
+                query_count=self.counts[query_slot], counts=counts
+            )
+        return similarities
+
+
+def pack_bit_vectors(vectors: np.ndarray, out: Optional[np.ndarray] = None,
+                     chunk_size: int = 65536) -> np.ndarray:
+    """
+        Packs rows of 0/1 values into rows of uint64 words, padding the rows with zero bits
+        to a whole number of words. Works chunk by chunk, so `vectors` and `out` can be
+        memory-mapped arrays (e.g. np.lib.format.open_memmap) larger than the memory.
+    """
+    num_words = (vectors.shape[1] + WORD_BITS - 1) // WORD_BITS
+    if out is None:
+        out = np.empty((len(vectors), num_words), dtype=np.uint64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size]).astype(bool)
+        padded = np.zeros((len(chunk), num_words * WORD_BITS), dtype=bool)
+        padded[:, :chunk.shape[1]] = chunk
+        out[start:start + len(chunk)] = np.packbits(
+            padded, axis=1, bitorder="little"
+        ).view(np.uint64)
+    return out
+
+
+def is_bit_vectors(vectors: np.ndarray, chunk_size: int = 65536) -> bool:
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start:start + chunk_size])
+        if not ((chunk == 0) | (chunk == 1)).all():
+            return False
+    return True
+
+
+# below this fraction of set bits a tile of queries is multiplied as a sparse matrix
+SPARSE_QUERY_DENSITY = 0.05
+CSR_BETA_WARNING = "Sparse CSR tensor support is in beta state"
+
+
+def _unpack_words(words: np.ndarray) -> torch.Tensor:
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=1, bitorder="little")
+    return torch.from_numpy(bits.astype(np.float32))
+
+
+class _QueryTile:
+    """
+        The unpacked bits of a tile of query fingerprints. Intersections with a tile of
+        stock fingerprints are the product with the transposed stock bits, which is exact
+        for up to 2 ** 24 bits per fingerprint. Sparse queries (Morgan fingerprints have
+        around 2% of their bits set) are multiplied as a CSR matrix, which skips the zeros.
+    """
+
+    def __init__(self, words: np.ndarray):
+        bits = _unpack_words(words)
+        self.counts = bits.sum(dim=1)
+        if bits.numel() and self.counts.sum() < SPARSE_QUERY_DENSITY * bits.numel():
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", message=CSR_BETA_WARNING)
+                bits = bits.to_sparse_csr()
+        self.bits = bits
+
+    def __len__(self):
+        return len(self.counts)
+
+    def tanimoto(self, stock_bits_t: torch.Tensor, stock_counts: torch.Tensor) -> torch.Tensor:
+        intersection = self.bits @ stock_bits_t
+        union = self.counts[:, None] + stock_counts[None, :] - intersection
+        similarities = intersection.div_(union)
+        # two empty fingerprints
+        return similarities.masked_fill_(union == 0, 1.0)
+
+
+class _StockTiles:
+    """
+        Iterates over a range of rows of the packed stock in tiles of transposed unpacked
+        bits, only one tile is read from a memory-mapped stock at a time.
+    """
+
+    def __init__(self, words: np.ndarray, start: int, stop: int, tile_size: int):
+        self.words = words
+        self.start = start
+        self.stop = stop
+        self.tile_size = tile_size
+
+    def __iter__(self):
+        for tile_start in range(self.start, self.stop, self.tile_size):
+            tile = np.asarray(self.words[tile_start:min(tile_start + self.tile_size, self.stop)])
+            bits = _unpack_words(tile)
+            yield tile_start, bits.t().contiguous(), bits.sum(dim=1)
+
+
+def _tiled_tasks(num_queries, num_stock, tile_size, num_threads):
+    """
+        Splits the query rows into tiles and, when there are fewer query tiles than threads
+        (a few molecules against a large stock), the stock rows into contiguous parts.
+    """
+    query_tiles = [
+        (start, min(start + tile_size, num_queries))
+        for start in range(0, num_queries, tile_size)
+    ]
+    num_parts = max(1, min(
+        math.ceil(num_threads / max(len(query_tiles), 1)), math.ceil(num_stock / tile_size)
+    ))
+    part_size = math.ceil(num_stock / num_parts) if num_stock else 0
+    stock_parts = [
+        (start, min(start + part_size, num_stock))
+        for start in range(0, num_stock, part_size or 1)
+    ]
+    return [(query_tile, stock_part) for query_tile in query_tiles for stock_part in stock_parts]
+
+
+def _run_tiled(query_words, stock_words, tile_size, num_threads, process_part):
+    num_threads = num_threads or os.cpu_count() or 1
+    tasks = _tiled_tasks(len(query_words), len(stock_words), tile_size, num_threads)
+
+    def run_task(task):
+        (query_start, query_stop), (stock_start, stock_stop) = task
+        return task, process_part(
+            _QueryTile(np.asarray(query_words[query_start:query_stop])),
+            _StockTiles(stock_words, stock_start, stock_stop, tile_size)
+        )
+
+    with torch.no_grad():
+        if num_threads == 1 or len(tasks) == 1:
+            return [run_task(task) for task in tasks]
+        # the unpacking and the torch kernels release the GIL
+        with ThreadPoolExecutor(num_threads) as executor:
+            return list(executor.map(run_task, tasks))
+
+
+def tanimoto_aggregate(
+        query_words: np.ndarray, stock_words: np.ndarray, agg: str = "max", p: float = 1,
+        tile_size: int = 1024, num_threads: Optional[int] = None
+) -> np.ndarray:
+    """
+        For every packed query fingerprint aggregates its Tanimoto similarities to all the
+        packed stock fingerprints: the maximum, or the power mean (mean x^p)^(1/p).
+        The stock can be a memory-mapped array (np.load(path, mmap_mode="r")) of millions
+        of rows, the memory use is bounded by a few tile_size x tile_size blocks per thread.
+        Two empty fingerprints have similarity 1.
+    """
+    assert agg in ["max", "mean"], "Can aggregate only max or mean"
+
+    def process_part(query_tile, stock_tiles):
+        result = torch.zeros(len(query_tile), dtype=torch.float64)
+        for _, stock_bits_t, stock_counts in stock_tiles:
+            similarities = query_tile.tanimoto(stock_bits_t, stock_counts)
+            if agg == "max":
+                torch.maximum(result, similarities.max(dim=1).values, out=result)
+            else:
+                if p != 1:
+                    similarities.pow_(p)
+                result += similarities.sum(dim=1, dtype=torch.float64)
+        return result.numpy()
+
+    aggregated = np.zeros(len(query_words), dtype=np.float64)
+    for ((query_start, query_stop), _), result in _run_tiled(
+        query_words, stock_words, tile_size, num_threads, process_part
+    ):
+        if agg == "max":
+            np.maximum(
+                aggregated[query_start:query_stop], result,
+                out=aggregated[query_start:query_stop]
+            )
+        else:
+            aggregated[query_start:query_stop] += result
+    if agg == "mean":
+        aggregated /= len(stock_words)
+        if p != 1:
+            aggregated **= 1 / p
+    return aggregated
+
+
+def tanimoto_top_k(
+        query_words: np.ndarray, stock_words: np.ndarray, k: int,
+        tile_size: int = 1024, num_threads: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        The k nearest stock fingerprints of every query fingerprint by Tanimoto similarity.
+        Returns the similarities and the stock row indices, both of shape (num_queries, k)
+        and ordered from the most similar. Tiled like tanimoto_aggregate.
+    """
+    k = min(k, len(stock_words))
+
+    def merge(similarities, indices):
+        similarities, kept = torch.topk(similarities, min(k, similarities.shape[1]), dim=1)
+        return similarities, torch.gather(indices, 1, kept)
+
+    def process_part(query_tile, stock_tiles):
+        best_similarities = torch.empty((len(query_tile), 0))
+        best_indices = torch.empty((len(query_tile), 0), dtype=torch.int64)
+        for tile_start, stock_bits_t, stock_counts in stock_tiles:
+            similarities = query_tile.tanimoto(stock_bits_t, stock_counts)
+            indices = torch.arange(
+                tile_start, tile_start + similarities.shape[1]
+            ).expand_as(similarities)
+            best_similarities, best_indices = merge(
+                torch.cat([best_similarities, similarities], dim=1),
+                torch.cat([best_indices, indices], dim=1)
+            )
+        return best_similarities, best_indices
+
+    similarities = np.empty((len(query_words), k), dtype=np.float32)
+    indices = np.empty((len(query_words), k), dtype=np.int64)
+    parts = {}
+    for ((query_start, query_stop), _), result in _run_tiled(
+        query_words, stock_words, tile_size, num_threads, process_part
+    ):
+        parts.setdefault((query_start, query_stop), []).append(result)
+    for (query_start, query_stop), results in parts.items():
+        part_similarities, part_indices = merge(
+            torch.cat([result[0] for result in results], dim=1),
+            torch.cat([result[1] for result in results], dim=1)
+        )
+        similarities[query_start:query_stop] = part_similarities.numpy()
+        indices[query_start:query_stop] = part_indices.numpy()
+    return similarities, indices
+
+
+class FingerprintIndex:
+    """
+        Exact k nearest neighbour search by Tanimoto similarity over a growing set of packed
+        fingerprints. Every row is stored as the list of its set bits, i.e. a CSR matrix
+        that new rows are appended to, so the intersections with a batch of queries are one
+        sparse-dense matrix product whose cost is proportional to the number of set bits
+        (around 2% for Morgan fingerprints). Rows are processed in blocks of `block_size`
+        and queries in chunks of `query_chunk_size`, which bounds the memory of the
+        similarity matrix.
+    """
+
+    def __init__(self, num_bits: int = NUM_MORGAN_BITS, capacity: int = 1024,
+                 block_size: int = 16384, query_chunk_size: int = 512):
+        self.num_bits = num_bits
+        self.block_size = block_size
+        self.query_chunk_size = query_chunk_size
+        self.row_offsets = np.zeros(capacity + 1, dtype=np.int64)
+        self.columns = np.zeros(capacity * WORD_BITS, dtype=np.int64)
+        self.counts = np.zeros(capacity, dtype=np.float32)
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def _reserve(self, num_rows, num_columns):
+        if num_rows > len(self.counts):
+            capacity = max(2 * len(self.counts), num_rows)
+            self.counts = np.resize(self.counts, capacity)
+            self.row_offsets = np.resize(self.row_offsets, capacity + 1)
+        if num_columns > len(self.columns):
+            self.columns = np.resize(self.columns, max(2 * len(self.columns), num_columns))
+
+    def add(self, packed_fingerprints: np.ndarray) -> np.ndarray:
+        """
+            Appends the fingerprints and returns their row indices.
+        """
+        packed_fingerprints = np.ascontiguousarray(np.atleast_2d(packed_fingerprints))
+        bits = np.unpackbits(packed_fingerprints.view(np.uint8), axis=1, bitorder="little")
+        new_rows, new_columns = np.nonzero(bits)
+        counts = np.bincount(new_rows, minlength=len(bits))
+        start, stop = self.num_rows, self.num_rows + len(bits)
+        offset = self.row_offsets[start]
+        self._reserve(stop, offset + len(new_columns))
+        self.columns[offset:offset + len(new_columns)] = new_columns
+        self.row_offsets[start + 1:stop + 1] = offset + np.cumsum(counts)
+        self.counts[start:stop] = counts
+        self.num_rows = stop
+        return np.arange(start, stop)
+
+    def _block(self, start, stop):
+        offsets = self.row_offsets[start:stop + 1]
+        columns = self.columns[offsets[0]:offsets[-1]]
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message=CSR_BETA_WARNING)
+            return torch.sparse_csr_tensor(
+                torch.from_numpy(offsets - offsets[0]), torch.from_numpy(columns),
+                torch.ones(len(columns)), size=(stop - start, self.num_bits),
+                check_invariants=False
+            )
+
+    @torch.no_grad()
+    def search(self, queries: np.ndarray, k: int, exclude_rows=None):
+        """
+            The k most similar rows for every packed query fingerprint, returns the
+            similarities and the rows, both of shape (num_queries, k), from the most similar.
+            exclude_rows[i] (-1 for none) is never returned for query i. When the index has
+            fewer rows the missing entries have row -1.
+        """
+        queries = np.atleast_2d(queries)
+        if exclude_rows is None:
+            exclude_rows = np.full(len(queries), -1)
+        exclude_rows = torch.as_tensor(np.asarray(exclude_rows, dtype=np.int64))
+        k = min(k, self.num_rows)
+        similarities = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        for query_start in range(0, len(queries), self.query_chunk_size):
+            query_stop = min(query_start + self.query_chunk_size, len(queries))
+            query_bits = _unpack_words(queries[query_start:query_stop])
+            query_counts = query_bits.sum(dim=1)
+            query_bits_t = query_bits.t().contiguous()
+            query_excluded = exclude_rows[query_start:query_stop]
+            best_similarities = torch.empty((0, query_stop - query_start))
+            best_rows = torch.empty((0, query_stop - query_start), dtype=torch.int64)
+            for start in range(0, self.num_rows, self.block_size):
+                stop = min(start + self.block_size, self.num_rows)
+                counts = torch.from_numpy(self.counts[start:stop])
+                # rows x queries, the union is computed in place of a copy of the intersection
+                intersection = self._block(start, stop) @ query_bits_t
+                union = intersection.neg().add_(counts[:, None]).add_(query_counts[None, :])
+                block_similarities = intersection.div_(union)
+                if (counts == 0).any() and (query_counts == 0).any():
+                    # two empty fingerprints
+                    block_similarities[
+                        (counts == 0).nonzero()[:, 0][:, None], (query_counts == 0).nonzero()[:, 0]
+                    ] = 1.0
+                excluded = ((query_excluded >= start) & (query_excluded < stop)).nonzero()[:, 0]
+                block_similarities[query_excluded[excluded] - start, excluded] = -np.inf
+                block_similarities, block_rows = torch.topk(
+                    block_similarities, min(k, stop - start), dim=0
+                )
+                best_similarities, kept = torch.topk(
+                    torch.cat([best_similarities, block_similarities]), k, dim=0
+                )
+                best_rows = torch.gather(torch.cat([best_rows, block_rows + start]), 0, kept)
+            best_rows[torch.isinf(best_similarities)] = -1
+            similarities[query_start:query_stop] = best_similarities.t().numpy()
+            rows[query_start:query_stop] = best_rows.t().numpy()
+        return similarities, rows
@@ -0,0 +1,128 @@
+from typing import Dict, Optional
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import time
+
+
+class PhaseTimer:
+    """
+        Wall-clock time and counters of the phases of the optimize loop. Time spent in a
+        phase nested in another one is only counted for the inner phase, so the phase times
+        of an iteration add up to at most its wall-clock time, the rest is reported as other.
+        `end_iteration` writes the times and counters of the iteration as one JSON line to
+        `path` (if given) and tracks them in `aim_run` (an aim.Run, e.g. the _run of a
+        CustomAimCallback), the totals are kept for `summary`.
+        A phase costs two perf_counter calls and a few dict updates, so it can stay on.
+        Phases must be entered from one thread.
+    """
+
+    def __init__(self, path: Optional[str] = None, aim_run=None, append: bool = False):
+        self.file = open(path, "a" if append else "w") if path else None
+        self.aim_run = aim_run
+        self.times: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.total_times: Dict[str, float] = defaultdict(float)
+        self.total_calls: Dict[str, int] = defaultdict(int)
+        self.total_counters: Dict[str, float] = defaultdict(float)
+        # time spent in nested phases, one entry per open phase
+        self.child_times = []
+        self.start_time = time.perf_counter()
+        self.iteration_start_time = self.start_time
+        self.num_iterations = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        start_time = time.perf_counter()
+        self.child_times.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.add(name, elapsed - self.child_times.pop())
+            if self.child_times:
+                self.child_times[-1] += elapsed
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        """
+            Adds time measured elsewhere to a phase.
+        """
+        self.times[name] += seconds
+        self.calls[name] += calls
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] += value
+
+    def end_iteration(self, iteration: int, **fields):
+        """
+            Reports the phases and counters since the previous call, `fields` are added
+            to the JSON line.
+        """
+        now = time.perf_counter()
+        wall_time = now - self.iteration_start_time
+        self.iteration_start_time = now
+        self.num_iterations += 1
+        record = {
+            "iteration": iteration,
+            **fields,
+            "wall_time": wall_time,
+            "other_time": max(wall_time - sum(self.times.values()), 0.0),
+            "times": dict(self.times),
+            "calls": dict(self.calls),
+            "counters": dict(self.counters),
+        }
+        if self.file is not None:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+        if self.aim_run is not None:
+            for name, seconds in self.times.items():
+                self.aim_run.track(
+                    seconds, name="phase_time", step=iteration, context={"phase": name}
+                )
+            for name, value in self.counters.items():
+                self.aim_run.track(value, name=name, step=iteration, context={"subset": "optimize"})
+            self.aim_run.track(wall_time, name="iteration_time", step=iteration)
+        for name, seconds in self.times.items():
+            self.total_times[name] += seconds
+        for name, calls in self.calls.items():
+            self.total_calls[name] += calls
+        for name, value in self.counters.items():
+            self.total_counters[name] += value
+        self.times.clear()
+        self.calls.clear()
+        self.counters.clear()
+        return record
+
+    def summary(self) -> str:
+        """
+            A table of the time per phase over all the reported iterations.
+        """
+        wall_time = time.perf_counter() - self.start_time
+        rows = sorted(self.total_times.items(), key=lambda item: item[1], reverse=True)
+        rows.append(("other", max(wall_time - sum(self.total_times.values()), 0.0)))
+        lines = [f"{'phase':<16}{'total (s)':>12}{'share':>9}{'calls':>9}{'mean (ms)':>12}"]
+        for name, seconds in rows:
+            calls = self.total_calls.get(name, 0)
+            mean = f"{1000 * seconds / calls:.2f}" if calls else "-"
+            lines.append(
+                f"{name:<16}{seconds:>12.3f}{100 * seconds / max(wall_time, 1e-9):>8.1f}%"
+                f"{calls or '-':>9}{mean:>12}"
+            )
+        lines.append(f"{'wall':<16}{wall_time:>12.3f}{'':>9}{self.num_iterations:>9} iterations")
+        if self.total_counters:
+            lines.append(", ".join(
+                f"{name}: {value:g}" for name, value in sorted(self.total_counters.items())
+            ))
+        return "\n".join(lines)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def create_aim_run(repo: str, experiment: Optional[str] = None):
+    # aim is only needed when the timings are tracked
+    from aim import Run
+    return Run(repo=repo, experiment=experiment)
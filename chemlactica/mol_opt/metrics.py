@@ -1,41 +1,118 @@
+import heapq
 import numpy as np
 import torch
+from chemlactica.mol_opt.fingerprints import (
+    is_bit_vectors, pack_bit_vectors, tanimoto_aggregate
+)
 
 
-def top_auc(buffer, top_n, finish, freq_log, max_oracle_calls):
-    sum = 0
+def _trapezoid_auc(checkpoint_means, last_mean, num_calls, finish, freq_log, max_oracle_calls):
+    """
+        The area under the top-n mean curve as computed by top_auc, from the means after
+        every freq_log calls (only checkpoints followed by another call and below
+        max_oracle_calls count) and the mean over all the calls.
+    """
+    auc = 0
     prev = 0
-    called = 0
-    ordered_results = list(sorted(buffer.items(), key=lambda kv: kv[1][1], reverse=False))
-    for idx in range(freq_log, min(len(buffer), max_oracle_calls), freq_log):
-        temp_result = ordered_results[:idx]
-        temp_result = list(sorted(temp_result, key=lambda kv: kv[1][0], reverse=True))[:top_n]
-        top_n_now = np.mean([item[1][0] for item in temp_result])
-        sum += freq_log * (top_n_now + prev) / 2
+    for top_n_now in checkpoint_means:
+        auc += freq_log * (top_n_now + prev) / 2
         prev = top_n_now
-        called = idx
-    temp_result = list(sorted(ordered_results, key=lambda kv: kv[1][0], reverse=True))[:top_n]
-    top_n_now = np.mean([item[1][0] for item in temp_result])
-    sum += (len(buffer) - called) * (top_n_now + prev) / 2
-    if finish and len(buffer) < max_oracle_calls:
-        sum += (max_oracle_calls - len(buffer)) * top_n_now
-    return sum / max_oracle_calls
+    called = len(checkpoint_means) * freq_log
+    auc += (num_calls - called) * (last_mean + prev) / 2
+    if finish and num_calls < max_oracle_calls:
+        auc += (max_oracle_calls - num_calls) * last_mean
+    return auc / max_oracle_calls
 
 
-def average_agg_tanimoto(stock_vecs, gen_vecs,
-                         batch_size=5000, agg='max',
-                         device='cpu', p=1):
+def top_auc_scores(scores, top_n, finish, freq_log, max_oracle_calls):
     """
-    For each molecule in gen_vecs finds closest molecule in stock_vecs.
-    Returns average tanimoto score for between these molecules
+        top_auc of the scores given in the order of the oracle calls. The top-n scores
+        are merged with one freq_log block of new scores at a time with np.partition,
+        so a buffer of n scores costs O(n + n / freq_log * top_n).
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    num_checkpoints = len(range(freq_log, min(len(scores), max_oracle_calls), freq_log))
+    checkpoint_means = np.empty(num_checkpoints, dtype=np.float64)
+    top_scores = scores[:0]
+    for i in range(num_checkpoints):
+        top_scores = np.concatenate([top_scores, scores[i * freq_log:(i + 1) * freq_log]])
+        if len(top_scores) > top_n:
+            top_scores = np.partition(top_scores, len(top_scores) - top_n)[-top_n:]
+        checkpoint_means[i] = top_scores.mean()
+    top_scores = np.concatenate([top_scores, scores[num_checkpoints * freq_log:]])
+    if len(top_scores) > top_n:
+        top_scores = np.partition(top_scores, len(top_scores) - top_n)[-top_n:]
+    last_mean = top_scores.mean() if len(top_scores) else np.nan
+    return _trapezoid_auc(
+        checkpoint_means, last_mean, len(scores), finish, freq_log, max_oracle_calls
+    )
 
-    Parameters:
-        stock_vecs: numpy array <n_vectors x dim>
-        gen_vecs: numpy array <n_vectors' x dim>
-        agg: max or mean
-        p: power for averaging: (mean x^p)^(1/p)
+
+def top_auc(buffer, top_n, finish, freq_log, max_oracle_calls):
     """
-    assert agg in ['max', 'mean'], "Can aggregate only max or mean"
+        Area under the curve of the mean of the top_n scores against the number of oracle
+        calls, normalized by max_oracle_calls. `buffer` maps molecules to (score, call index).
+    """
+    values = list(buffer.values())
+    call_indices = np.array([value[1] for value in values])
+    scores = np.array([value[0] for value in values], dtype=np.float64)
+    return top_auc_scores(
+        scores[np.argsort(call_indices, kind="stable")], top_n, finish, freq_log, max_oracle_calls
+    )
+
+
+class TopAUC:
+    """
+        top_auc computed while the oracle runs: `add(score, call_index)` keeps the top_n
+        scores in a min-heap with their sum and closes a trapezoid every freq_log calls,
+        in O(log top_n) per call. Calls reported out of order are held back until the
+        calls before them arrive. `value(finish)` equals top_auc of the calls added so far.
+    """
+
+    def __init__(self, top_n: int, freq_log: int, max_oracle_calls: int):
+        self.top_n = top_n
+        self.freq_log = freq_log
+        self.max_oracle_calls = max_oracle_calls
+        self.top_scores = []
+        self.top_sum = 0.0
+        self.num_calls = 0
+        self.checkpoint_means = []
+        self.pending = {}
+
+    def _top_mean(self):
+        return self.top_sum / len(self.top_scores) if self.top_scores else np.nan
+
+    def _add_next(self, score):
+        num_calls = self.num_calls
+        if num_calls and num_calls % self.freq_log == 0 and num_calls < self.max_oracle_calls:
+            # a checkpoint counts once a call follows it
+            self.checkpoint_means.append(self._top_mean())
+        if len(self.top_scores) < self.top_n:
+            heapq.heappush(self.top_scores, score)
+            self.top_sum += score
+        elif score > self.top_scores[0]:
+            self.top_sum += score - heapq.heapreplace(self.top_scores, score)
+        self.num_calls += 1
+
+    def add(self, score: float, call_index: int = None):
+        """
+            `call_index` is 1-based, as in the mol_buffer of the oracles,
+            None means the next call.
+        """
+        if call_index is None:
+            call_index = self.num_calls + len(self.pending) + 1
+        self.pending[call_index] = float(score)
+        while self.num_calls + 1 in self.pending:
+            self._add_next(self.pending.pop(self.num_calls + 1))
+
+    def value(self, finish: bool = False) -> float:
+        return _trapezoid_auc(
+            self.checkpoint_means, self._top_mean(), self.num_calls,
+            finish, self.freq_log, self.max_oracle_calls
+        )
+
+
+def _agg_tanimoto_dense(stock_vecs, gen_vecs, batch_size, agg, device, p):
     agg_tanimoto = np.zeros(len(gen_vecs))
     total = np.zeros(len(gen_vecs))
     for j in range(0, stock_vecs.shape[0], batch_size):
@@ -59,13 +136,44 @@ def average_agg_tanimoto(stock_vecs, gen_vecs,
         agg_tanimoto /= total
     if p != 1:
         agg_tanimoto = (agg_tanimoto)**(1/p)
-    return np.mean(agg_tanimoto)
+    return agg_tanimoto
+
+
+def average_agg_tanimoto(stock_vecs, gen_vecs,
+                         batch_size=5000, agg='max',
+                         device='cpu', p=1, num_threads=None):
+    """
+    For each molecule in gen_vecs finds closest molecule in stock_vecs.
+    Returns average tanimoto score for between these molecules
+
+    Parameters:
+        stock_vecs: numpy array <n_vectors x dim>, or packed uint64 fingerprints
+            <n_vectors x n_words> (see fingerprints.pack_bit_vectors), possibly memory-mapped
+        gen_vecs: numpy array <n_vectors' x dim>, or packed uint64 fingerprints
+        agg: max or mean
+        p: power for averaging: (mean x^p)^(1/p)
+
+    Packed fingerprints, and 0/1 vectors on cpu, go through the tiled
+    fingerprints.tanimoto_aggregate, batch_size and device are only used otherwise.
+    """
+    assert agg in ['max', 'mean'], "Can aggregate only max or mean"
+    packed = stock_vecs.dtype == np.uint64 and gen_vecs.dtype == np.uint64
+    if packed or (device == 'cpu' and is_bit_vectors(stock_vecs) and is_bit_vectors(gen_vecs)):
+        if not packed:
+            stock_vecs = pack_bit_vectors(stock_vecs)
+            gen_vecs = stock_vecs if gen_vecs is stock_vecs else pack_bit_vectors(gen_vecs)
+        return np.mean(tanimoto_aggregate(
+            gen_vecs, stock_vecs, agg=agg, p=p, num_threads=num_threads
+        ))
+    return np.mean(_agg_tanimoto_dense(stock_vecs, gen_vecs, batch_size, agg, device, p))
 
 
-def internal_diversity(molecule_fingerprints, device='cpu', fp_type='morgan', p=1):
+def internal_diversity(molecule_fingerprints, device='cpu', fp_type='morgan', p=1,
+                       num_threads=None):
     """
     Computes internal diversity as:
     1/|A|^2 sum_{x, y in AxA} (1-tanimoto(x, y))
     """
     return 1 - (average_agg_tanimoto(molecule_fingerprints, molecule_fingerprints,
-                                     agg='mean', device=device, p=p)).mean()
\ No newline at end of file
+                                     agg='mean', device=device, p=p,
+                                     num_threads=num_threads)).mean()
\ No newline at end of file
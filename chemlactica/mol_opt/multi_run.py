@@ -0,0 +1,248 @@
+from typing import Dict, List
+import copy
+import threading
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList
+from chemlactica.mol_opt.checkpointing import get_rng_state, set_rng_state
+from chemlactica.mol_opt.optimization import accept_smiles, optimize
+from chemlactica.mol_opt.utils import set_seed
+
+
+class RowSlicedLogitsProcessor(LogitsProcessor):
+    """
+        Applies the logits processors of every run to its own rows of a merged batch,
+        followed by the temperature of the run (generate is called with temperature 1).
+    """
+
+    def __init__(self, row_slices, logits_processors, temperatures):
+        self.row_slices = row_slices
+        self.logits_processors = logits_processors
+        self.temperatures = temperatures
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for rows, logits_processor, temperature in zip(
+            self.row_slices, self.logits_processors, self.temperatures
+        ):
+            if logits_processor:
+                scores[rows] = logits_processor(input_ids[rows], scores[rows])
+            if temperature is not None and temperature != 1.0:
+                scores[rows] = scores[rows] / temperature
+        return scores
+
+
+class _GenerateRequest:
+    def __init__(self, model, input_ids, attention_mask, kwargs):
+        self.model = model
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.temperature = kwargs.pop("temperature", None) if kwargs.get("do_sample") else None
+        self.logits_processor = kwargs.pop("logits_processor", None)
+        self.kwargs = kwargs
+        self.output = None
+        self.error = None
+
+    def group_key(self):
+        # requests with the same model and the same generation arguments go into one batch
+        return id(self.model), repr(sorted(self.kwargs.items()))
+
+
+class RunScheduler:
+    """
+        Runs optimize calls in threads that take turns: one run executes at a time and hands
+        over the turn when it calls generate or finishes. When every unfinished run waits for
+        generate, the requests are merged into one batch per model and generation arguments.
+        The python, numpy and torch rng states are swapped at every turn, so each run draws
+        from its own generators. Sampling uses the scheduler's generator, so the molecules of
+        a run depend on the runs it was batched with.
+    """
+
+    def __init__(self, num_runs: int, pad_token_id: int, seed: int = 0):
+        self.pad_token_id = pad_token_id
+        self.condition = threading.Condition()
+        self.alive = set(range(num_runs))
+        self.requests: Dict[int, _GenerateRequest] = {}
+        self.rng_states = [None] * num_runs
+        self.current = 0
+        self.num_generate_calls = 0
+        self.num_requests = 0
+        set_seed(seed)
+        self.generation_rng_state = get_rng_state()
+
+    def _next_run(self, run_index):
+        ready = sorted(self.alive - set(self.requests))
+        if not ready:
+            return None
+        later = [index for index in ready if index > run_index]
+        return later[0] if later else ready[0]
+
+    def _pass_turn(self, run_index):
+        self.rng_states[run_index] = get_rng_state()
+        next_run = self._next_run(run_index)
+        if next_run is None and self.requests:
+            self._generate()
+            next_run = min(self.alive)
+        self.current = next_run
+        self.condition.notify_all()
+
+    def _wait_turn(self, run_index):
+        self.condition.wait_for(lambda: self.current == run_index)
+        set_rng_state(self.rng_states[run_index])
+
+    def _generate(self):
+        set_rng_state(self.generation_rng_state)
+        groups = {}
+        for run_index in sorted(self.requests):
+            request = self.requests[run_index]
+            groups.setdefault(request.group_key(), []).append(request)
+        for requests in groups.values():
+            try:
+                self._generate_group(requests)
+            except Exception as error:
+                # raised in every run of the group instead of the one that happened to generate
+                for request in requests:
+                    request.error = error
+        self.generation_rng_state = get_rng_state()
+        self.requests.clear()
+
+    def _generate_group(self, requests: List[_GenerateRequest]):
+        model = requests[0].model
+        length = max(request.input_ids.shape[1] for request in requests)
+        input_ids, attention_mask, row_slices = [], [], []
+        num_rows = 0
+        for request in requests:
+            # left padding, as in optimize
+            padding = length - request.input_ids.shape[1]
+            input_ids.append(torch.nn.functional.pad(
+                request.input_ids, (padding, 0), value=self.pad_token_id
+            ))
+            attention_mask.append(torch.nn.functional.pad(request.attention_mask, (padding, 0)))
+            row_slices.append(slice(num_rows, num_rows + len(request.input_ids)))
+            num_rows += len(request.input_ids)
+        kwargs = dict(requests[0].kwargs)
+        if kwargs.get("do_sample"):
+            kwargs["temperature"] = 1.0
+        output = model.generate(
+            input_ids=torch.cat(input_ids), attention_mask=torch.cat(attention_mask),
+            logits_processor=LogitsProcessorList([RowSlicedLogitsProcessor(
+                row_slices,
+                [request.logits_processor for request in requests],
+                [request.temperature for request in requests]
+            )]),
+            **kwargs
+        )
+        generated = output[:, length:]
+        for request, rows in zip(requests, row_slices):
+            # drops the columns that are padding for every row of the run
+            request_generated = generated[rows]
+            non_pad_columns = (request_generated != self.pad_token_id).any(dim=0).nonzero()
+            num_columns = int(non_pad_columns.max()) + 1 if len(non_pad_columns) else 0
+            request.output = torch.cat(
+                [request.input_ids, request_generated[:, :num_columns]], dim=1
+            )
+        self.num_generate_calls += 1
+        self.num_requests += len(requests)
+
+    def generate(self, run_index, model, input_ids, attention_mask, **kwargs):
+        request = _GenerateRequest(model, input_ids, attention_mask, kwargs)
+        with self.condition:
+            self.requests[run_index] = request
+            self._pass_turn(run_index)
+            self._wait_turn(run_index)
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def run(self, run_index, function):
+        with self.condition:
+            self._wait_turn(run_index)
+        try:
+            return function()
+        finally:
+            with self.condition:
+                self.alive.discard(run_index)
+                if self.alive:
+                    self._pass_turn(run_index)
+
+
+class ScheduledModel:
+    """
+        The model as seen by one run: generate goes through the RunScheduler,
+        everything else is forwarded to the model.
+    """
+
+    def __init__(self, scheduler: RunScheduler, run_index: int, model):
+        self.scheduler = scheduler
+        self.run_index = run_index
+        self.model = model
+
+    def generate(self, input_ids, attention_mask, **kwargs):
+        return self.scheduler.generate(
+            self.run_index, self.model, input_ids, attention_mask, **kwargs
+        )
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def _fine_tunes(config):
+    return "rej-sample-v2" in config["strategy"]
+
+
+def _uses_sft_trainer(config):
+    return _fine_tunes(config) and (
+        config["rej_sample_config"].get("use_sft_trainer", False)
+        or config["rej_sample_config"]["packing"]
+    )
+
+
+def optimize_runs(model, tokenizer, runs: List[Dict], seed: int = 0):
+    """
+        Runs several independent optimizations in lockstep, their generation requests
+        are merged into shared batches of the frozen `model`. Every run is a dict with
+        the arguments of optimize (oracle, config and optionally additional_properties,
+        validate_smiles) and a seed. Runs that fine-tune (rej-sample-v2) get their own copy
+        of the model, a run trained with SFTTrainer also generates on its own as the
+        trainer needs the model itself.
+        Returns the scheduler, which counts the generate calls.
+    """
+    scheduler = RunScheduler(len(runs), tokenizer.pad_token_id, seed=seed)
+    for run_index, run in enumerate(runs):
+        set_seed(run["seed"])
+        scheduler.rng_states[run_index] = get_rng_state()
+
+    errors = [None] * len(runs)
+    run_models = []
+    for run_index, run in enumerate(runs):
+        run_model = copy.deepcopy(model) if _fine_tunes(run["config"]) else model
+        if not _uses_sft_trainer(run["config"]):
+            run_model = ScheduledModel(scheduler, run_index, run_model)
+        run_models.append(run_model)
+
+    def run_optimize(run_index, run):
+        # optimize changes the generation temperature in the config
+        config = copy.deepcopy(run["config"])
+        run_model = run_models[run_index]
+        try:
+            scheduler.run(run_index, lambda: optimize(
+                run_model, tokenizer, run["oracle"], config,
+                additional_properties=run.get("additional_properties", {}),
+                validate_smiles=run.get("validate_smiles", accept_smiles)
+            ))
+        except BaseException as error:
+            errors[run_index] = error
+
+    threads = [
+        threading.Thread(target=run_optimize, args=(run_index, run), daemon=True)
+        for run_index, run in enumerate(runs)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error
+    return scheduler
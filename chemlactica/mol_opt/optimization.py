@@ -1,12 +1,36 @@
 from typing import List
+from collections import deque
+from concurrent.futures import Future
+import itertools
+import multiprocessing
+import os
+import pickle
+import time
+import numpy as np
 import torch
+from transformers import LogitsProcessorList
 from datasets import Dataset
 import gc
 import shutil
 from trl import SFTTrainer
-from transformers import OPTForCausalLM
 from chemlactica.mol_opt.utils import OptimEntry, MoleculeEntry, Pool
-from chemlactica.mol_opt.tunning import get_training_arguments, get_optimizer_and_lr_scheduler, CustomEarlyStopCallback, CustomModelSelectionCallback
+from chemlactica.mol_opt.featurization import featurize, featurization_cache, MoleculeFeatures
+from chemlactica.mol_opt.fingerprints import FingerprintIndex
+from chemlactica.mol_opt.oracles import CachedOracle, OracleCache, ThreadPoolOracle
+from chemlactica.mol_opt.checkpointing import (
+    OptimizationCheckpointer, load_checkpoint, get_rng_state, set_rng_state, cpu_copy
+)
+from chemlactica.mol_opt.prompt_builder import PromptBuilder
+from chemlactica.mol_opt.instrumentation import PhaseTimer, create_aim_run
+from chemlactica.mol_opt.run_log import RunLogWriter
+from chemlactica.utils.cpu_inference import is_quantized
+from chemlactica.generation.continuous_batching import ContinuousBatchingEngine
+from chemlactica.utils.logits_utils import get_logits_processors
+from chemlactica.utils.logits_processors import DuplicateSMILESLogitsProcessor
+from chemlactica.mol_opt.tunning import (
+    get_training_arguments, get_optimizer_and_lr_scheduler, CustomEarlyStopCallback,
+    CustomModelSelectionCallback, ModelSnapshot, FineTuningEngine
+)
 
 
 def create_similar_mol_entries(pool, mol_entry, num_similars):
@@ -23,16 +47,92 @@ def create_similar_mol_entries(pool, mol_entry, num_similars):
     return valid_similar_entries
 
 
-def create_optimization_entries(num_entries, pool, config):
+class NearestSimilars:
+    """
+        Chooses the [SIMILAR] molecules of a prompt molecule as its nearest neighbours among
+        all the scored molecules (not only the pool), with a FingerprintIndex that is
+        updated as molecules are scored. The neighbours of a molecule are cached until the
+        next molecules are added.
+    """
+
+    def __init__(self):
+        self.index = FingerprintIndex()
+        self.entries: List[MoleculeEntry] = []
+        self.rows = {}
+        self.cache = {}
+
+    def add(self, mol_entries: List[MoleculeEntry]):
+        mol_entries = [
+            mol_entry for mol_entry in dict.fromkeys(mol_entries)
+            if mol_entry.smiles not in self.rows
+        ]
+        if not mol_entries:
+            return
+        rows = self.index.add(np.stack([
+            mol_entry.features.packed_fingerprint for mol_entry in mol_entries
+        ]))
+        for row, mol_entry in zip(rows, mol_entries):
+            self.rows[mol_entry.smiles] = row
+            self.entries.append(mol_entry)
+        self.cache.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __call__(self, mol_entries: List[MoleculeEntry], num_similars) -> List[List[MoleculeEntry]]:
+        """
+            The similar molecules of every entry, searched in one batch.
+        """
+        queries = [
+            mol_entry for mol_entry in dict.fromkeys(mol_entries)
+            if mol_entry.smiles not in self.cache
+        ]
+        if queries and num_similars > 0 and self.entries:
+            _, rows = self.index.search(
+                np.stack([mol_entry.features.packed_fingerprint for mol_entry in queries]),
+                num_similars,
+                exclude_rows=[self.rows.get(mol_entry.smiles, -1) for mol_entry in queries]
+            )
+            for mol_entry, query_rows in zip(queries, rows):
+                self.cache[mol_entry.smiles] = [self.entries[row] for row in query_rows if row >= 0]
+        return [list(self.cache.get(mol_entry.smiles, [])) for mol_entry in mol_entries]
+
+    def neighbourhoods(self, pool, num_entries, num_similars) -> List[List[MoleculeEntry]]:
+        """
+            The similar molecules of `num_entries` generation targets: a random pool molecule
+            followed by its nearest neighbours, so that the target is asked to be similar to
+            molecules that are similar to each other.
+        """
+        if len(pool) == 0 or num_similars <= 0:
+            return [[] for _ in range(num_entries)]
+        anchors = [pool.random_subset(1)[0].last_entry for _ in range(num_entries)]
+        return [
+            [anchor] + neighbours
+            for anchor, neighbours in zip(anchors, self(anchors, num_similars - 1))
+        ]
+
+
+def create_optimization_entries(num_entries, pool, config, nearest_similars=None):
     optim_entries = []
     for i in range(num_entries):
         mol_entries = [e.last_entry for e in pool.random_subset(config["num_mols"])]
         entries = []
         for mol_entry in mol_entries:
-            similar_mol_entries = create_similar_mol_entries(pool, mol_entry, num_similars=config["num_similars"])
-            mol_entry.similar_mol_entries = similar_mol_entries
+            if nearest_similars is None:
+                similar_mol_entries = create_similar_mol_entries(
+                    pool, mol_entry, num_similars=config["num_similars"]
+                )
+                mol_entry.similar_mol_entries = similar_mol_entries
             entries.append(mol_entry)
         optim_entries.append(OptimEntry(None, entries))
+    if nearest_similars is not None:
+        # one search for the molecules of all the prompts
+        mol_entries = [
+            mol_entry for optim_entry in optim_entries for mol_entry in optim_entry.mol_entries
+        ]
+        similars = nearest_similars(mol_entries, config["num_similars"])
+        for mol_entry, similar_mol_entries in zip(mol_entries, similars):
+            mol_entry.similar_mol_entries = similar_mol_entries
     return optim_entries
 
 
@@ -57,16 +157,162 @@ def create_molecule_entry(output_text, validate_smiles):
         return None
 
 
+def extract_generated_smiles(generated_text):
+    """
+        Extracts the SMILES from the generated continuation of a prompt ending with [START_SMILES].
+    """
+    start_smiles_tag, end_smiles_tag = "[START_SMILES]", "[END_SMILES]"
+    end_ind = generated_text.find(end_smiles_tag)
+    if end_ind == -1:
+        return None
+    start_ind = generated_text.rfind(start_smiles_tag, 0, end_ind)
+    start_ind = 0 if start_ind == -1 else start_ind + len(start_smiles_tag)
+    return generated_text[start_ind:end_ind]
+
+
+_validate_smiles = None
+
+
+def accept_smiles(smiles):
+    # the default validate_smiles, a module level function so that it can be pickled
+    return True
+
+
+def _init_molecule_parser(validate_smiles):
+    global _validate_smiles
+    _validate_smiles = validate_smiles
+
+
+def _parse_generated_molecule(generated_text):
+    generated_smiles = extract_generated_smiles(generated_text)
+    if generated_smiles is None:
+        return None
+    if not _validate_smiles(generated_smiles):
+        return None
+    if len(generated_smiles) == 0:
+        return None
+    try:
+        features = featurize(generated_smiles)
+    except Exception:
+        return None
+    # send back plain bytes rather than pickled RDKit objects
+    return features.smiles, features.packed_fingerprint.tobytes()
+
+
+class GeneratedMoleculeParser:
+    """
+        Turns generated continuations into MoleculeEntry objects (None for invalid ones).
+        Parsing, validation and fingerprinting run in a pool of worker processes that lives
+        as long as the parser, the workers send back the canonical SMILES and the packed
+        fingerprint which are registered in the featurization cache of this process.
+        The workers are started by a forkserver, as optimize runs threads (the run log
+        writer, asynchronous oracles, the runs of optimize_runs) that make forking unsafe,
+        so `validate_smiles` has to be picklable (a module level function).
+    """
+
+    def __init__(self, validate_smiles, num_processes=1):
+        self.num_processes = num_processes
+        self.pool = None
+        _init_molecule_parser(validate_smiles)
+        if num_processes > 1:
+            try:
+                pickle.dumps(validate_smiles)
+            except (pickle.PicklingError, AttributeError, TypeError) as error:
+                raise ValueError(
+                    "validate_smiles is sent to the parsing processes and must be picklable "
+                    "(a module level function) when num_processes > 1"
+                ) from error
+            context = multiprocessing.get_context("forkserver")
+            # the server imports this module once, the workers are forked from it
+            context.set_forkserver_preload([__name__])
+            self.pool = context.Pool(
+                processes=num_processes,
+                initializer=_init_molecule_parser,
+                initargs=(validate_smiles,)
+            )
+
+    def __call__(self, generated_texts: List[str]):
+        if self.pool is not None:
+            chunksize = max(1, len(generated_texts) // (4 * self.num_processes))
+            results = self.pool.map(_parse_generated_molecule, generated_texts, chunksize=chunksize)
+        else:
+            results = map(_parse_generated_molecule, generated_texts)
+
+        molecules = []
+        for result in results:
+            if result is None:
+                molecules.append(None)
+                continue
+            smiles, fingerprint_bytes = result
+            featurization_cache.add(MoleculeFeatures(
+                smiles, packed_fingerprint=np.frombuffer(fingerprint_bytes, dtype=np.uint64)
+            ))
+            molecules.append(MoleculeEntry(smiles=smiles))
+        return molecules
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
 def optimize(
         model, tokenizer,
         oracle, config,
         additional_properties={},
-        validate_smiles=lambda x:True
+        validate_smiles=accept_smiles
     ):
-    file = open(config["log_dir"], "w")
+    if "rej-sample-v2" in config["strategy"] and is_quantized(model):
+        raise ValueError(
+            "An int8 quantized model can not be fine-tuned, use a strategy without rej-sample-v2"
+        )
+    run_log = RunLogWriter(
+        config["log_dir"], log_format=config.get("log_format", "text"),
+        append=bool(config.get("resume_from")),
+        max_queue_size=config.get("log_queue_size", 1024)
+    )
     print("config", config)
     # print("molecule generation arguments", config["generation_config"])
     pool = Pool(config["pool_size"], validation_perc=config["validation_perc"])
+    molecule_parser = GeneratedMoleculeParser(validate_smiles, config.get("num_processes", 1))
+    prompt_builder = PromptBuilder(
+        tokenizer,
+        max_length=(
+            config.get("max_context_length", 2048) - config["generation_config"]["max_new_tokens"]
+        )
+    )
+    logits_processor = get_logits_processors(config.get("logits_processors_config_path"))
+    duplicate_processor = None
+    if config.get("block_duplicates", False):
+        # keeps the model from ending a SMILES that was already scored
+        duplicate_processor = DuplicateSMILESLogitsProcessor(
+            tokenizer=tokenizer, penalty=config.get("duplicate_penalty")
+        )
+        logits_processor = LogitsProcessorList(list(logits_processor or []) + [duplicate_processor])
+    generation_engine = None
+    generation_stream = None
+    if config.get("continuous_batching", False):
+        generation_engine = ContinuousBatchingEngine(
+            model, tokenizer.pad_token_id,
+            num_slots=config["generation_batch_size"],
+            max_prompt_length=prompt_builder.max_length,
+            max_new_tokens=config["generation_config"]["max_new_tokens"]
+        )
+    user_oracle = oracle
+    oracle_cache = None
+    if config.get("oracle_cache_path"):
+        # scores computed by earlier runs, seeds and trials are read from disk
+        oracle_cache = OracleCache(config["oracle_cache_path"])
+        oracle = CachedOracle(
+            oracle, oracle_cache, oracle_key=config.get("oracle_cache_key"),
+            count_hits=config.get("oracle_cache_count_hits", True)
+        )
+    # the molecules the cache scored for free are not in the mol_buffer
+    free_hits = oracle.free_hits if isinstance(oracle, CachedOracle) else {}
+    if config.get("async_oracle", False) and not hasattr(oracle, "submit"):
+        # score in a background thread so that generation goes on meanwhile
+        oracle = ThreadPoolOracle(oracle)
 
     config["generation_config"]["temperature"] = config["generation_temperature"][0]
 
@@ -77,84 +323,361 @@ def optimize(
         max_num_trains = oracle.max_oracle_calls / (config["rej_sample_config"]["train_tol_level"] * config["num_gens_per_iter"])
         max_num_train_steps = int(max_num_trains * num_single_train_steps)
         optimizer, lr_scheduler = get_optimizer_and_lr_scheduler(model, config["rej_sample_config"], max_num_train_steps)
+        # the buffers of the best model weights are reused by every training round
+        best_model_snapshot = ModelSnapshot(
+            device=config["rej_sample_config"].get("best_model_snapshot_device", "cpu"),
+            trainable_only=config["rej_sample_config"].get("snapshot_trainable_only", False)
+        )
+        fine_tuning_engine = None
+        if (
+            not config["rej_sample_config"].get("use_sft_trainer", False)
+            and not config["rej_sample_config"]["packing"]
+        ):
+            # created once, the token ids of the pool entries are kept between training rounds
+            fine_tuning_engine = FineTuningEngine(
+                model, tokenizer, optimizer, lr_scheduler,
+                config["rej_sample_config"], best_model_snapshot
+            )
     max_score = 0
     tol_level = 0
     num_iter = 0
     prev_train_iter = 0
-    while True:
-        model.eval()
-        new_best_molecule_generated = False
-        iter_unique_optim_entries: List[OptimEntry] = {}
-        while len(iter_unique_optim_entries) < config["num_gens_per_iter"]:
+    num_trainings = 0
+    num_outer_iters = 0
+
+    if config.get("resume_from"):
+        state, weights = load_checkpoint(config["resume_from"])
+        pool.load_state_dict(state["pool"], additional_properties)
+        # the molecules scored before the snapshot are not scored again
+        oracle.mol_buffer.update(state["mol_buffer"])
+        max_score = state["max_score"]
+        tol_level = state["tol_level"]
+        num_iter = state["num_iter"]
+        prev_train_iter = state["prev_train_iter"]
+        num_trainings = state["num_trainings"]
+        num_outer_iters = state["num_outer_iters"]
+        config["generation_config"]["temperature"] = state["temperature"]
+        if weights is not None:
+            model.load_state_dict(weights["model"])
+            if "rej-sample-v2" in config["strategy"]:
+                optimizer.load_state_dict(weights["optimizer"])
+                lr_scheduler.load_state_dict(weights["lr_scheduler"])
+        set_rng_state(state["rng"])
+        print(
+            f"Resumed from {config['resume_from']}, "
+            f"budget: {len(oracle)}, pool size: {len(pool)}"
+        )
+    if duplicate_processor is not None:
+        duplicate_processor.add(list(oracle.mol_buffer))
+    nearest_similars = None
+    if config.get("similars_strategy", "random") == "nearest":
+        nearest_similars = NearestSimilars()
+        nearest_similars.add([
+            MoleculeEntry(smiles, score=values[0]) for smiles, values in oracle.mol_buffer.items()
+        ])
+
+    checkpointer = None
+    if config.get("checkpoint_dir"):
+        checkpointer = OptimizationCheckpointer(config["checkpoint_dir"])
+        if config.get("resume_from") and (
+            os.path.abspath(config["resume_from"]) == os.path.abspath(config["checkpoint_dir"])
+        ):
+            checkpointer.weights_version = num_trainings if weights is not None else None
+            checkpointer.weights_file_name = state["weights_file_name"]
+
+    aim_run = None
+    if config.get("aim_repo"):
+        aim_run = create_aim_run(config["aim_repo"], config.get("aim_experiment"))
+    timer = PhaseTimer(
+        config.get("timings_path"), aim_run=aim_run, append=bool(config.get("resume_from"))
+    )
+
+    def save_checkpoint():
+        run_log.flush()
+        weights = None
+        if num_trainings and checkpointer.needs_weights(num_trainings):
+            # copied here, training may update the weights while the snapshot is written
+            weights = {"model": cpu_copy(model.state_dict())}
+            if "rej-sample-v2" in config["strategy"]:
+                weights["optimizer"] = cpu_copy(optimizer.state_dict())
+                weights["lr_scheduler"] = lr_scheduler.state_dict()
+        checkpointer.save({
+            "pool": pool.state_dict(),
+            "mol_buffer": dict(oracle.mol_buffer),
+            "max_score": max_score,
+            "tol_level": tol_level,
+            "num_iter": num_iter,
+            "prev_train_iter": prev_train_iter,
+            "num_trainings": num_trainings,
+            "num_outer_iters": num_outer_iters,
+            "temperature": config["generation_config"]["temperature"],
+            "rng": get_rng_state(),
+        }, weights, weights_version=num_trainings if weights is not None else None)
+
+    def create_generation_entries(num_entries):
+        with timer.phase("prompt_building"):
             optim_entries = create_optimization_entries(
-                config["generation_batch_size"], pool,
-                config=config
+                num_entries, pool, config=config, nearest_similars=nearest_similars
             )
+            if nearest_similars is not None:
+                neighbourhoods = nearest_similars.neighbourhoods(
+                    pool, len(optim_entries), config["num_similars"]
+                )
             for i in range(len(optim_entries)):
                 last_entry = MoleculeEntry(smiles="")
-                last_entry.similar_mol_entries = create_similar_mol_entries(
-                    pool, last_entry, config["num_similars"]
-                )
+                if nearest_similars is not None:
+                    last_entry.similar_mol_entries = neighbourhoods[i]
+                else:
+                    last_entry.similar_mol_entries = create_similar_mol_entries(
+                        pool, last_entry, config["num_similars"]
+                    )
                 for prop_name, prop_spec in additional_properties.items():
                     last_entry.add_props[prop_name] = prop_spec
                 optim_entries[i].last_entry = last_entry
 
-            prompts = [
-                optim_entry.to_prompt(
+            prompts_segments = [
+                optim_entry.to_prompt_segments(
                     is_generation=True, include_oracle_score=prev_train_iter != 0,
                     config=config, max_score=max_score
                 )
                 for optim_entry in optim_entries
             ]
-            output_texts = []
-            data = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
-            if type(model) == OPTForCausalLM:
-                del data["token_type_ids"]
-            for key, value in data.items():
-                data[key] = value[:, -2048 + config["generation_config"]["max_new_tokens"]:]
-            output = model.generate(
-                **data,
-                **config["generation_config"]
-            )
-            gc.collect()
-            torch.cuda.empty_cache()
-            output_texts.extend(tokenizer.batch_decode(output))
-
-            current_unique_optim_entries = {}
-            # with multiprocessing.Pool(processes=config["num_processes"]) as pol:
-            for i, molecule in enumerate(map(create_molecule_entry, output_texts)):
-                if molecule and not optim_entries[i].contains_entry(molecule):
-                    if molecule.smiles not in oracle.mol_buffer and molecule.smiles not in current_unique_optim_entries:
-                        molecule.similar_mol_entries = optim_entries[i].last_entry.similar_mol_entries
-                        for prop_name, prop_spec in additional_properties.items():
-                            molecule.add_props[prop_name] = prop_spec
-                            molecule.add_props[prop_name]["value"] = molecule.add_props[prop_name]["calculate_value"](molecule)
-                        optim_entries[i].last_entry = molecule
-                        current_unique_optim_entries[molecule.smiles] = optim_entries[i]
-
-            num_of_molecules_to_score = min(len(current_unique_optim_entries), config["num_gens_per_iter"] - len(iter_unique_optim_entries))
-            current_unique_smiles_list = list(current_unique_optim_entries.keys())[:num_of_molecules_to_score]
-            current_unique_optim_entries = {smiles: current_unique_optim_entries[smiles] for smiles in current_unique_smiles_list}
-
-            if getattr(oracle, "takes_entry", False):
-                oracle_scores = oracle([current_unique_optim_entries[smiles].last_entry for smiles in current_unique_smiles_list])
-            else:
-                oracle_scores = oracle(current_unique_smiles_list)
-
-            for smiles, oracle_score in zip(current_unique_smiles_list, oracle_scores):
-                current_unique_optim_entries[smiles].last_entry.score = oracle_score
-                iter_unique_optim_entries[smiles] = current_unique_optim_entries[smiles]
-                file.write(f"generated smiles: {smiles}, score: {current_unique_optim_entries[smiles].last_entry.score:.4f}\n")
-                if max_score >= config["max_possible_oracle_score"] - 1e-2 or current_unique_optim_entries[smiles].last_entry.score > max_score:
-                    max_score = max(max_score, current_unique_optim_entries[smiles].last_entry.score)
-                    new_best_molecule_generated = True
-
-            print(f"Iter unique optim entries: {len(iter_unique_optim_entries)}, budget: {len(oracle)}")
+        with timer.phase("tokenization"):
+            prompts_ids = prompt_builder.prompts_ids(prompts_segments)
+        return optim_entries, prompts_ids
+
+    def next_generation_prompts(num_prompts):
+        return list(zip(*create_generation_entries(num_prompts)))
+
+    def end_iteration(generation_stats):
+        for name in ["prompt_tokens", "padded_prompt_tokens", "generated_tokens"]:
+            timer.count(name, generation_stats[name])
+        timer.end_iteration(num_outer_iters, oracle_calls=len(oracle), pool_size=len(pool))
+
+    while True:
+        model.eval()
+        new_best_molecule_generated = False
+        iter_unique_optim_entries: List[OptimEntry] = {}
+        generation_stats = {
+            "prompt_tokens": 0, "padded_prompt_tokens": 0,
+            "generated_tokens": 0, "generation_time": 0.0
+        }
 
+        # batches handed to the oracle and not recorded yet, in submission order
+        pending_oracle_batches = deque()
+        pending_smiles = set()
+        while True:
+            num_remaining = min(
+                config["num_gens_per_iter"] - len(iter_unique_optim_entries),
+                oracle.budget - len(oracle)
+            ) - len(pending_smiles)
             if oracle.finish:
+                num_remaining = 0
+            if num_remaining <= 0 and not pending_oracle_batches:
                 break
+            if num_remaining > 0:
+                if generation_engine is not None:
+                    # rows are refilled with new prompts as soon as they finish
+                    if generation_stream is None:
+                        generation_stream = generation_engine.generate(
+                            next_generation_prompts, config["generation_config"], logits_processor
+                        )
+                    generation_start_time = time.perf_counter()
+                    # the prompts of refilled rows are built inside, timed as their own phases
+                    with timer.phase("generate"):
+                        finished = list(
+                            itertools.islice(generation_stream, config["generation_batch_size"])
+                        )
+                    generation_stats["generation_time"] += (
+                        time.perf_counter() - generation_start_time
+                    )
+                    generation_stats["generated_tokens"] += sum(
+                        len(generated) for _, generated in finished
+                    )
+                    optim_entries = [optim_entry for optim_entry, _ in finished]
+                    with timer.phase("decode"):
+                        output_texts = tokenizer.batch_decode(
+                            [generated for _, generated in finished]
+                        )
+                else:
+                    # over-sample candidates so that prompts of similar length can be generated
+                    # together, every candidate is generated so the sampling distribution does
+                    # not change
+                    batch_size = config["generation_batch_size"]
+                    optim_entries, prompts_ids = create_generation_entries(
+                        batch_size * config.get("generation_bucketing_factor", 1)
+                    )
+                    length_order = sorted(
+                        range(len(prompts_ids)), key=lambda i: len(prompts_ids[i])
+                    )
+                    output_texts = [None] * len(prompts_ids)
+                    for batch_start in range(0, len(length_order), batch_size):
+                        batch_indices = length_order[batch_start:batch_start + batch_size]
+                        with timer.phase("tokenization"):
+                            data = prompt_builder.collate(
+                                [prompts_ids[i] for i in batch_indices]
+                            ).to(model.device)
+                        generation_start_time = time.perf_counter()
+                        with timer.phase("generate"):
+                            output = model.generate(
+                                **data,
+                                **config["generation_config"],
+                                logits_processor=logits_processor
+                            )
+                        generation_stats["generation_time"] += (
+                            time.perf_counter() - generation_start_time
+                        )
+                        # only the generated continuation has to be parsed
+                        generated = output[:, data["input_ids"].shape[1]:]
+                        generation_stats["prompt_tokens"] += data["attention_mask"].sum().item()
+                        generation_stats["padded_prompt_tokens"] += data["attention_mask"].numel()
+                        generation_stats["generated_tokens"] += (
+                            (generated != tokenizer.pad_token_id).sum().item()
+                        )
+                        with timer.phase("decode"):
+                            batch_texts = tokenizer.batch_decode(generated)
+                            for i, output_text in zip(batch_indices, batch_texts):
+                                output_texts[i] = output_text
+                    # once per candidate batch, not after every length bucket
+                    del data, output, generated
+                    with timer.phase("memory_cleanup"):
+                        gc.collect()
+                        torch.cuda.empty_cache()
+
+                current_unique_optim_entries = {}
+                with timer.phase("parse"):
+                    molecules = molecule_parser(output_texts)
+                    for i, molecule in enumerate(molecules):
+                        if molecule and not optim_entries[i].contains_entry(molecule):
+                            if (
+                                molecule.smiles not in oracle.mol_buffer
+                                and molecule.smiles not in free_hits
+                                and molecule.smiles not in pending_smiles
+                                and molecule.smiles not in current_unique_optim_entries
+                            ):
+                                molecule.similar_mol_entries = (
+                                    optim_entries[i].last_entry.similar_mol_entries
+                                )
+                                for prop_name, prop_spec in additional_properties.items():
+                                    molecule.add_props[prop_name] = prop_spec
+                                    prop_spec["value"] = prop_spec["calculate_value"](molecule)
+                                optim_entries[i].last_entry = molecule
+                                current_unique_optim_entries[molecule.smiles] = optim_entries[i]
+                timer.count("generated", len(output_texts))
+                timer.count("valid", sum(molecule is not None for molecule in molecules))
+
+                num_of_molecules_to_score = min(len(current_unique_optim_entries), num_remaining)
+                current_unique_smiles_list = list(
+                    current_unique_optim_entries.keys()
+                )[:num_of_molecules_to_score]
+                current_unique_optim_entries = {
+                    smiles: current_unique_optim_entries[smiles]
+                    for smiles in current_unique_smiles_list
+                }
+
+                if current_unique_smiles_list:
+                    if getattr(oracle, "takes_entry", False):
+                        oracle_input = [
+                            current_unique_optim_entries[smiles].last_entry
+                            for smiles in current_unique_smiles_list
+                        ]
+                    else:
+                        oracle_input = current_unique_smiles_list
+                    with timer.phase("oracle"):
+                        if hasattr(oracle, "submit"):
+                            oracle_future = oracle.submit(oracle_input)
+                        else:
+                            oracle_future = Future()
+                            oracle_future.set_result(oracle(oracle_input))
+                    timer.count("submitted", len(oracle_input))
+                    pending_oracle_batches.append((oracle_future, current_unique_optim_entries))
+                    pending_smiles.update(current_unique_smiles_list)
+
+                if duplicate_processor is not None:
+                    # the generated spelling is added as well, it is often not the canonical one
+                    known_smiles = []
+                    for output_text, molecule in zip(output_texts, molecules):
+                        if molecule and (
+                            molecule.smiles in oracle.mol_buffer or molecule.smiles in free_hits
+                            or molecule.smiles in pending_smiles
+                        ):
+                            known_smiles.extend(
+                                [molecule.smiles, extract_generated_smiles(output_text)]
+                            )
+                    duplicate_processor.add(known_smiles)
+
+            # record the batches that are scored already, block only when there is nothing to
+            # generate
+            while pending_oracle_batches and (
+                num_remaining <= 0 or pending_oracle_batches[0][0].done()
+            ):
+                oracle_future, scored_optim_entries = pending_oracle_batches.popleft()
+                with timer.phase("oracle"):
+                    # only the waiting is timed for an asynchronous oracle
+                    oracle_scores = oracle_future.result()
+                for smiles, oracle_score in zip(scored_optim_entries.keys(), oracle_scores):
+                    pending_smiles.discard(smiles)
+                    scored_optim_entries[smiles].last_entry.score = oracle_score
+                    iter_unique_optim_entries[smiles] = scored_optim_entries[smiles]
+                    if (
+                        max_score >= config["max_possible_oracle_score"] - 1e-2
+                        or oracle_score > max_score
+                    ):
+                        max_score = max(max_score, oracle_score)
+                        new_best_molecule_generated = True
+                with timer.phase("log_writing"):
+                    run_log.generated(list(zip(scored_optim_entries.keys(), oracle_scores)))
+                if nearest_similars is not None:
+                    nearest_similars.add([
+                        optim_entry.last_entry for optim_entry in scored_optim_entries.values()
+                    ])
+                print(
+                    f"Iter unique optim entries: {len(iter_unique_optim_entries)}, "
+                    f"budget: {len(oracle)}"
+                )
+                if num_remaining <= 0:
+                    break
+
+        tokens_per_second = (
+            generation_stats["generated_tokens"] / max(generation_stats["generation_time"], 1e-6)
+        )
+        if generation_stats["padded_prompt_tokens"]:
+            padding_efficiency = (
+                generation_stats["prompt_tokens"] / generation_stats["padded_prompt_tokens"]
+            )
+            print(
+                f"Padding efficiency: {padding_efficiency:.3f}, "
+                f"generated tokens/s: {tokens_per_second:.1f}"
+            )
+        elif generation_engine is not None:
+            print(
+                f"Slot occupancy: {generation_engine.stats()['slot_occupancy']:.3f}, "
+                f"generated tokens/s: {tokens_per_second:.1f}"
+            )
 
         if oracle.finish:
+            print(f"Featurization cache: {featurization_cache.stats()}")
+            print(f"Prompt token cache: {prompt_builder.stats()}")
+            if duplicate_processor is not None:
+                print(f"Duplicate blocking: {duplicate_processor.stats()}")
+            if generation_stream is not None:
+                generation_stream.close()
+            molecule_parser.close()
+            if isinstance(oracle, ThreadPoolOracle) and oracle is not user_oracle:
+                oracle.shutdown()
+            if oracle_cache is not None:
+                print(f"Oracle cache: {oracle.stats()}")
+                oracle_cache.close()
+            if checkpointer is not None:
+                # resuming from the final snapshot finishes right away
+                with timer.phase("checkpoint"):
+                    save_checkpoint()
+                checkpointer.close()
+            with timer.phase("log_writing"):
+                run_log.close()
+            end_iteration(generation_stats)
+            print(f"Phase timings:\n{timer.summary()}")
+            timer.close()
             break
         initial_num_iter = num_iter
         num_iter = len(oracle.mol_buffer) // config["num_gens_per_iter"]
@@ -170,10 +693,10 @@ def optimize(
             print(f"Generation temperature: {config['generation_config']['temperature']}")
 
         # diversity_score = 1 / (1 + math.log(1 + repeated_max_score) / math.log(10))
-        pool.add(list(iter_unique_optim_entries.values()))
-        file.write("Pool\n")
-        for i, optim_entry in enumerate(pool.optim_entries):
-            file.write(f"\t{i} smiles: {optim_entry.last_entry.smiles}, score: {optim_entry.last_entry.score:.4f}\n")
+        with timer.phase("pool_add"):
+            pool.add(list(iter_unique_optim_entries.values()))
+        with timer.phase("log_writing"):
+            run_log.pool(pool.optim_entries, num_outer_iters)
 
         if "rej-sample-v2" in config["strategy"]:
             # round_entries.extend(current_entries)
@@ -181,61 +704,91 @@ def optimize(
             # top_k = int(len(all_entries) * config["rej_sample_config"]["rej_perc"])
             # if top_k >= config["rej_sample_config"]["num_samples_per_round"]:
             if tol_level >= config["rej_sample_config"]["train_tol_level"]:
+                training_start_time = time.perf_counter()
                 train_entries, validation_entries = pool.get_train_valid_entries()
                 print(f"Num of training examples: {len(train_entries)}, num of validation examples: {len(validation_entries)}.")
-                file.write("Training entries\n")
-                for i, optim_entry in enumerate(train_entries):
-                    file.write(f"\t{i} smiles: {optim_entry.last_entry.smiles}, score: {optim_entry.last_entry.score:.4f}\n")
-                file.write("Validation entries\n")
-                for i, optim_entry in enumerate(validation_entries):
-                    file.write(f"\t{i} smiles: {optim_entry.last_entry.smiles}, score: {optim_entry.last_entry.score:.4f}\n")
+                run_log.training(train_entries, validation_entries, num_outer_iters)
                 
-                train_dataset = Dataset.from_dict({
-                    "sample": [
-                        optim_entry.to_prompt(
-                            is_generation=False, include_oracle_score=True,
-                            config=config, max_score=config["max_possible_oracle_score"]
-                        )
-                        for optim_entry in train_entries
-                    ]
-                })
-                validation_dataset = Dataset.from_dict({
-                    "sample": [
-                        optim_entry.to_prompt(
-                            is_generation=False, include_oracle_score=True,
-                            config=config, max_score=config["max_possible_oracle_score"]
-                        )
-                        for optim_entry in validation_entries
-                    ]
-                })
-                train_dataset.shuffle(seed=42)
-                validation_dataset.shuffle(seed=42)
-
-                # early_stopping_callback = CustomEarlyStopCallback(
-                #     early_stopping_patience=1,
-                #     early_stopping_threshold=0.0001
-                # )
-                model_selection_callback = CustomModelSelectionCallback()
-
-                model.train()
-                trainer = SFTTrainer(
-                    model=model,
-                    train_dataset=train_dataset,
-                    eval_dataset=validation_dataset,
-                    formatting_func=lambda x: x["sample"],
-                    args=training_args,
-                    packing=config["rej_sample_config"]["packing"],
-                    tokenizer=tokenizer,
-                    max_seq_length=config["rej_sample_config"]["max_seq_length"],
-                    # data_collator=collator,
-                    callbacks=[model_selection_callback],
-                    optimizers=[optimizer, lr_scheduler],
-                )
-                trainer.train()
-                print(f"Loading the best model state dict with validation loss {model_selection_callback.best_validation_loss}")
-                model.load_state_dict(model_selection_callback.best_model_state_dict)
-                del model_selection_callback.best_model_state_dict
-                gc.collect()
-                torch.cuda.empty_cache()
+                if fine_tuning_engine is not None:
+                    model.train()
+                    best_validation_loss = fine_tuning_engine.train(
+                        [
+                            optim_entry.to_prompt_segments(
+                                is_generation=False, include_oracle_score=True,
+                                config=config, max_score=config["max_possible_oracle_score"]
+                            )
+                            for optim_entry in train_entries
+                        ],
+                        [
+                            optim_entry.to_prompt_segments(
+                                is_generation=False, include_oracle_score=True,
+                                config=config, max_score=config["max_possible_oracle_score"]
+                            )
+                            for optim_entry in validation_entries
+                        ]
+                    )
+                    print(
+                        f"Loaded the best model weights with validation loss {best_validation_loss}"
+                    )
+                else:
+                    train_dataset = Dataset.from_dict({
+                        "sample": [
+                            optim_entry.to_prompt(
+                                is_generation=False, include_oracle_score=True,
+                                config=config, max_score=config["max_possible_oracle_score"]
+                            )
+                            for optim_entry in train_entries
+                        ]
+                    })
+                    validation_dataset = Dataset.from_dict({
+                        "sample": [
+                            optim_entry.to_prompt(
+                                is_generation=False, include_oracle_score=True,
+                                config=config, max_score=config["max_possible_oracle_score"]
+                            )
+                            for optim_entry in validation_entries
+                        ]
+                    })
+                    train_dataset.shuffle(seed=42)
+                    validation_dataset.shuffle(seed=42)
+
+                    # early_stopping_callback = CustomEarlyStopCallback(
+                    #     early_stopping_patience=1,
+                    #     early_stopping_threshold=0.0001
+                    # )
+                    model_selection_callback = CustomModelSelectionCallback(best_model_snapshot)
+
+                    model.train()
+                    trainer = SFTTrainer(
+                        model=model,
+                        train_dataset=train_dataset,
+                        eval_dataset=validation_dataset,
+                        formatting_func=lambda x: x["sample"],
+                        args=training_args,
+                        packing=config["rej_sample_config"]["packing"],
+                        tokenizer=tokenizer,
+                        max_seq_length=config["rej_sample_config"]["max_seq_length"],
+                        # data_collator=collator,
+                        callbacks=[model_selection_callback],
+                        optimizers=[optimizer, lr_scheduler],
+                    )
+                    trainer.train()
+                    print(
+                        "Loading the best model weights with validation loss "
+                        f"{model_selection_callback.best_validation_loss}"
+                    )
+                    model_selection_callback.restore_best_model(model)
+                timer.add("fine_tuning", time.perf_counter() - training_start_time)
                 tol_level = 0
-                prev_train_iter = num_iter
\ No newline at end of file
+                prev_train_iter = num_iter
+                num_trainings += 1
+                if generation_stream is not None:
+                    # the unfinished rows were decoded with the weights before training
+                    generation_stream.close()
+                    generation_stream = None
+
+        num_outer_iters += 1
+        if checkpointer is not None and num_outer_iters % config.get("checkpoint_every", 1) == 0:
+            with timer.phase("checkpoint"):
+                save_checkpoint()
+        end_iteration(generation_stats)
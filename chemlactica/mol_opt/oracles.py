@@ -0,0 +1,252 @@
+from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+import os
+import sqlite3
+import threading
+from chemlactica.mol_opt.featurization import featurize
+
+
+class ThreadPoolOracle:
+    """
+        Adds the asynchronous interface used by optimize to an oracle that only implements
+        __call__: `submit(molecules)` returns a future with the scores, computed in a thread.
+        Every other attribute (mol_buffer, budget, finish, takes_entry, ...) is read from the
+        wrapped oracle. With a single worker the batches are scored in submission order,
+        so oracles that are not thread-safe can be wrapped as they are.
+
+        Oracles that score in a process pool (or on a remote service) should implement
+        `submit` themselves and keep their mol_buffer up to date when a batch is done.
+    """
+
+    def __init__(self, oracle, max_workers: int = 1):
+        self.oracle = oracle
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __call__(self, molecules):
+        return self.oracle(molecules)
+
+    def submit(self, molecules) -> Future:
+        return self.executor.submit(self.oracle, molecules)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def __len__(self):
+        return len(self.oracle)
+
+    def __getattr__(self, name):
+        return getattr(self.oracle, name)
+
+
+class OracleCache:
+    """
+        Oracle scores stored on disk in a sqlite database, keyed by the oracle (its name and
+        version) and the canonical SMILES. Several processes (seeds, hyperparameter trials)
+        can use the same file: the database is in WAL mode, so readers do not block the
+        writer, and writers wait for each other up to `timeout` seconds.
+        Every process and thread opens its own connection, `close` closes the connections
+        of all the threads of the process.
+    """
+
+    # sqlite limits the number of parameters of a statement
+    MAX_VARIABLES = 500
+
+    def __init__(self, path: str, timeout: float = 60.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections: List[sqlite3.Connection] = []
+        self.connections_pid = os.getpid()
+        # connections opened before the last close are not used again
+        self.epoch = 0
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS scores ("
+                "oracle TEXT NOT NULL, smiles TEXT NOT NULL, score REAL, "
+                "PRIMARY KEY (oracle, smiles)) WITHOUT ROWID"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid() or self.local.epoch != self.epoch:
+            # a connection must not be used in a forked child
+            # each connection is used by one thread, but close runs in another
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with self.lock:
+                if self.connections_pid != os.getpid():
+                    # the connections of the parent belong to the parent
+                    self.connections, self.connections_pid = [], os.getpid()
+                self.connections.append(connection)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+            self.local.epoch = self.epoch
+        return connection
+
+    def get(self, oracle_key: str, smiles_list: List[str]) -> Dict[str, float]:
+        """
+            The cached scores of the SMILES that are in the cache.
+        """
+        connection = self._connection()
+        scores = {}
+        smiles_list = list(dict.fromkeys(smiles_list))
+        for start in range(0, len(smiles_list), self.MAX_VARIABLES):
+            chunk = smiles_list[start:start + self.MAX_VARIABLES]
+            scores.update(connection.execute(
+                f"SELECT smiles, score FROM scores WHERE oracle = ? "
+                f"AND smiles IN ({', '.join('?' * len(chunk))})",
+                [oracle_key, *chunk]
+            ))
+        return scores
+
+    def put(self, oracle_key: str, scores: Dict[str, float]):
+        """
+            Inserts the scores in one transaction, the scores that are cached already are kept.
+        """
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO scores (oracle, smiles, score) VALUES (?, ?, ?)",
+                [(oracle_key, smiles, float(score)) for smiles, score in scores.items()]
+            )
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def close(self):
+        """
+            Closes the connections that the threads of this process opened.
+        """
+        with self.lock:
+            connections, self.connections = self.connections, []
+            if self.connections_pid != os.getpid():
+                connections = []
+            self.epoch += 1
+        for connection in connections:
+            connection.close()
+        self.local.connection = None
+
+
+def default_oracle_key(oracle) -> str:
+    while isinstance(oracle, (ThreadPoolOracle, CachedOracle)):
+        oracle = oracle.oracle
+    return f"{type(oracle).__module__}.{type(oracle).__qualname__}:{getattr(oracle, 'version', 0)}"
+
+
+class CachedOracle:
+    """
+        Looks the molecules up in an OracleCache before scoring them with `oracle`, only the
+        molecules that are not cached are passed to it and their scores are added to the
+        cache. `oracle_key` identifies the oracle and its version in the cache, by default
+        the class name and its `version` attribute: change it when the scoring changes.
+
+        With `count_hits` the cached molecules are recorded in the mol_buffer of the oracle
+        like scored ones (after the molecules of the batch that were scored), so they take
+        oracle budget as the benchmarks require. Otherwise they are free and recorded in
+        `free_hits` instead, which optimize checks like the mol_buffer so it does not
+        submit them again. As the example oracles log their progress from `__call__` every
+        `log_interval` scored molecules, `log_intermediate` of the wrapped oracle (when it has
+        one) is called when the counted hits reach such a multiple.
+        Every other attribute is read from the wrapped oracle. Like ThreadPoolOracle the
+        wrapper has `submit` only when the wrapped oracle has it.
+    """
+
+    log_interval = 100
+
+    def __init__(self, oracle, cache: OracleCache, oracle_key: Optional[str] = None,
+                 count_hits: bool = True):
+        self.oracle = oracle
+        self.cache = cache
+        self.oracle_key = oracle_key or default_oracle_key(oracle)
+        self.count_hits = count_hits
+        self.hits = 0
+        self.misses = 0
+        self.free_hits: Dict[str, float] = {}
+
+    def _lookup(self, molecules):
+        smiles_list = []
+        for molecule in molecules:
+            if isinstance(molecule, str):
+                try:
+                    molecule = featurize(molecule).smiles
+                except ValueError:
+                    pass
+                smiles_list.append(molecule)
+            else:
+                smiles_list.append(molecule.smiles)
+        mol_buffer = self.oracle.mol_buffer
+        # molecules that this run scored already are left to the oracle
+        cached_scores = self.cache.get(
+            self.oracle_key, [smiles for smiles in smiles_list if smiles not in mol_buffer]
+        )
+        missing = [
+            i for i, smiles in enumerate(smiles_list) if smiles not in cached_scores
+        ]
+        return smiles_list, cached_scores, missing
+
+    def _record(self, molecules, smiles_list, cached_scores, missing, missing_scores):
+        self.cache.put(self.oracle_key, {
+            smiles_list[i]: score for i, score in zip(missing, missing_scores)
+            if score is not None
+        })
+        self.misses += len(missing)
+        self.hits += len(smiles_list) - len(missing)
+        scores = [None] * len(molecules)
+        for i, score in zip(missing, missing_scores):
+            scores[i] = score
+        mol_buffer = self.oracle.mol_buffer
+        for i, smiles in enumerate(smiles_list):
+            if scores[i] is not None or smiles not in cached_scores:
+                continue
+            scores[i] = cached_scores[smiles]
+            if smiles in mol_buffer:
+                continue
+            if self.count_hits:
+                mol_buffer[smiles] = [scores[i], len(mol_buffer) + 1]
+                if len(mol_buffer) % self.log_interval == 0 and hasattr(
+                    self.oracle, "log_intermediate"
+                ):
+                    self.oracle.log_intermediate()
+            else:
+                self.free_hits[smiles] = scores[i]
+        return scores
+
+    def __call__(self, molecules):
+        smiles_list, cached_scores, missing = self._lookup(molecules)
+        missing_scores = self.oracle([molecules[i] for i in missing]) if missing else []
+        return self._record(molecules, smiles_list, cached_scores, missing, missing_scores)
+
+    def _submit(self, molecules) -> Future:
+        smiles_list, cached_scores, missing = self._lookup(molecules)
+        future = Future()
+
+        def record(oracle_future):
+            try:
+                future.set_result(self._record(
+                    molecules, smiles_list, cached_scores, missing, oracle_future.result()
+                ))
+            except Exception as error:
+                future.set_exception(error)
+        # submitted even without missing molecules, the hits are recorded in the mol_buffer
+        # after the batches submitted before
+        self.oracle.submit([molecules[i] for i in missing]).add_done_callback(record)
+        return future
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def __len__(self):
+        return len(self.oracle)
+
+    def __getattr__(self, name):
+        if name == "submit" and hasattr(self.oracle, "submit"):
+            return self._submit
+        return getattr(self.oracle, name)
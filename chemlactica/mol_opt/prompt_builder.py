@@ -0,0 +1,127 @@
+from typing import List
+import torch
+from transformers import BatchEncoding
+
+
+class PromptBuilder:
+    """
+        Builds the input_ids and attention_mask of a batch of prompts from the segments of
+        OptimEntry.to_prompt_segments without running the tokenizer on whole prompts.
+        Token ids are cached per fragment (tags, SMILES of the pool molecules, formatted
+        numbers), so a molecule that appears in many prompts is tokenized once.
+
+        Prompts longer than `max_length` tokens lose their leading molecule segments
+        until they fit, only a last segment that is too long on its own is cut.
+        The first prompt is checked against the tokenizer, if the fragment tokenization
+        does not reproduce it the builder falls back to tokenizing whole prompts.
+    """
+
+    def __init__(self, tokenizer, max_length: int, max_cache_size: int = 500000):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.max_cache_size = max_cache_size
+        self.token_ids = {}
+        self.hits = 0
+        self.misses = 0
+        self.verified = False
+        self.use_tokenizer = False
+
+        # special tokens the tokenizer adds around a text, e.g. bos
+        with_special = tokenizer("x")["input_ids"]
+        without_special = tokenizer("x", add_special_tokens=False)["input_ids"]
+        start = 0
+        while with_special[start:start + len(without_special)] != without_special:
+            start += 1
+        self.prefix_ids = with_special[:start]
+        self.suffix_ids = with_special[start + len(without_special):]
+
+    def _cache_fragments(self, fragments):
+        missing = list({fragment for fragment in fragments if fragment not in self.token_ids})
+        self.hits += len(fragments) - len(missing)
+        self.misses += len(missing)
+        if not missing:
+            return
+        if len(self.token_ids) + len(missing) > self.max_cache_size:
+            self.token_ids.clear()
+            missing = list(set(fragments))
+        encoded = self.tokenizer(missing, add_special_tokens=False)["input_ids"]
+        for fragment, token_ids in zip(missing, encoded):
+            self.token_ids[fragment] = token_ids
+
+    def _segment_ids(self, segment: List[str]):
+        token_ids = []
+        for fragment in segment:
+            token_ids.extend(self.token_ids[fragment])
+        return token_ids
+
+    def _prompt_ids(self, segments: List[List[str]]):
+        budget = self.max_length - len(self.prefix_ids) - len(self.suffix_ids)
+        segment_ids = [self._segment_ids(segment) for segment in segments]
+        length = sum(len(token_ids) for token_ids in segment_ids)
+        first = 0
+        while length > budget and first < len(segment_ids) - 1:
+            length -= len(segment_ids[first])
+            first += 1
+        prompt_ids = [token_id for token_ids in segment_ids[first:] for token_id in token_ids]
+        if len(prompt_ids) > budget:
+            prompt_ids = prompt_ids[len(prompt_ids) - budget:]
+        return self.prefix_ids + prompt_ids + self.suffix_ids
+
+    def _verify(self, segments: List[List[str]]):
+        prompt = "".join("".join(segment) for segment in segments)
+        expected = self.tokenizer(prompt)["input_ids"]
+        if len(expected) > self.max_length:
+            return
+        if expected != self._prompt_ids(segments):
+            print(
+                "Fragment tokenization differs from the tokenizer output, "
+                "falling back to tokenizing whole prompts."
+            )
+            self.use_tokenizer = True
+        self.verified = True
+
+    def prompts_ids(self, prompts_segments: List[List[List[str]]]) -> List[List[int]]:
+        self._cache_fragments([
+            fragment
+            for segments in prompts_segments
+            for segment in segments
+            for fragment in segment
+        ])
+        if not self.verified:
+            self._verify(prompts_segments[0])
+
+        if self.use_tokenizer:
+            prompts = [
+                "".join("".join(segment) for segment in segments)
+                for segments in prompts_segments
+            ]
+            return [
+                prompt_ids[-self.max_length:]
+                for prompt_ids in self.tokenizer(prompts)["input_ids"]
+            ]
+        return [self._prompt_ids(segments) for segments in prompts_segments]
+
+    def collate(self, all_prompt_ids: List[List[int]]) -> BatchEncoding:
+        max_length = max(len(prompt_ids) for prompt_ids in all_prompt_ids)
+        input_ids = torch.full((len(all_prompt_ids), max_length), self.tokenizer.pad_token_id)
+        attention_mask = torch.zeros((len(all_prompt_ids), max_length), dtype=torch.long)
+        for i, prompt_ids in enumerate(all_prompt_ids):
+            if self.tokenizer.padding_side == "left":
+                positions = slice(max_length - len(prompt_ids), max_length)
+            else:
+                positions = slice(0, len(prompt_ids))
+            input_ids[i, positions] = torch.tensor(prompt_ids)
+            attention_mask[i, positions] = 1
+        return BatchEncoding({"input_ids": input_ids, "attention_mask": attention_mask})
+
+    def __call__(self, prompts_segments: List[List[List[str]]]) -> BatchEncoding:
+        return self.collate(self.prompts_ids(prompts_segments))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.token_ids),
+        }
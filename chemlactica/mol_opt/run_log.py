@@ -0,0 +1,210 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
+import json
+import queue
+import sys
+import threading
+
+LOG_FORMATS = ["text", "jsonl"]
+
+
+class PoolDiffer:
+    """
+        Turns pool snapshots, lists of (smiles, score) ordered like the pool, into diffs
+        against the previous snapshot and back. A diff removes the molecules that left the
+        pool and inserts the new ones at their positions, in increasing position order, which
+        rebuilds the snapshot as long as the molecules that stayed keep their relative order
+        (the pool is sorted by score). Otherwise the whole snapshot is written.
+    """
+
+    def __init__(self):
+        self.entries: Optional[List[Tuple[str, float]]] = None
+
+    def diff(self, entries: List[Tuple[str, float]]) -> Dict:
+        previous = self.entries
+        self.entries = entries
+        if previous is None:
+            return {"entries": entries}
+        smiles_set = {smiles for smiles, _ in entries}
+        previous_smiles_set = {smiles for smiles, _ in previous}
+        kept = [entry for entry in previous if entry[0] in smiles_set]
+        if kept != [entry for entry in entries if entry[0] in previous_smiles_set]:
+            return {"entries": entries}
+        return {
+            "removed": [smiles for smiles, _ in previous if smiles not in smiles_set],
+            "added": [
+                [position, smiles, score]
+                for position, (smiles, score) in enumerate(entries)
+                if smiles not in previous_smiles_set
+            ],
+        }
+
+    def apply(self, diff: Dict) -> List[Tuple[str, float]]:
+        if "entries" in diff:
+            self.entries = [tuple(entry) for entry in diff["entries"]]
+            return self.entries
+        removed = set(diff["removed"])
+        entries = [entry for entry in self.entries if entry[0] not in removed]
+        for position, smiles, score in diff["added"]:
+            entries.insert(position, (smiles, score))
+        self.entries = entries
+        return entries
+
+
+def _format_entries(title, entries):
+    lines = [f"{title}\n"]
+    for i, (smiles, score) in enumerate(entries):
+        lines.append(f"\t{i} smiles: {smiles}, score: {score:.4f}\n")
+    return "".join(lines)
+
+
+def format_event(event: Dict, pool_differ: PoolDiffer) -> str:
+    """
+        The lines of the text log for a JSONL event.
+    """
+    if event["event"] == "generated":
+        return "".join(
+            f"generated smiles: {smiles}, score: {score:.4f}\n"
+            for smiles, score in event["molecules"]
+        )
+    if event["event"] == "pool":
+        return _format_entries("Pool", pool_differ.apply(event))
+    if event["event"] == "training":
+        return (
+            _format_entries("Training entries", event["train"])
+            + _format_entries("Validation entries", event["validation"])
+        )
+    raise ValueError(f"Unknown run log event: {event['event']}")
+
+
+class RunLogWriter:
+    """
+        Writes the run log of optimize from a background thread. The optimize loop only puts
+        the scored molecules, pool snapshots and training entries into a queue of at most
+        `max_queue_size` events (it blocks when the writer falls behind), the formatting and
+        writing happen in the writer. `log_format` "jsonl" writes one compact JSON event per
+        line with the pool as a diff to the previous snapshot, "text" writes the text view,
+        which format_run_log also rebuilds from a JSONL log.
+    """
+
+    def __init__(self, path: str, log_format: str = "text", append: bool = False,
+                 max_queue_size: int = 1024):
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"log_format must be one of {LOG_FORMATS}, got {log_format}")
+        self.file = open(path, "a" if append else "w")
+        self.log_format = log_format
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.pool_differ = PoolDiffer()
+        self.error = None
+        # a daemon, so a run that raises does not hang at exit
+        self.thread = threading.Thread(target=self._write_events, daemon=True)
+        self.thread.start()
+
+    def _write_events(self):
+        while True:
+            event = self.queue.get()
+            try:
+                if event is None:
+                    self.file.flush()
+                    return
+                if event == "flush":
+                    self.file.flush()
+                    continue
+                if self.error is not None:
+                    continue
+                if self.log_format == "jsonl":
+                    if event["event"] == "pool":
+                        event.update(self.pool_differ.diff(event.pop("snapshot")))
+                    self.file.write(json.dumps(event) + "\n")
+                elif event["event"] == "pool":
+                    self.file.write(_format_entries("Pool", event["snapshot"]))
+                else:
+                    self.file.write(format_event(event, self.pool_differ))
+                if self.queue.empty():
+                    self.file.flush()
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _put(self, event):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(event)
+
+    def generated(self, molecules: List[Tuple[str, float]]):
+        self._put({"event": "generated", "molecules": molecules})
+
+    def pool(self, optim_entries, iteration: int):
+        self._put({
+            "event": "pool", "iteration": iteration,
+            "snapshot": [
+                (optim_entry.last_entry.smiles, optim_entry.last_entry.score)
+                for optim_entry in optim_entries
+            ],
+        })
+
+    def training(self, train_entries, validation_entries, iteration: int):
+        self._put({
+            "event": "training", "iteration": iteration,
+            **{
+                name: [
+                    (optim_entry.last_entry.smiles, optim_entry.last_entry.score)
+                    for optim_entry in entries
+                ]
+                for name, entries in [("train", train_entries), ("validation", validation_entries)]
+            },
+        })
+
+    def flush(self):
+        """
+            Waits until the queued events are written and flushed to the file.
+        """
+        self._put("flush")
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+def read_run_log(path: str) -> Iterator[Dict]:
+    """
+        The events of a JSONL run log, pool diffs are returned as written. A run resumed from
+        a checkpoint appends to the log, starting with a whole pool snapshot.
+    """
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a run that was killed while writing
+                if line.endswith("\n"):
+                    raise
+                return
+
+
+def format_run_log(path: str, output=None):
+    """
+        Writes the text view of a JSONL run log to `output` (stdout by default).
+    """
+    output = output or sys.stdout
+    pool_differ = PoolDiffer()
+    for event in read_run_log(path):
+        output.write(format_event(event, pool_differ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the text view of a JSONL run log.")
+    parser.add_argument("path", type=str)
+    format_run_log(parser.parse_args().path)
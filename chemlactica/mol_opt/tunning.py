@@ -6,7 +6,9 @@ import torch
 import math
 import time
 from collections import OrderedDict
+from typing import Optional
 from chemlactica.mol_opt.utils import generate_random_number
+from chemlactica.mol_opt.prompt_builder import PromptBuilder
 
 
 class CustomEarlyStopCallback(TrainerCallback):
@@ -35,21 +37,221 @@ class CustomEarlyStopCallback(TrainerCallback):
         return super().on_evaluate(args, state, control, **kwargs)
 
 
+class ModelSnapshot:
+    """
+        Copy of the weights of a model kept in buffers that are allocated on the first save
+        and reused by every later one. By default the buffers are in host memory, pinned
+        when the model is on a GPU so that the copies do not block; device=None keeps them
+        on the model's device instead, which is faster but takes a second copy of the
+        weights in device memory. With trainable_only only the parameters that require grad
+        are kept (e.g. adapter weights). Tensors sharing storage (tied embeddings) are copied
+        once.
+    """
+
+    def __init__(self, device: Optional[str] = "cpu", trainable_only: bool = False):
+        self.device = device
+        self.trainable_only = trainable_only
+        self.buffers: OrderedDict = OrderedDict()
+        self.num_saves = 0
+
+    def _tensors(self, model):
+        if self.trainable_only:
+            named_tensors = [
+                (name, param) for name, param in model.named_parameters() if param.requires_grad
+            ]
+        else:
+            named_tensors = model.state_dict(keep_vars=True).items()
+        tensors = OrderedDict()
+        seen_storages = set()
+        for name, tensor in named_tensors:
+            storage = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tensor.shape)
+            if storage not in seen_storages:
+                seen_storages.add(storage)
+                tensors[name] = tensor
+        return tensors
+
+    def _allocate(self, tensors):
+        for name, tensor in tensors.items():
+            if self.device == "cpu":
+                self.buffers[name] = torch.empty(
+                    tensor.shape, dtype=tensor.dtype, device="cpu",
+                    pin_memory=tensor.device.type == "cuda"
+                )
+            else:
+                self.buffers[name] = torch.empty_like(tensor, device=self.device or tensor.device)
+
+    @property
+    def nbytes(self):
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    @torch.no_grad()
+    def save(self, model):
+        tensors = self._tensors(model)
+        if not self.buffers:
+            self._allocate(tensors)
+        for name, tensor in tensors.items():
+            self.buffers[name].copy_(tensor.detach(), non_blocking=True)
+        self.num_saves += 1
+
+    @torch.no_grad()
+    def restore(self, model):
+        """
+            Copies the saved weights back into the parameters of `model` in place.
+        """
+        if not self.num_saves:
+            return
+        tensors = self._tensors(model)
+        for name, buffer in self.buffers.items():
+            tensors[name].detach().copy_(buffer, non_blocking=True)
+        if any(buffer.is_pinned() for buffer in self.buffers.values()):
+            torch.cuda.synchronize()
+
+    def clear(self):
+        # keeps the buffers, the next save overwrites them
+        self.num_saves = 0
+
+
 class CustomModelSelectionCallback(TrainerCallback):
 
-    def __init__(self):
+    def __init__(self, snapshot: ModelSnapshot = None):
         super().__init__()
         self.best_validation_loss: float = math.inf
-        self.best_model_state_dict: OrderedDict = OrderedDict()
+        self.snapshot = snapshot if snapshot is not None else ModelSnapshot()
+        self.snapshot.clear()
 
     def on_evaluate(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, metrics, model, **kwargs):
         if metrics["eval_loss"] <= self.best_validation_loss:
             self.best_validation_loss = metrics["eval_loss"]
-            print(f"Better validation loss achieved {self.best_validation_loss}, updating the state dict.")
-            for key, value in model.state_dict().items():
-                self.best_model_state_dict[key] = value.detach().clone()
+            print(
+                f"Better validation loss achieved {self.best_validation_loss}, "
+                "updating the snapshot."
+            )
+            self.snapshot.save(model)
         return super().on_evaluate(args, state, control, **kwargs)
 
+    def restore_best_model(self, model):
+        self.snapshot.restore(model)
+
+
+class FineTuningEngine:
+    """
+        Fine-tunes the model on the pool in the rejection-sampling rounds of optimize.
+        It is created once per run: the token ids of the training prompts are cached per
+        fragment by a PromptBuilder (only new pool entries are tokenized), and the optimizer
+        and lr_scheduler are stepped directly, without a new Trainer and dataloader per round.
+
+        Every optimizer step takes train_batch_size * gradient_accumulation_steps examples,
+        split into micro-batches of at most max_tokens_per_batch padded tokens (examples of
+        similar length are put together). The loss is the mean over the target tokens of
+        the step. After every epoch the validation loss is computed, the weights with the
+        best one are kept in `snapshot` and restored at the end of the round.
+    """
+
+    def __init__(
+            self, model, tokenizer,
+            optimizer, lr_scheduler, config,
+            snapshot: ModelSnapshot = None
+    ):
+        self.model = model
+        self.optimizer = optimizer
+        self.lr_scheduler = lr_scheduler
+        self.pad_token_id = tokenizer.pad_token_id
+        self.prompt_builder = PromptBuilder(tokenizer, max_length=config["max_seq_length"])
+        self.num_train_epochs = config["num_train_epochs"]
+        self.examples_per_step = config["train_batch_size"] * config["gradient_accumulation_steps"]
+        self.max_grad_norm = config["global_gradient_norm"]
+        self.max_tokens_per_batch = config.get("max_tokens_per_batch") or (
+            config["train_batch_size"] * config["max_seq_length"]
+        )
+        self.snapshot = snapshot if snapshot is not None else ModelSnapshot()
+        self.num_steps = 0
+
+    def _micro_batches(self, examples):
+        order = sorted(range(len(examples)), key=lambda i: len(examples[i]))
+        micro_batches = [[]]
+        for i in order:
+            # sorted by length, so the current example is the longest of the micro-batch
+            padded_length = (len(micro_batches[-1]) + 1) * len(examples[i])
+            if micro_batches[-1] and padded_length > self.max_tokens_per_batch:
+                micro_batches.append([])
+            micro_batches[-1].append(examples[i])
+        return [micro_batch for micro_batch in micro_batches if micro_batch]
+
+    def _collate(self, micro_batch):
+        max_length = max(len(token_ids) for token_ids in micro_batch)
+        input_ids = torch.full((len(micro_batch), max_length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(micro_batch), max_length), dtype=torch.long)
+        for i, token_ids in enumerate(micro_batch):
+            input_ids[i, :len(token_ids)] = torch.tensor(token_ids)
+            attention_mask[i, :len(token_ids)] = 1
+        return input_ids.to(self.model.device), attention_mask.to(self.model.device)
+
+    def _loss_sum(self, micro_batch):
+        input_ids, attention_mask = self._collate(micro_batch)
+        logits = self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+        labels = input_ids[:, 1:].masked_fill(attention_mask[:, 1:] == 0, -100)
+        return torch.nn.functional.cross_entropy(
+            logits[:, :-1].flatten(0, 1).float(), labels.flatten(),
+            ignore_index=-100, reduction="sum"
+        )
+
+    def _train_step(self, examples):
+        num_tokens = sum(len(token_ids) - 1 for token_ids in examples)
+        step_loss = 0.0
+        for micro_batch in self._micro_batches(examples):
+            loss = self._loss_sum(micro_batch) / max(num_tokens, 1)
+            loss.backward()
+            step_loss += loss.item()
+        if self.max_grad_norm:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+        self.optimizer.step()
+        self.lr_scheduler.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.num_steps += 1
+        return step_loss
+
+    @torch.no_grad()
+    def evaluate(self, examples):
+        self.model.eval()
+        num_tokens = sum(len(token_ids) - 1 for token_ids in examples)
+        loss_sum = sum(
+            self._loss_sum(micro_batch).item() for micro_batch in self._micro_batches(examples)
+        )
+        self.model.train()
+        return loss_sum / num_tokens if num_tokens else math.inf
+
+    def train(self, train_prompts_segments, validation_prompts_segments):
+        """
+            Runs one round of fine-tuning on the prompts given as OptimEntry.to_prompt_segments,
+            returns the best validation loss.
+        """
+        train_examples = self.prompt_builder.prompts_ids(train_prompts_segments)
+        validation_examples = self.prompt_builder.prompts_ids(validation_prompts_segments)
+        self.snapshot.clear()
+        best_validation_loss = math.inf
+        self.model.train()
+        for epoch in range(self.num_train_epochs):
+            permutation = torch.randperm(len(train_examples)).tolist()
+            train_loss = 0.0
+            for step_start in range(0, len(permutation), self.examples_per_step):
+                train_loss += self._train_step([
+                    train_examples[i]
+                    for i in permutation[step_start:step_start + self.examples_per_step]
+                ])
+            num_steps = max(math.ceil(len(permutation) / self.examples_per_step), 1)
+            validation_loss = self.evaluate(validation_examples)
+            print(
+                f"Epoch {epoch + 1}/{self.num_train_epochs}, "
+                f"train loss: {train_loss / num_steps:.4f}, "
+                f"validation loss: {validation_loss:.4f}, "
+                f"lr: {self.lr_scheduler.get_last_lr()[0]:.2e}"
+            )
+            if validation_loss <= best_validation_loss:
+                best_validation_loss = validation_loss
+                self.snapshot.save(self.model)
+        self.snapshot.restore(self.model)
+        return best_validation_loss
+
 
 # class CustomSFTTrainer(SFTTrainer):
 # 
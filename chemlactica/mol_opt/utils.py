@@ -1,12 +1,15 @@
-from typing import List
+from typing import List, Dict
+import bisect
 import datetime
 import os
 import random
 from pathlib import Path
 import numpy as np
 import torch
-from rdkit import Chem, DataStructs, RDLogger
+from rdkit import DataStructs, RDLogger
 from rdkit.Chem import AllChem, MACCSkeys, rdMolDescriptors
+from chemlactica.mol_opt.fingerprints import FingerprintMatrix
+from chemlactica.mol_opt.featurization import featurize, featurization_cache, MoleculeFeatures
 
 # Disable RDKit logs
 RDLogger.DisableLog("rdApp.*")
@@ -49,9 +52,7 @@ def generate_random_number(lower, upper):
 
 
 def canonicalize(smiles):
-    mol = Chem.MolFromSmiles(smiles)
-    return Chem.MolToSmiles(mol, canonical=True)
-    # return Chem.MolToSmiles(Chem.MolFromSmiles(smiles), kekuleSmiles=True)
+    return featurize(smiles).smiles
 
 
 class MoleculeEntry:
@@ -59,12 +60,20 @@ class MoleculeEntry:
         self.smiles = smiles
         self.score = score
         self.similar_mol_entries = []
+        self.features = None
         if smiles:
-            self.smiles = canonicalize(smiles)
-            self.mol = Chem.MolFromSmiles(smiles)
-            self.fingerprint = get_morgan_fingerprint(self.mol)
+            self.features = featurize(smiles)
+            self.smiles = self.features.smiles
         self.add_props = kwargs
 
+    @property
+    def mol(self):
+        return self.features.mol
+
+    @property
+    def fingerprint(self):
+        return self.features.morgan_fingerprint
+
     def __eq__(self, other):
         return self.smiles == other.smiles
 
@@ -85,11 +94,66 @@ class MoleculeEntry:
         return hash(self.smiles)
 
 
+def _molecule_entry_state(mol_entry, include_similars=True):
+    state = {
+        "smiles": mol_entry.smiles,
+        "score": mol_entry.score,
+        "fingerprint": mol_entry.features.packed_fingerprint.tobytes(),
+        "add_props": list(mol_entry.add_props.keys()),
+    }
+    if include_similars:
+        # similar entries only contribute their SMILES and fingerprint to prompts
+        state["similar_mol_entries"] = [
+            _molecule_entry_state(sim_entry, include_similars=False)
+            for sim_entry in mol_entry.similar_mol_entries
+        ]
+    return state
+
+
+def _molecule_entry_from_state(state, additional_properties):
+    featurization_cache.add(MoleculeFeatures(
+        state["smiles"], packed_fingerprint=np.frombuffer(state["fingerprint"], dtype=np.uint64)
+    ))
+    mol_entry = MoleculeEntry(smiles=state["smiles"], score=state["score"])
+    mol_entry.similar_mol_entries = [
+        _molecule_entry_from_state(sim_state, additional_properties)
+        for sim_state in state.get("similar_mol_entries", [])
+    ]
+    for prop_name in state["add_props"]:
+        if prop_name in additional_properties:
+            prop_spec = additional_properties[prop_name]
+            mol_entry.add_props[prop_name] = prop_spec
+            prop_spec["value"] = prop_spec["calculate_value"](mol_entry)
+    return mol_entry
+
+
+class _DescendingKey:
+    __slots__ = ("mol_entry",)
+
+    def __init__(self, optim_entry):
+        self.mol_entry = optim_entry.last_entry
+
+    def __lt__(self, other):
+        return other.mol_entry < self.mol_entry
+
+
 class Pool:
     def __init__(self, size, validation_perc: float):
         self.size = size
+        # kept sorted by the last entry, the best entry first
         self.optim_entries: List[OptimEntry] = []
+        # the sort keys of optim_entries, bisected without the key argument (python < 3.10)
+        self.sort_keys: List[_DescendingKey] = []
         self.num_validation_entries = int(size * validation_perc + 1)
+        self.num_valid_entries = 0
+        # canonical smiles of the last entry -> pool entry
+        self.smiles_index: Dict[str, OptimEntry] = {}
+        # packed fingerprints of the pool entries
+        self.fingerprints = FingerprintMatrix()
+        self.fingerprint_slots: Dict[str, int] = {}
+        self.slot_entries: Dict[int, OptimEntry] = {}
+        # the strictest similarity threshold the current entries are known to satisfy
+        self.diversity_score = 1.0
 
     # def random_dump(self, num):
     #     for _ in range(num):
@@ -97,44 +161,91 @@ class Pool:
     #         self.molecule_entries.pop(rand_ind)
     #     print(f"Dump {num} random elements from pool, num pool mols {len(self)}")
 
+    def _position(self, optim_entry):
+        return bisect.bisect_left(self.sort_keys, _DescendingKey(optim_entry))
+
+    def _insert(self, optim_entry, slot):
+        smiles = optim_entry.last_entry.smiles
+        position = self._position(optim_entry)
+        self.optim_entries.insert(position, optim_entry)
+        self.sort_keys.insert(position, _DescendingKey(optim_entry))
+        self.smiles_index[smiles] = optim_entry
+        self.fingerprint_slots[smiles] = slot
+        self.slot_entries[slot] = optim_entry
+        if optim_entry.entry_status == EntryStatus.valid:
+            self.num_valid_entries += 1
+
+    def _remove(self, optim_entry):
+        smiles = optim_entry.last_entry.smiles
+        position = self._position(optim_entry)
+        del self.optim_entries[position]
+        del self.sort_keys[position]
+        del self.smiles_index[smiles]
+        slot = self.fingerprint_slots.pop(smiles)
+        del self.slot_entries[slot]
+        self.fingerprints.remove(slot)
+        if optim_entry.entry_status == EntryStatus.valid:
+            self.num_valid_entries -= 1
+
+    def _try_insert(self, optim_entry, diversity_score):
+        """
+            Inserts the entry unless an entry ranked at least as high is the same molecule
+            or is more similar than `diversity_score`, lower ranked conflicting entries are removed.
+        """
+        conflicting_entries = {}
+        same_entry = self.smiles_index.get(optim_entry.last_entry.smiles)
+        if same_entry is not None:
+            if not same_entry.last_entry < optim_entry.last_entry:
+                return False
+            conflicting_entries[id(same_entry)] = same_entry
+
+        slot = self.fingerprints.add(optim_entry.last_entry.features.packed_fingerprint)
+        if diversity_score < 1.0:
+            similar_slots = np.flatnonzero(self.fingerprints.tanimoto_all(slot) > diversity_score)
+            for similar_slot in similar_slots:
+                if similar_slot == slot:
+                    continue
+                similar_entry = self.slot_entries[similar_slot]
+                if not similar_entry.last_entry < optim_entry.last_entry:
+                    self.fingerprints.remove(slot)
+                    return False
+                conflicting_entries[id(similar_entry)] = similar_entry
+
+        for conflicting_entry in conflicting_entries.values():
+            self._remove(conflicting_entry)
+        self._insert(optim_entry, slot)
+        return True
+
     def add(self, entries: List, diversity_score=1.0):
         assert type(entries) == list
-        self.optim_entries.extend(entries)
-        self.optim_entries.sort(key=lambda x: x.last_entry, reverse=True)
-
-        # remove doublicates
-        new_optim_entries = []
-        for entry in self.optim_entries:
-            insert = True
-            for e in new_optim_entries:
-                if (
-                    entry.last_entry == e.last_entry
-                    or tanimoto_dist_func(
-                        entry.last_entry.fingerprint, e.last_entry.fingerprint
-                    )
-                    > diversity_score
-                ):
-                    insert = False
-                    break
-            if insert:
-                new_optim_entries.append(entry)
-
-        self.optim_entries = new_optim_entries[: min(len(new_optim_entries), self.size)]
-        curr_num_validation_entries = sum([entry.entry_status == EntryStatus.valid for entry in self.optim_entries])
-
-        i = 0
-        while curr_num_validation_entries < self.num_validation_entries:
-            if self.optim_entries[i].entry_status == EntryStatus.none:
-                self.optim_entries[i].entry_status = EntryStatus.valid
-                curr_num_validation_entries += 1
-            i += 1
-        
-        for j in range(i, len(self.optim_entries)):
-            if self.optim_entries[j].entry_status == EntryStatus.none:
-                self.optim_entries[j].entry_status = EntryStatus.train
-        
-        curr_num_validation_entries = sum([entry.entry_status == EntryStatus.valid for entry in self.optim_entries])
-        assert curr_num_validation_entries == min(len(self.optim_entries), self.num_validation_entries)
+        if diversity_score < self.diversity_score and self.optim_entries:
+            # the entries in the pool have to be checked against each other again
+            entries = self.optim_entries + entries
+            for optim_entry in list(self.optim_entries):
+                self._remove(optim_entry)
+        self.diversity_score = diversity_score
+
+        # inserting from the best entry to the worst makes the result the same as
+        # greedily deduplicating the sorted union of the pool and the new entries
+        inserted_entries = []
+        for optim_entry in sorted(entries, key=lambda x: x.last_entry, reverse=True):
+            if self._try_insert(optim_entry, diversity_score):
+                inserted_entries.append(optim_entry)
+
+        while len(self.optim_entries) > self.size:
+            self._remove(self.optim_entries[-1])
+
+        # the best new entries fill the validation set if it has missing entries
+        for optim_entry in inserted_entries:
+            if self.smiles_index.get(optim_entry.last_entry.smiles) is not optim_entry:
+                continue
+            if optim_entry.entry_status == EntryStatus.none:
+                if self.num_valid_entries < self.num_validation_entries:
+                    optim_entry.entry_status = EntryStatus.valid
+                    self.num_valid_entries += 1
+                else:
+                    optim_entry.entry_status = EntryStatus.train
+        assert self.num_valid_entries == min(len(self.optim_entries), self.num_validation_entries)
 
     def get_train_valid_entries(self):
         train_entries = []
@@ -158,6 +269,41 @@ class Pool:
     def __len__(self):
         return len(self.optim_entries)
 
+    def state_dict(self):
+        """
+            Plain python state of the pool (SMILES, scores, packed fingerprints and entry statuses),
+            it does not reference the entries so it can be written while the pool changes.
+        """
+        return {
+            "diversity_score": self.diversity_score,
+            "optim_entries": [
+                {
+                    "last_entry": _molecule_entry_state(optim_entry.last_entry),
+                    "mol_entries": [
+                        _molecule_entry_state(mol_entry) for mol_entry in optim_entry.mol_entries
+                    ],
+                    "entry_status": optim_entry.entry_status,
+                }
+                for optim_entry in self.optim_entries
+            ],
+        }
+
+    def load_state_dict(self, state, additional_properties={}):
+        for optim_entry in list(self.optim_entries):
+            self._remove(optim_entry)
+        self.diversity_score = state["diversity_score"]
+        for entry_state in state["optim_entries"]:
+            optim_entry = OptimEntry(
+                _molecule_entry_from_state(entry_state["last_entry"], additional_properties),
+                [
+                    _molecule_entry_from_state(mol_state, additional_properties)
+                    for mol_state in entry_state["mol_entries"]
+                ]
+            )
+            optim_entry.entry_status = entry_state["entry_status"]
+            slot = self.fingerprints.add(optim_entry.last_entry.features.packed_fingerprint)
+            self._insert(optim_entry, slot)
+
 
 def make_output_files_base(input_path, results_dir, run_name, config):
     formatted_date_time = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -172,14 +318,19 @@ def make_output_files_base(input_path, results_dir, run_name, config):
     return output_dir
 
 
-def create_prompt_with_similars(mol_entry: MoleculeEntry, sim_range=None):
-    prompt = ""
+def create_similars_fragments(mol_entry: MoleculeEntry, sim_range=None):
+    fragments = []
     for sim_mol_entry in mol_entry.similar_mol_entries:
         if sim_range:
-            prompt += f"[SIMILAR]{sim_mol_entry.smiles} {generate_random_number(sim_range[0], sim_range[1]):.2f}[/SIMILAR]"  # noqa
+            similarity = generate_random_number(sim_range[0], sim_range[1])
         else:
-            prompt += f"[SIMILAR]{sim_mol_entry.smiles} {tanimoto_dist_func(sim_mol_entry.fingerprint, mol_entry.fingerprint):.2f}[/SIMILAR]"  # noqa
-    return prompt
+            similarity = tanimoto_dist_func(sim_mol_entry.fingerprint, mol_entry.fingerprint)
+        fragments.extend(["[SIMILAR]", sim_mol_entry.smiles, f" {similarity:.2f}", "[/SIMILAR]"])
+    return fragments
+
+
+def create_prompt_with_similars(mol_entry: MoleculeEntry, sim_range=None):
+    return "".join(create_similars_fragments(mol_entry, sim_range=sim_range))
 
 
 class EntryStatus:
@@ -194,42 +345,52 @@ class OptimEntry:
         self.mol_entries: List[MoleculeEntry] = mol_entries
         self.entry_status: EntryStatus = EntryStatus.none
 
-    def to_prompt(
+    def to_prompt_segments(
             self, is_generation: bool,
             include_oracle_score: bool, config,
             max_score
-        ):
-        prompt = ""
-        # prompt = config["eos_token"]
+    ) -> List[List[str]]:
+        """
+            The prompt split into one segment per molecule of mol_entries followed by the segment
+            of last_entry. Every segment is a list of text fragments (tags, SMILES, formatted
+            numbers) which start and end at token boundaries, so they can be tokenized separately.
+        """
+        segments = []
         for mol_entry in self.mol_entries:
-            prompt += config["eos_token"]
-            prompt += create_prompt_with_similars(mol_entry=mol_entry)
+            segment = [config["eos_token"]]
+            segment.extend(create_similars_fragments(mol_entry=mol_entry))
 
             for prop_name, prop_spec in mol_entry.add_props.items():
-                prompt += f"{prop_spec['start_tag']}{prop_spec['value']}{prop_spec['end_tag']}"
-                
+                segment.append(
+                    f"{prop_spec['start_tag']}{prop_spec['value']}{prop_spec['end_tag']}"
+                )
+
             if "default" in config["strategy"]:
                 pass
             elif "rej-sample-v2" in config["strategy"]:
                 if include_oracle_score:
-                    prompt += f"[PROPERTY]oracle_score {mol_entry.score:.2f}[/PROPERTY]"
+                    segment.extend([
+                        "[PROPERTY]oracle_score", f" {mol_entry.score:.2f}", "[/PROPERTY]"
+                    ])
             else:
                 raise Exception(f"Strategy {config['strategy']} not known.")
-            prompt += f"[START_SMILES]{mol_entry.smiles}[END_SMILES]"
+            segment.extend(["[START_SMILES]", mol_entry.smiles, "[END_SMILES]"])
+            segments.append(segment)
 
         assert self.last_entry
-        prompt += config["eos_token"]
+        segment = [config["eos_token"]]
         if is_generation:
-            prompt_with_similars = create_prompt_with_similars(
+            segment.extend(create_similars_fragments(
                 self.last_entry, sim_range=config["sim_range"]
-            )
+            ))
         else:
-            prompt_with_similars = create_prompt_with_similars(self.last_entry)
-
-        prompt += prompt_with_similars
+            segment.extend(create_similars_fragments(self.last_entry))
 
         for prop_name, prop_spec in self.last_entry.add_props.items():
-            prompt += prop_spec["start_tag"] + prop_spec["infer_value"](self.last_entry) + prop_spec["end_tag"]
+            segment.append(
+                prop_spec["start_tag"] + prop_spec["infer_value"](self.last_entry)
+                + prop_spec["end_tag"]
+            )
 
         if "default" in config["strategy"]:
             pass
@@ -242,17 +403,28 @@ class OptimEntry:
             else:
                 oracle_score = self.last_entry.score
             if include_oracle_score:
-                prompt += f"[PROPERTY]oracle_score {oracle_score:.2f}[/PROPERTY]"
+                segment.extend(["[PROPERTY]oracle_score", f" {oracle_score:.2f}", "[/PROPERTY]"])
         else:
             raise Exception(f"Strategy {config['strategy']} not known.")
 
         if is_generation:
-            prompt += "[START_SMILES]"
+            segment.append("[START_SMILES]")
         else:
-            prompt += f"[START_SMILES]{self.last_entry.smiles}[END_SMILES]"
-            prompt += config["eos_token"]
+            segment.extend(["[START_SMILES]", self.last_entry.smiles, "[END_SMILES]"])
+            segment.append(config["eos_token"])
+        segments.append(segment)
 
-        return prompt
+        return segments
+
+    def to_prompt(
+            self, is_generation: bool,
+            include_oracle_score: bool, config,
+            max_score
+        ):
+        segments = self.to_prompt_segments(
+            is_generation, include_oracle_score, config, max_score
+        )
+        return "".join("".join(segment) for segment in segments)
 
     def contains_entry(self, mol_entry: MoleculeEntry):
         for entry in self.mol_entries:
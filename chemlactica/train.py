@@ -3,7 +3,6 @@ import random
 
 # import signal
 import traceback
-import multiprocessing
 from datetime import timedelta
 from contextlib import nullcontext
 
@@ -43,6 +42,7 @@ from chemlactica.utils.utils import get_model_train_config
 from chemlactica.utils.distributed_utils import get_experiment_hash
 from chemlactica.utils.flop_counter import get_theoretical_peak_flops
 from chemlactica.get_dataset import get_dataset
+from chemlactica.jsonl_dataset import JsonlPositions, jsonl_files
 from chemlactica.get_trainer import get_trainer
 
 torch.manual_seed(42)
@@ -192,10 +192,14 @@ def train(
     )
     accelerator.wait_for_everyone()
 
-    with multiprocessing.Manager() as manager:
-        shared_jsonl_files = None
+    shared_jsonl_files = None
+    if train_type == "pretrain":
+        # the readers of the dataloader workers record their positions in shared memory
+        shared_jsonl_files = JsonlPositions(
+            [file for directory in training_data_dirs for file in jsonl_files(directory)]
+        )
+    with shared_jsonl_files if shared_jsonl_files is not None else nullcontext():
         if train_type == "pretrain":
-            shared_jsonl_files = manager.dict()
             trainer_callback_dict[
                 "json_dataset_resume_callback"
             ] = JsonlDatasetResumeCallback(shared_jsonl_files)
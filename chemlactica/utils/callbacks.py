@@ -8,6 +8,7 @@ import json
 from .dataset_utils import process_dataset
 from datasets import load_dataset
 from .model_utils import load_model
+from .numerical_eval import predict_properties_sharded
 from tqdm.auto import tqdm
 from sklearn.metrics import root_mean_squared_error
 
@@ -341,6 +342,13 @@ class EarlyStoppingCallback(TrainerCallback):
 
 
 class SFTNumericalEval(TrainerCallback):
+    """
+        RMSE of the activity the model generates for the validation molecules. Every rank
+        generates for an equal share of the molecules in batches, in step with the other
+        ranks, the predictions are gathered and the RMSE is computed and tracked on the
+        main process.
+    """
+
     def __init__(self, dataset, aim_callback, separator_token) -> None:
         super().__init__()
         self.dataset = dataset
@@ -358,35 +366,22 @@ class SFTNumericalEval(TrainerCallback):
     ):
         super().on_evaluate(args, state, control, **kwargs)
         model.eval()
-        ground_truths, gens, diffs = [], [], []
-        eos_token_id = tokenizer.encode("[/PROPERTY]")[0]
-        for sample in self.dataset["validation"]:
-            ground_truth = round(sample["activity"], 2)
-            prompt = (
-                f"{self.separator_token}[START_SMILES]{sample['smiles']}"
-                "[END_SMILES][PROPERTY]activity"
-            )
-            prompt = tokenizer(prompt, return_tensors="pt").to(model.device)
-            out = model.generate(
-                prompt.input_ids,
-                do_sample=False,
-                eos_token_id=eos_token_id,
-                max_new_tokens=100,
-            )
-            out = tokenizer.batch_decode(out)[0]
-            try:
-                gen = out[
-                    out.find("activity ")
-                    + len("activity ") : out.find("[/PROPERTY]")  # noqa
-                ]
-                gen = float(gen)
-                diff = abs(ground_truth - gen)
-                ground_truths.append(ground_truth)
-                gens.append(gen)
-                diffs.append(diff)
-            except ValueError:
-                print(f"could not generate for {sample['smiles']}")
-                pass
+        validation = self.dataset["validation"]
+        predictions = predict_properties_sharded(
+            model, tokenizer, validation["smiles"], self.separator_token,
+            args.process_index, args.world_size, batch_size=args.per_device_eval_batch_size
+        )
+        if not state.is_world_process_zero:
+            return
+        ground_truths, gens = [], []
+        for smiles, activity, prediction in zip(
+            validation["smiles"], validation["activity"], predictions
+        ):
+            if prediction is None:
+                print(f"could not generate for {smiles}")
+                continue
+            ground_truths.append(round(activity, 2))
+            gens.append(prediction)
         rmse = root_mean_squared_error(ground_truths, gens)
         self.aim._run.track({"numerical eval rmse": rmse}, step=state.global_step)
         print(f"{rmse=}")
@@ -0,0 +1,62 @@
+from typing import Iterable, Optional
+import os
+import torch
+import torch.nn as nn
+
+
+def available_cpus() -> int:
+    # the cpus of the job, not of the node
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_cpu_threads(num_threads: Optional[int] = None) -> int:
+    """
+        Uses `num_threads` (all the cpus of the job by default) for the matrix products
+        of a forward pass. Generation runs one forward at a time, so a single inter-op
+        thread is enough.
+    """
+    num_threads = num_threads or available_cpus()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set before the first parallel work of the process
+        pass
+    return num_threads
+
+
+def quantize_int8(
+    model: nn.Module,
+    num_threads: Optional[int] = None,
+    skip_modules: Iterable[str] = ("lm_head",)
+) -> nn.Module:
+    """
+        Converts a causal LM for inference on CPU: the weights of the linear layers are
+        stored in int8 and the activations are quantized on the fly (dynamic quantization).
+        The modules named in `skip_modules` stay in float32, so the lm_head keeps float32
+        logits like LinearFloat32. Works for the OPT/Galactica, Gemma and Mistral models.
+        The model is converted in place (to float32 on CPU first, without a copy of the
+        weights) and can only be used for inference afterwards.
+    """
+    configure_cpu_threads(num_threads)
+    if "fbgemm" in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = "fbgemm"
+    model = model.to(device="cpu", dtype=torch.float32).eval()
+    skip_modules = set(skip_modules)
+    linear_names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and name.split(".")[-1] not in skip_modules
+    }
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {name: torch.ao.quantization.default_dynamic_qconfig for name in linear_names},
+        dtype=torch.qint8, inplace=True
+    )
+
+
+def is_quantized(model: nn.Module) -> bool:
+    return any(
+        isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in model.modules()
+    )
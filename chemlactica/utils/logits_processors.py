@@ -1,4 +1,6 @@
+from array import array
 from transformers import LogitsProcessor
+import numpy as np
 import torch
 from typing import List, Union
 
@@ -86,3 +88,350 @@ class SequentialDecayProcessor(LogitsProcessor):
                 penalties[:, token_id] = penalty
                 scores_processed = scores + penalties
         return scores_processed
+
+
+# SMILES syntax states, the state is what the last character was
+(
+    SMILES_START, SMILES_ATOM, SMILES_ATOM_B, SMILES_ATOM_C, SMILES_BOND,
+    SMILES_BRANCH_OPEN, SMILES_BRANCH_CLOSE, SMILES_DOT, SMILES_BRACKET_OPEN,
+    SMILES_BRACKET_BODY, SMILES_PERCENT,
+) = range(11)
+# after "%d", one state per first digit of the ring number
+SMILES_PERCENT_DIGIT = 11
+NUM_SMILES_STATES = SMILES_PERCENT_DIGIT + 10
+SMILES_INVALID = -1
+
+SMILES_ATOMS = {
+    "B": SMILES_ATOM_B, "C": SMILES_ATOM_C, "N": SMILES_ATOM, "O": SMILES_ATOM,
+    "P": SMILES_ATOM, "S": SMILES_ATOM, "F": SMILES_ATOM, "I": SMILES_ATOM,
+    "b": SMILES_ATOM, "c": SMILES_ATOM, "n": SMILES_ATOM, "o": SMILES_ATOM,
+    "p": SMILES_ATOM, "s": SMILES_ATOM, "*": SMILES_ATOM,
+}
+SMILES_BONDS = set("-=#$:/\\")
+SMILES_DIGITS = set("0123456789")
+SMILES_BRACKET_CHARS = set(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789@+-:*"
+)
+SMILES_AFTER_ATOM = (SMILES_ATOM, SMILES_ATOM_B, SMILES_ATOM_C)
+SMILES_CLOSABLE = (SMILES_ATOM, SMILES_ATOM_B, SMILES_ATOM_C, SMILES_BRANCH_CLOSE)
+
+
+def smiles_char_transition(state: int, char: str):
+    """
+        Returns (next state, depth change, toggled ring number or None) for one character,
+        or None if the character cannot follow the state.
+    """
+    if state in (SMILES_ATOM_B, SMILES_ATOM_C):
+        if (state, char) in ((SMILES_ATOM_B, "r"), (SMILES_ATOM_C, "l")):
+            return SMILES_ATOM, 0, None
+        state = SMILES_ATOM
+    if state == SMILES_BRACKET_OPEN:
+        return (SMILES_BRACKET_BODY, 0, None) if char in SMILES_BRACKET_CHARS else None
+    if state == SMILES_BRACKET_BODY:
+        if char == "]":
+            return SMILES_ATOM, 0, None
+        return (SMILES_BRACKET_BODY, 0, None) if char in SMILES_BRACKET_CHARS else None
+    if state == SMILES_PERCENT:
+        return (SMILES_PERCENT_DIGIT + int(char), 0, None) if char in SMILES_DIGITS else None
+    if state >= SMILES_PERCENT_DIGIT:
+        if char not in SMILES_DIGITS:
+            return None
+        return SMILES_ATOM, 0, 10 * (state - SMILES_PERCENT_DIGIT) + int(char)
+
+    if char in SMILES_ATOMS:
+        return SMILES_ATOMS[char], 0, None
+    if char == "[":
+        return SMILES_BRACKET_OPEN, 0, None
+    if char in SMILES_BONDS:
+        if state in (SMILES_ATOM, SMILES_BRANCH_CLOSE, SMILES_BRANCH_OPEN):
+            return SMILES_BOND, 0, None
+        return None
+    if char in SMILES_DIGITS:
+        if state in (SMILES_ATOM, SMILES_BOND):
+            return SMILES_ATOM, 0, int(char)
+        return None
+    if char == "%":
+        return (SMILES_PERCENT, 0, None) if state in (SMILES_ATOM, SMILES_BOND) else None
+    if state not in (SMILES_ATOM, SMILES_BRANCH_CLOSE):
+        return None
+    if char == "(":
+        return SMILES_BRANCH_OPEN, 1, None
+    if char == ")":
+        return SMILES_BRANCH_CLOSE, -1, None
+    if char == ".":
+        return SMILES_DOT, 0, None
+    return None
+
+
+class SMILESGrammarLogitsProcessor(LogitsProcessor):
+    """
+        Masks the tokens that would turn the text generated after the last [START_SMILES]
+        into a syntactically invalid SMILES prefix, and allows [END_SMILES] only when every
+        branch, ring closure and bracket atom is closed. Rows that have no [START_SMILES]
+        or already generated [END_SMILES] are left as they are.
+
+        For every token and syntax state the transition (next state, the branch depth the
+        token needs, its depth change, the ring numbers it toggles) is computed once, a row
+        is then advanced by one token per step. Row states are cached by the generated
+        token ids, so rows can be reordered or replaced between calls (e.g. by the
+        continuous batching engine).
+    """
+
+    def __init__(
+            self, tokenizer_path: str = None, tokenizer=None,
+            start_token: str = "[START_SMILES]", end_token: str = "[END_SMILES]",
+            max_cache_size: int = 200000
+    ):
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.start_token_id = tokenizer.convert_tokens_to_ids(start_token)
+        self.end_token_id = tokenizer.convert_tokens_to_ids(end_token)
+        self.max_cache_size = max_cache_size
+        self.vocab_size = len(tokenizer)
+        self._build_tables(tokenizer)
+        self.device_tables = {}
+        self.states = {}
+        self.num_masked_steps = 0
+        self.num_blocked_ends = 0
+
+    def _build_tables(self, tokenizer):
+        special_ids = set(tokenizer.all_special_ids) | set(tokenizer.get_added_vocab().values())
+        self.next_state = np.full(
+            (NUM_SMILES_STATES, self.vocab_size), SMILES_INVALID, dtype=np.int8
+        )
+        self.min_depth = np.zeros((NUM_SMILES_STATES, self.vocab_size), dtype=np.int16)
+        self.depth_delta = np.zeros((NUM_SMILES_STATES, self.vocab_size), dtype=np.int16)
+        self.ring_toggles = {}
+        tokens = tokenizer.convert_ids_to_tokens(list(range(self.vocab_size)))
+        for token_id, token in enumerate(tokens):
+            if token_id in special_ids or not token:
+                continue
+            for state in range(NUM_SMILES_STATES):
+                current_state, depth, min_depth, rings = state, 0, 0, 0
+                for char in token:
+                    transition = smiles_char_transition(current_state, char)
+                    if transition is None:
+                        current_state = SMILES_INVALID
+                        break
+                    current_state, depth_change, ring = transition
+                    depth += depth_change
+                    min_depth = min(min_depth, depth)
+                    if ring is not None:
+                        rings ^= 1 << ring
+                if current_state == SMILES_INVALID:
+                    continue
+                self.next_state[state, token_id] = current_state
+                self.min_depth[state, token_id] = -min_depth
+                self.depth_delta[state, token_id] = depth
+                if rings:
+                    self.ring_toggles[state, token_id] = rings
+
+    def _tables(self, device):
+        if device not in self.device_tables:
+            self.device_tables[device] = (
+                torch.from_numpy(self.next_state != SMILES_INVALID).to(device),
+                torch.from_numpy(self.min_depth).to(device),
+            )
+        return self.device_tables[device]
+
+    def _advance(self, row_state, token_id):
+        state, depth, rings = row_state
+        if state == SMILES_INVALID:
+            return row_state
+        next_state = int(self.next_state[state, token_id])
+        if next_state == SMILES_INVALID or depth < self.min_depth[state, token_id]:
+            return SMILES_INVALID, 0, 0
+        return (
+            next_state, depth + int(self.depth_delta[state, token_id]),
+            rings ^ self.ring_toggles.get((state, token_id), 0)
+        )
+
+    def _row_state(self, generated):
+        # start from the longest prefix with a known state, usually all but the last token
+        num_known = len(generated)
+        while num_known > 0 and tuple(generated[:num_known]) not in self.states:
+            num_known -= 1
+        row_state = self.states.get(tuple(generated[:num_known]), (SMILES_START, 0, 0))
+        if len(self.states) + len(generated) - num_known > self.max_cache_size:
+            self.states.clear()
+        for i in range(num_known, len(generated)):
+            row_state = self._advance(row_state, generated[i])
+            self.states[tuple(generated[:i + 1])] = row_state
+        return row_state
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        is_start = input_ids == self.start_token_id
+        has_start = is_start.any(dim=1)
+        last_start = input_ids.shape[1] - 1 - is_start.flip(1).int().argmax(dim=1)
+        rows, states, depths, can_end = [], [], [], []
+        for row, (row_has_start, start) in enumerate(zip(has_start.tolist(), last_start.tolist())):
+            if not row_has_start:
+                continue
+            generated = input_ids[row, start + 1:].tolist()
+            if self.end_token_id in generated:
+                continue
+            state, depth, rings = self._row_state(generated)
+            if state == SMILES_INVALID:
+                continue
+            rows.append(row)
+            states.append(state)
+            depths.append(depth)
+            can_end.append(state in SMILES_CLOSABLE and depth == 0 and rings == 0)
+        if not rows:
+            return scores
+
+        valid_table, min_depth_table = self._tables(scores.device)
+        rows = torch.tensor(rows, device=scores.device)
+        states = torch.tensor(states, device=scores.device)
+        depths = torch.tensor(depths, device=scores.device)
+        allowed = torch.zeros((len(rows), scores.shape[1]), dtype=torch.bool, device=scores.device)
+        num_tokens = min(scores.shape[1], self.vocab_size)
+        allowed[:, :num_tokens] = (
+            valid_table[states] & (min_depth_table[states] <= depths[:, None])
+        )[:, :num_tokens]
+        allowed[:, self.end_token_id] = torch.tensor(can_end, device=scores.device)
+        self.num_masked_steps += len(rows)
+        self.num_blocked_ends += len(can_end) - sum(can_end)
+        scores[rows] = scores[rows].masked_fill(~allowed, -float("inf"))
+        return scores
+
+
+class TokenTrie:
+    """
+        Trie of token id sequences. Most nodes of a trie of SMILES have a single child,
+        so the first child of every node is kept in two int arrays and only the other
+        children go to a dict keyed by (node, token). Terminal nodes are marked in a bytearray.
+    """
+
+    def __init__(self):
+        self.first_tokens = array("i", [-1])
+        self.first_children = array("i", [-1])
+        self.other_children = {}
+        self.terminal = bytearray(1)
+        self.num_sequences = 0
+
+    def __len__(self):
+        return self.num_sequences
+
+    @property
+    def num_nodes(self):
+        return len(self.terminal)
+
+    def child(self, node: int, token_id: int) -> int:
+        if self.first_tokens[node] == token_id:
+            return self.first_children[node]
+        return self.other_children.get((node << 20) | token_id, -1)
+
+    def add(self, token_ids: List[int]) -> bool:
+        node = 0
+        for token_id in token_ids:
+            child = self.child(node, token_id)
+            if child == -1:
+                child = len(self.terminal)
+                self.first_tokens.append(-1)
+                self.first_children.append(-1)
+                self.terminal.append(0)
+                if self.first_tokens[node] == -1:
+                    self.first_tokens[node] = token_id
+                    self.first_children[node] = child
+                else:
+                    self.other_children[(node << 20) | token_id] = child
+            node = child
+        if self.terminal[node]:
+            return False
+        self.terminal[node] = 1
+        self.num_sequences += 1
+        return True
+
+
+class DuplicateSMILESLogitsProcessor(LogitsProcessor):
+    """
+        Keeps a trie of the token ids of known SMILES (e.g. the molecules already scored by
+        the oracle) and lowers the score of [END_SMILES] by `penalty` (blocks it when None)
+        wherever the text generated after [START_SMILES] is exactly a known SMILES.
+        Molecules are added with `add` as they become known.
+
+        `num_penalized` counts the steps at which [END_SMILES] was lowered and
+        `expected_prevented` sums the probability [END_SMILES] had at those steps,
+        an estimate of the number of duplicates that were not generated.
+    """
+
+    def __init__(
+            self, tokenizer_path: str = None, tokenizer=None, penalty: float = None,
+            start_token: str = "[START_SMILES]", end_token: str = "[END_SMILES]",
+            max_cache_size: int = 200000
+    ):
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        self.tokenizer = tokenizer
+        self.penalty = penalty
+        self.start_token_id = tokenizer.convert_tokens_to_ids(start_token)
+        self.end_token_id = tokenizer.convert_tokens_to_ids(end_token)
+        self.max_cache_size = max_cache_size
+        self.trie = TokenTrie()
+        self.nodes = {}
+        self.num_penalized = 0
+        self.expected_prevented = 0.0
+
+    def add(self, smiles_list: List[str]):
+        smiles_list = [smiles for smiles in smiles_list if smiles]
+        if not smiles_list:
+            return
+        added = False
+        for token_ids in self.tokenizer(smiles_list, add_special_tokens=False)["input_ids"]:
+            added |= self.trie.add(token_ids)
+        if added:
+            # prefixes cached as unknown may be in the trie now
+            self.nodes.clear()
+
+    def _node(self, generated):
+        num_known = len(generated)
+        while num_known > 0 and tuple(generated[:num_known]) not in self.nodes:
+            num_known -= 1
+        node = self.nodes.get(tuple(generated[:num_known]), 0)
+        if len(self.nodes) + len(generated) - num_known > self.max_cache_size:
+            self.nodes.clear()
+        for i in range(num_known, len(generated)):
+            if node != -1:
+                node = self.trie.child(node, generated[i])
+            self.nodes[tuple(generated[:i + 1])] = node
+        return node
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if not len(self.trie):
+            return scores
+        is_start = input_ids == self.start_token_id
+        has_start = is_start.any(dim=1)
+        last_start = input_ids.shape[1] - 1 - is_start.flip(1).int().argmax(dim=1)
+        rows = []
+        for row, (row_has_start, start) in enumerate(zip(has_start.tolist(), last_start.tolist())):
+            if not row_has_start:
+                continue
+            generated = input_ids[row, start + 1:].tolist()
+            if not generated or self.end_token_id in generated:
+                continue
+            node = self._node(generated)
+            if node != -1 and self.trie.terminal[node]:
+                rows.append(row)
+        if not rows:
+            return scores
+
+        rows = torch.tensor(rows, device=scores.device)
+        end_probs = torch.softmax(scores[rows].float(), dim=-1)[:, self.end_token_id]
+        self.num_penalized += len(rows)
+        self.expected_prevented += end_probs.sum().item()
+        if self.penalty is None:
+            scores[rows, self.end_token_id] = -float("inf")
+        else:
+            scores[rows, self.end_token_id] -= self.penalty
+        return scores
+
+    def stats(self):
+        return {
+            "molecules": len(self.trie),
+            "trie_nodes": self.trie.num_nodes,
+            "penalized": self.num_penalized,
+            "expected_prevented": self.expected_prevented,
+        }
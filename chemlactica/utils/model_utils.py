@@ -13,6 +13,7 @@ import bitsandbytes as bnb
 import torch
 from transformers import BitsAndBytesConfig
 import torch.nn as nn
+from chemlactica.utils.cpu_inference import quantize_int8
 
 
 class LinearFloat32(nn.Linear):
@@ -94,7 +95,20 @@ def load_model(
     model_config=None,
     auth_token=None,
     gradient_checkpointing=True,
+    cpu_int8=False,
+    num_threads=None,
 ):
+    """
+        cpu_int8 loads the model for inference on CPU with int8 dynamic quantization
+        of the linear layers (see quantize_int8), num_threads is the number of CPU threads.
+    """
+    if cpu_int8:
+        # quantization needs float32 weights, flash attention needs CUDA
+        model = load_model(
+            from_pretrained, use_flash_attn=False, dtype=torch.float32,
+            model_config=model_config, auth_token=auth_token, gradient_checkpointing=False
+        )
+        return quantize_int8(model, num_threads=num_threads)
     attn_implementation = select_attention_implementation(use_flash_attn)
     if from_pretrained == "small_opt":
         return OPTForCausalLM(
@@ -131,7 +145,7 @@ def load_model(
     if "gemma" in from_pretrained.lower():
         model = AutoModelForCausalLM.from_pretrained(
             from_pretrained,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=dtype if dtype == torch.float32 else torch.bfloat16,
             attn_implementation=attn_implementation,
         )
 
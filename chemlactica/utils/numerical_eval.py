@@ -0,0 +1,382 @@
+from typing import List, Optional
+from dataclasses import dataclass
+import argparse
+import csv
+import inspect
+import sys
+import numpy as np
+import torch
+from accelerate.utils import gather_object
+
+END_PROPERTY_TAG = "[/PROPERTY]"
+
+
+def property_prompt(smiles: str, separator_token: str, property_name: str = "activity") -> str:
+    return f"{separator_token}[START_SMILES]{smiles}[END_SMILES][PROPERTY]{property_name}"
+
+
+def parse_property_value(text: str, property_name: str = "activity") -> Optional[float]:
+    """
+        The number between "`property_name` " and [/PROPERTY], None if there is none.
+    """
+    start = text.find(f"{property_name} ")
+    end = text.find(END_PROPERTY_TAG)
+    if start == -1 or end == -1:
+        return None
+    try:
+        return float(text[start + len(property_name) + 1:end])
+    except ValueError:
+        return None
+
+
+def length_buckets(lengths: List[int], batch_size: int) -> List[List[int]]:
+    # batches of prompts of similar length, so little of a batch is padding
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+@torch.no_grad()
+def generate_property_texts(
+    model, tokenizer, prompts: List[str],
+    batch_size: int = 32, max_new_tokens: int = 100, synced_gpus: bool = False
+) -> List[str]:
+    """
+        Greedy completions of the prompts (prompt included), in batches of prompts of
+        similar length that are left padded. A row stops at [/PROPERTY] and a batch when
+        all of its rows stopped. The prompts are tokenized in one call. With
+        `synced_gpus` every batch runs max_new_tokens forward passes, as sharded (FSDP)
+        models need all ranks in every forward.
+    """
+    prompts_ids = tokenizer(prompts)["input_ids"]
+    end_token_id = tokenizer.encode(END_PROPERTY_TAG)[0]
+    pad_token_id = tokenizer.pad_token_id
+    texts = [None] * len(prompts)
+    for batch_indices in length_buckets([len(ids) for ids in prompts_ids], batch_size):
+        max_length = max(len(prompts_ids[i]) for i in batch_indices)
+        input_ids = torch.full((len(batch_indices), max_length), pad_token_id)
+        attention_mask = torch.zeros((len(batch_indices), max_length), dtype=torch.long)
+        for row, i in enumerate(batch_indices):
+            input_ids[row, max_length - len(prompts_ids[i]):] = torch.tensor(prompts_ids[i])
+            attention_mask[row, max_length - len(prompts_ids[i]):] = 1
+        output = model.generate(
+            input_ids=input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            do_sample=False,
+            eos_token_id=end_token_id,
+            pad_token_id=pad_token_id,
+            max_new_tokens=max_new_tokens,
+            synced_gpus=synced_gpus,
+        )
+        generated = output[:, max_length:].tolist()
+        for row, i in enumerate(batch_indices):
+            # the rows that stopped early are padded on the right
+            generated_ids = generated[row]
+            while generated_ids and generated_ids[-1] == pad_token_id:
+                generated_ids.pop()
+            texts[i] = tokenizer.decode(prompts_ids[i] + generated_ids)
+    return texts
+
+
+def predict_properties(
+    model, tokenizer, smiles_list: List[str], separator_token: str,
+    property_name: str = "activity", batch_size: int = 32, max_new_tokens: int = 100,
+    synced_gpus: bool = False
+) -> List[Optional[float]]:
+    texts = generate_property_texts(
+        model, tokenizer,
+        [property_prompt(smiles, separator_token, property_name) for smiles in smiles_list],
+        batch_size=batch_size, max_new_tokens=max_new_tokens, synced_gpus=synced_gpus
+    )
+    return [parse_property_value(text, property_name) for text in texts]
+
+
+def shard_indices(num_rows: int, process_index: int, world_size: int):
+    """
+        The rows of a rank (every `world_size`-th one) and how many of them are its own:
+        every rank gets ceil(num_rows / world_size) rows, the shorter shards are padded
+        with a repeated row, so all the ranks run the same number of generate calls.
+    """
+    indices = list(range(process_index, num_rows, world_size))
+    num_own = len(indices)
+    shard_size = -(-num_rows // world_size)
+    indices += [indices[-1] if indices else 0] * (shard_size - num_own)
+    return indices, num_own
+
+
+def predict_properties_sharded(
+    model, tokenizer, smiles_list: List[str], separator_token: str,
+    process_index: int, world_size: int, gather=gather_object, **kwargs
+) -> List[Optional[float]]:
+    """
+        predict_properties with the molecules split over the ranks, every rank returns the
+        predictions of all the molecules. The generation is synced over the ranks when
+        there is more than one.
+    """
+    indices, num_own = shard_indices(len(smiles_list), process_index, world_size)
+    predictions = predict_properties(
+        model, tokenizer, [smiles_list[i] for i in indices], separator_token,
+        synced_gpus=world_size > 1, **kwargs
+    )
+    results = list(zip(indices, predictions))[:num_own]
+    if world_size > 1:
+        results = gather(results)
+    return [prediction for _, prediction in sorted(results)]
+
+
+NUMBER_CHARACTERS = "0123456789-."
+
+
+@dataclass
+class PropertyDistribution:
+    """
+        The values the model can write for a property with their log-probabilities
+        (the log-likelihood of the number text followed by [/PROPERTY]). `coverage` is
+        the probability of the values found, the rest of the mass is on numbers that
+        fell out of the beams and on non-numeric text. The point estimates and the
+        uncertainty use the distribution renormalized over the values, with the
+        log-probabilities divided by `temperature` (see fit_temperature).
+    """
+    values: np.ndarray
+    log_probs: np.ndarray
+
+    def probs(self, temperature: float = 1.0) -> np.ndarray:
+        if len(self.values) == 0:
+            return self.log_probs
+        log_probs = self.log_probs / temperature
+        probs = np.exp(log_probs - log_probs.max())
+        return probs / probs.sum()
+
+    @property
+    def coverage(self) -> float:
+        return float(np.exp(self.log_probs).sum())
+
+    def mode(self) -> float:
+        return float(self.values[np.argmax(self.log_probs)]) if len(self.values) else float("nan")
+
+    def mean(self, temperature: float = 1.0) -> float:
+        if len(self.values) == 0:
+            return float("nan")
+        return float(self.probs(temperature) @ self.values)
+
+    def std(self, temperature: float = 1.0) -> float:
+        if len(self.values) == 0:
+            return float("nan")
+        probs = self.probs(temperature)
+        return float(np.sqrt(probs @ (self.values - probs @ self.values) ** 2))
+
+
+def _select_cache(past_key_values, rows):
+    if hasattr(past_key_values, "reorder_cache"):
+        past_key_values.reorder_cache(rows)
+        return past_key_values
+    return tuple(
+        tuple(tensor.index_select(0, rows) for tensor in layer) for layer in past_key_values
+    )
+
+
+def _allowed_characters(prefix: str, max_decimals: Optional[int]):
+    # sign, digits without leading zeros, at most one point, [/PROPERTY] after a digit
+    has_digit = any(character.isdigit() for character in prefix)
+    digits = prefix.lstrip("-")
+    allow_digit = digits != "0" and not (
+        max_decimals is not None and "." in prefix
+        and len(prefix) - prefix.index(".") - 1 >= max_decimals
+    )
+    return [
+        allow_digit if character.isdigit()
+        else (prefix == "" if character == "-" else has_digit and "." not in prefix)
+        for character in NUMBER_CHARACTERS
+    ] + [prefix[-1:].isdigit()]
+
+
+@torch.no_grad()
+def _read_batch(model, tokenizer, prompts_ids, token_ids, num_beams, max_tokens, max_decimals):
+    device = model.device
+    num_prompts = len(prompts_ids)
+    max_length = max(len(prompt_ids) for prompt_ids in prompts_ids)
+    input_ids = torch.full((num_prompts, max_length), tokenizer.pad_token_id)
+    attention_mask = torch.zeros((num_prompts, max_length), dtype=torch.long)
+    for i, prompt_ids in enumerate(prompts_ids):
+        input_ids[i, max_length - len(prompt_ids):] = torch.tensor(prompt_ids)
+        attention_mask[i, max_length - len(prompt_ids):] = 1
+    input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+    # OPT derives the positions of left padded rows from the mask, the other models take them
+    pass_positions = "position_ids" in inspect.signature(model.forward).parameters
+    position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+    kwargs = {"position_ids": position_ids} if pass_positions else {}
+    output = model(input_ids=input_ids, attention_mask=attention_mask, use_cache=True, **kwargs)
+    past_key_values = output.past_key_values
+    logits = output.logits[:, -1]
+    positions = position_ids[:, -1]
+
+    token_ids = torch.tensor(token_ids, device=device)
+    num_candidates = len(token_ids) - 1
+    scores = torch.zeros(num_prompts, device=device)
+    prefixes = [""] * num_prompts
+    beams_per_prompt = 1
+    finished = [{} for _ in range(num_prompts)]
+    for step in range(max_tokens + 1):
+        log_probs = torch.log_softmax(logits.float(), dim=-1)[:, token_ids]
+        allowed = torch.tensor(
+            [_allowed_characters(prefix, max_decimals) for prefix in prefixes], device=device
+        )
+        candidates = (scores[:, None] + log_probs).masked_fill(~allowed, -float("inf"))
+        for row, score in enumerate(candidates[:, -1].tolist()):
+            if score > -float("inf"):
+                values = finished[row // beams_per_prompt]
+                # "1.5" and "1.50" are the same value
+                value = float(prefixes[row])
+                values[value] = np.logaddexp(values.get(value, -np.inf), score)
+        if step == max_tokens:
+            break
+        candidates = candidates[:, :-1].reshape(num_prompts, beams_per_prompt * num_candidates)
+        scores, indices = candidates.topk(min(num_beams, candidates.shape[1]), dim=-1)
+        beams_per_prompt = scores.shape[1]
+        scores = scores.reshape(-1)
+        previous_beams_per_prompt = candidates.shape[1] // num_candidates
+        rows = (
+            torch.arange(num_prompts, device=device)[:, None] * previous_beams_per_prompt
+            + indices // num_candidates
+        ).reshape(-1)
+        characters = (indices % num_candidates).reshape(-1)
+        prefixes = [
+            prefixes[row] + NUMBER_CHARACTERS[character]
+            for row, character in zip(rows.tolist(), characters.tolist())
+        ]
+        past_key_values = _select_cache(past_key_values, rows)
+        attention_mask = torch.cat(
+            [attention_mask[rows], torch.ones((len(rows), 1), dtype=torch.long, device=device)],
+            dim=-1
+        )
+        positions = positions[rows] + 1
+        kwargs = {"position_ids": positions[:, None]} if pass_positions else {}
+        output = model(
+            input_ids=token_ids[characters][:, None], attention_mask=attention_mask,
+            past_key_values=past_key_values, use_cache=True, **kwargs
+        )
+        past_key_values = output.past_key_values
+        logits = output.logits[:, -1]
+    return [
+        PropertyDistribution(
+            np.array(list(values.keys()), dtype=np.float64),
+            np.array(list(values.values()), dtype=np.float64)
+        )
+        for values in finished
+    ]
+
+
+def read_properties(
+    model, tokenizer, smiles_list: List[str], separator_token: str,
+    property_name: str = "activity", batch_size: int = 32, num_beams: int = 16,
+    max_tokens: int = 8, max_decimals: Optional[int] = None
+) -> List[PropertyDistribution]:
+    """
+        Reads the property values from the distribution of the model after
+        "...[PROPERTY]`property_name` " without sampling text: a beam search over the
+        number tokens (sign, digits, point) with `num_beams` beams per molecule keeps the
+        likeliest numbers of up to `max_tokens` tokens and scores each of them followed by
+        [/PROPERTY], in `max_tokens` + 1 forward passes per batch. Returns the distribution
+        over the values for every molecule.
+    """
+    prompts_ids = tokenizer([
+        property_prompt(smiles, separator_token, property_name) + " " for smiles in smiles_list
+    ])["input_ids"]
+    token_ids = tokenizer.convert_tokens_to_ids(list(NUMBER_CHARACTERS))
+    token_ids.append(tokenizer.encode(END_PROPERTY_TAG)[0])
+    distributions = [None] * len(smiles_list)
+    for batch_indices in length_buckets([len(ids) for ids in prompts_ids], batch_size):
+        batch = _read_batch(
+            model, tokenizer, [prompts_ids[i] for i in batch_indices], token_ids,
+            num_beams, max_tokens, max_decimals
+        )
+        for i, distribution in zip(batch_indices, batch):
+            distributions[i] = distribution
+    return distributions
+
+
+def fit_temperature(
+    distributions: List[PropertyDistribution], targets: List[float],
+    temperatures=np.logspace(-1, 1, 41)
+) -> float:
+    """
+        The temperature with the lowest Gaussian negative log-likelihood of the targets
+        given the mean and the standard deviation of the distributions, for calibrating
+        the uncertainties on a validation set.
+    """
+    best_temperature, best_nll = 1.0, float("inf")
+    for temperature in temperatures:
+        nlls = []
+        for distribution, target in zip(distributions, targets):
+            if len(distribution.values) == 0:
+                continue
+            variance = distribution.std(temperature) ** 2 + 1e-4
+            nlls.append(
+                0.5 * np.log(2 * np.pi * variance)
+                + (target - distribution.mean(temperature)) ** 2 / (2 * variance)
+            )
+        if nlls and np.mean(nlls) < best_nll:
+            best_temperature, best_nll = float(temperature), np.mean(nlls)
+    return best_temperature
+
+
+def read_smiles_file(path: str) -> List[str]:
+    # one molecule per line, the SMILES is the first column
+    with open(path) as file:
+        return [line.split()[0] for line in file if line.strip()]
+
+
+def write_readouts(output, smiles_list, distributions, temperature=1.0):
+    writer = csv.writer(output)
+    writer.writerow(["smiles", "mean", "std", "mode", "coverage"])
+    for smiles, distribution in zip(smiles_list, distributions):
+        writer.writerow([
+            smiles, distribution.mean(temperature), distribution.std(temperature),
+            distribution.mode(), distribution.coverage
+        ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Reads a property of the molecules of a SMILES file from the model."
+    )
+    parser.add_argument("--checkpoint_path", type=str, required=True)
+    parser.add_argument("--tokenizer_path", type=str, default=None)
+    parser.add_argument("--smiles_file", type=str, required=True)
+    parser.add_argument("--output", type=str, default=None, help="csv file, stdout by default")
+    parser.add_argument("--property_name", type=str, default="activity")
+    parser.add_argument("--separator_token", type=str, default="</s>")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_beams", type=int, default=16)
+    parser.add_argument("--max_tokens", type=int, default=8)
+    parser.add_argument("--max_decimals", type=int, default=None)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--cpu_int8", action="store_true")
+    args = parser.parse_args()
+
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from chemlactica.utils.cpu_inference import quantize_int8
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path or args.checkpoint_path)
+    if args.cpu_int8:
+        model = quantize_int8(
+            AutoModelForCausalLM.from_pretrained(args.checkpoint_path, torch_dtype=torch.float32)
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.checkpoint_path,
+            torch_dtype=torch.bfloat16 if args.device.startswith("cuda") else torch.float32
+        ).to(args.device).eval()
+    smiles_list = read_smiles_file(args.smiles_file)
+    distributions = read_properties(
+        model, tokenizer, smiles_list, args.separator_token, property_name=args.property_name,
+        batch_size=args.batch_size, num_beams=args.num_beams, max_tokens=args.max_tokens,
+        max_decimals=args.max_decimals
+    )
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            write_readouts(output, smiles_list, distributions, args.temperature)
+    else:
+        write_readouts(sys.stdout, smiles_list, distributions, args.temperature)
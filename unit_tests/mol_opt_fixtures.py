@@ -0,0 +1,90 @@
+import os
+import torch
+from rdkit import Chem
+from rdkit.Chem import rdMolDescriptors
+
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+CORES = ["c1ccccc1", "C1CCCCC1", "c1ccncc1", "C1CCOC1"]
+LINKERS = ["C", "O", "N", "CC", "C(=O)", "C(F)"]
+
+
+class RandomGenerator(torch.nn.Module):
+    """
+        Appends a molecule drawn with the global torch generator to every prompt,
+        so a run is reproducible from the saved rng state.
+    """
+
+    def __init__(self, tokenizer):
+        super().__init__()
+        self.molecule_token_ids = [
+            tokenizer.encode(core + a + b + "[END_SMILES]", add_special_tokens=False)
+            for core in CORES for a in LINKERS for b in LINKERS
+        ]
+        self.pad_token_id = tokenizer.pad_token_id
+        self.register_buffer("dummy", torch.zeros(0))
+
+    @property
+    def device(self):
+        return self.dummy.device
+
+    def generate(self, input_ids, **kwargs):
+        indices = torch.randint(len(self.molecule_token_ids), (len(input_ids),)).tolist()
+        generated = [self.molecule_token_ids[i] for i in indices]
+        new_tokens = torch.full(
+            (len(input_ids), max(map(len, generated))), self.pad_token_id, dtype=input_ids.dtype
+        )
+        for i, token_ids in enumerate(generated):
+            new_tokens[i, :len(token_ids)] = torch.tensor(token_ids)
+        return torch.cat([input_ids, new_tokens], dim=1)
+
+
+class CountingOracle:
+    def __init__(self, max_oracle_calls, fail_after=None):
+        self.max_oracle_calls = max_oracle_calls
+        self.fail_after = fail_after
+        self.mol_buffer = {}
+        self.num_calls = 0
+
+    def __call__(self, smiles_list):
+        scores = []
+        for smiles in smiles_list:
+            if smiles not in self.mol_buffer:
+                if self.num_calls == self.fail_after:
+                    raise RuntimeError("preempted")
+                self.num_calls += 1
+                score = rdMolDescriptors.CalcTPSA(Chem.MolFromSmiles(smiles))
+                self.mol_buffer[smiles] = [score, len(self.mol_buffer) + 1]
+            scores.append(self.mol_buffer[smiles][0])
+        return scores
+
+    def __len__(self):
+        return len(self.mol_buffer)
+
+    @property
+    def budget(self):
+        return self.max_oracle_calls
+
+    @property
+    def finish(self):
+        return len(self.mol_buffer) >= self.max_oracle_calls
+
+
+def create_config(log_dir, **kwargs):
+    config = {
+        "log_dir": os.path.join(log_dir, "results.log"),
+        "pool_size": 10,
+        "validation_perc": 0.2,
+        "num_mols": 1,
+        "num_similars": 2,
+        "num_gens_per_iter": 20,
+        "generation_batch_size": 10,
+        "sim_range": [0.4, 0.9],
+        "eos_token": "</s>",
+        "generation_temperature": [1.0, 1.5],
+        "generation_config": {"max_new_tokens": 50, "do_sample": True, "eos_token_id": 20},
+        "strategy": ["default"],
+        "max_possible_oracle_score": 200,
+    }
+    config.update(kwargs)
+    return config
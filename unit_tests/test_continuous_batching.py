@@ -0,0 +1,63 @@
+import random
+import unittest
+import torch
+import yaml
+from transformers import OPTConfig, OPTForCausalLM
+from chemlactica.generation.continuous_batching import ContinuousBatchingEngine, list_prompt_source
+
+
+def small_opt():
+    # the small_opt branch of chemlactica.utils.model_utils.load_model
+    model_config = yaml.safe_load(open("chemlactica/config/models_train_config.yaml"))["small_opt"]
+    return OPTForCausalLM(OPTConfig(
+        vocab_size=model_config["vocab_size"],
+        hidden_size=model_config["hidden_size"],
+        num_hidden_layers=model_config["num_hidden_layers"],
+        ffn_dim=model_config["ffn_dim"],
+        max_position_embeddings=model_config["max_position_embeddings"],
+        num_attention_heads=model_config["num_attention_heads"],
+        word_embed_proj_dim=model_config["word_embed_proj_dim"],
+    )).eval()
+
+
+class TestContinuousBatchingEngine(unittest.TestCase):
+    def test_matches_greedy_generate(self):
+        torch.manual_seed(0)
+        model = small_opt()
+        rng = random.Random(0)
+        prompts = [
+            [rng.randrange(3, 50000) for _ in range(rng.randint(2, 12))]
+            for _ in range(20)
+        ]
+        references = []
+        for prompt_ids in prompts:
+            output = model.generate(
+                torch.tensor([prompt_ids]), max_new_tokens=10,
+                do_sample=False, eos_token_id=None, pad_token_id=1
+            )
+            references.append(output[0, len(prompt_ids):].tolist())
+
+        # tokens the model does generate, so that rows finish at different steps
+        eos_token_ids = [references[0][2], references[5][4], references[7][0]]
+        expected = []
+        for reference in references:
+            end = next(
+                (i + 1 for i, token in enumerate(reference) if token in eos_token_ids),
+                len(reference)
+            )
+            expected.append(reference[:end])
+
+        generation_config = {
+            "max_new_tokens": 10, "do_sample": False, "eos_token_id": eos_token_ids
+        }
+        for num_slots in [1, 3, 8]:
+            engine = ContinuousBatchingEngine(
+                model, pad_token_id=1, num_slots=num_slots,
+                max_prompt_length=12, max_new_tokens=10
+            )
+            results = dict(engine.generate(list_prompt_source(prompts), generation_config))
+            self.assertEqual([results[i] for i in range(len(prompts))], expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
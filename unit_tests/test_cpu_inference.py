@@ -0,0 +1,76 @@
+import importlib.util
+import tempfile
+import unittest
+import torch
+from transformers import AutoTokenizer, OPTConfig, OPTForCausalLM
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.utils.cpu_inference import is_quantized, quantize_int8
+from unit_tests.mol_opt_fixtures import TOKENIZER_PATH, CountingOracle, create_config
+
+
+def small_model(vocab_size=64):
+    torch.manual_seed(0)
+    return OPTForCausalLM(OPTConfig(
+        vocab_size=vocab_size, hidden_size=64, num_hidden_layers=2, ffn_dim=128,
+        num_attention_heads=4, word_embed_proj_dim=64, max_position_embeddings=128
+    )).eval()
+
+
+class TestQuantizeInt8(unittest.TestCase):
+    def test_linear_layers_except_head_are_quantized(self):
+        model = small_model()
+        input_ids = torch.randint(0, 64, (4, 16))
+        with torch.no_grad():
+            expected = model(input_ids).logits
+            quantized = quantize_int8(small_model(), num_threads=torch.get_num_threads())
+            logits = quantized(input_ids).logits
+        self.assertTrue(is_quantized(quantized))
+        self.assertFalse(is_quantized(model))
+        self.assertIs(type(quantized.lm_head), torch.nn.Linear)
+        self.assertIsInstance(
+            quantized.model.decoder.layers[0].fc1, torch.ao.nn.quantized.dynamic.Linear
+        )
+        self.assertEqual(logits.dtype, torch.float32)
+        self.assertLess((logits - expected).abs().max().item(), 0.1)
+
+    def test_generate(self):
+        model = quantize_int8(small_model(), num_threads=torch.get_num_threads())
+        output = model.generate(
+            input_ids=torch.randint(2, 64, (2, 5)), max_new_tokens=4, do_sample=False,
+            pad_token_id=1
+        )
+        self.assertEqual(output.shape, (2, 9))
+
+    def test_optimize_refuses_to_fine_tune(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        model = quantize_int8(small_model(len(tokenizer)), num_threads=torch.get_num_threads())
+        with tempfile.TemporaryDirectory() as log_dir:
+            config = create_config(log_dir, strategy=["rej-sample-v2"])
+            with self.assertRaises(ValueError):
+                optimize(model, tokenizer, CountingOracle(10), config)
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec("bitsandbytes"), "chemlactica.utils.model_utils imports bitsandbytes"
+)
+class TestLoadModel(unittest.TestCase):
+    def test_cpu_int8(self):
+        from chemlactica.utils.model_utils import load_model
+
+        model_config = {
+            "vocab_size": 64, "hidden_size": 16, "num_hidden_layers": 1, "ffn_dim": 16,
+            "max_position_embeddings": 128, "num_attention_heads": 1, "word_embed_proj_dim": 16,
+        }
+        model = load_model(
+            "small_opt", model_config=model_config, cpu_int8=True,
+            num_threads=torch.get_num_threads()
+        )
+        self.assertTrue(is_quantized(model))
+        self.assertEqual(model.device.type, "cpu")
+        with torch.no_grad():
+            logits = model(torch.randint(0, 64, (2, 8))).logits
+        self.assertEqual(logits.dtype, torch.float32)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+import torch
+from transformers import AutoTokenizer, OPTConfig, OPTForCausalLM
+from chemlactica.generation.generation import generate, generate_continuous
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+END_SMILES_TOKEN_ID = 20
+
+
+def small_model(vocab_size):
+    torch.manual_seed(0)
+    return OPTForCausalLM(OPTConfig(
+        vocab_size=vocab_size, hidden_size=32, num_hidden_layers=2, ffn_dim=64,
+        num_attention_heads=2, word_embed_proj_dim=32, max_position_embeddings=128
+    )).eval()
+
+
+class TestGenerate(unittest.TestCase):
+    def test_continuous_matches_generate(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+        model = small_model(len(tokenizer))
+        prompts = [
+            "</s>[START_SMILES]",
+            "</s>[QED]0.84[/QED][START_SMILES]",
+            "</s>[SIMILAR]CCO 0.72[/SIMILAR][SIMILAR]c1ccccc1 0.65[/SIMILAR][START_SMILES]",
+        ]
+        gen_kwargs = {
+            "max_new_tokens": 12, "do_sample": False,
+            "eos_token_id": END_SMILES_TOKEN_ID, "pad_token_id": tokenizer.pad_token_id,
+        }
+        expected = generate(prompts, model, tokenizer, **gen_kwargs)
+        for num_slots in [1, 2]:
+            self.assertEqual(
+                generate_continuous(prompts, model, tokenizer, num_slots=num_slots, **gen_kwargs),
+                expected
+            )
+        self.assertEqual(set(expected), set(prompts))
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec("bitsandbytes"), "chemlactica.utils.model_utils imports bitsandbytes"
+)
+class TestCommandLine(unittest.TestCase):
+    def test_cpu_int8(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+        with tempfile.TemporaryDirectory() as directory:
+            # load_model picks the model class from the checkpoint name
+            checkpoint_path = os.path.join(directory, "galactica-test")
+            small_model(len(tokenizer)).save_pretrained(checkpoint_path)
+            result = subprocess.run(
+                [
+                    sys.executable, "-m", "chemlactica.generation.generation",
+                    "--prompts", "</s>[START_SMILES]", "--checkpoint_path", checkpoint_path,
+                    "--device", "cpu", "--max_new_tokens", "4", "--cpu_int8",
+                    "--num_threads", "1", "--tokenizer_path", TOKENIZER_PATH,
+                ],
+                capture_output=True, text=True
+            )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("[START_SMILES]", result.stdout)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
+import unittest
+from chemlactica.jsonl_dataset import JsonlPositions, samples_generator
+
+# printed by the generator, set by the training scripts
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def write_jsonl(path, num_lines, prefix):
+    with open(path, "w", encoding="utf-8") as file:
+        for i in range(num_lines):
+            # non ascii text, the positions are bytes
+            file.write(json.dumps({"text": f"{prefix} line {i} é"}, ensure_ascii=False) + "\n")
+
+
+def read_in_child(positions, file, queue):
+    try:
+        for sample in samples_generator([file], positions, return_line_info=True):
+            queue.put(sample["line_info"]["line_number"])
+            if sample["line_info"]["line_number"] == 3:
+                break
+    finally:
+        queue.put(None)
+
+
+class TestSamplesGenerator(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.files = [os.path.join(self.directory.name, f"file_{i}.jsonl") for i in range(2)]
+        for i, file in enumerate(self.files):
+            write_jsonl(file, 20 + i, f"file {i}")
+        self.lines = {}
+        for file in self.files:
+            with open(file, encoding="utf-8") as f:
+                self.lines[file] = [line.strip() for line in f]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self, positions, num_samples=None):
+        samples = []
+        generator = samples_generator(self.files, positions, return_line_info=True)
+        for sample in generator:
+            samples.append(sample)
+            if len(samples) == num_samples:
+                break
+        generator.close()
+        return samples
+
+    def check_resume(self, positions):
+        first = self.read(positions, num_samples=7)
+        rest = self.read(positions)
+        samples = first + rest
+        self.assertEqual(
+            [sample["text"] for sample in samples],
+            self.lines[self.files[0]] + self.lines[self.files[1]]
+        )
+        for sample in samples:
+            line_info = sample["line_info"]
+            self.assertEqual(
+                sample["text"], self.lines[line_info["file"]][line_info["line_number"] - 1]
+            )
+        self.assertEqual(positions[self.files[1]]["position"], os.path.getsize(self.files[1]))
+        self.assertEqual(positions[self.files[1]]["line_number"], 21)
+
+    def test_exact_resume_from_shared_memory(self):
+        with JsonlPositions(self.files) as positions:
+            self.check_resume(positions)
+
+    def test_exact_resume_from_dict(self):
+        self.check_resume({})
+
+    def test_dict_published_on_cadence(self):
+        positions = {}
+        generator = samples_generator(self.files, positions, publish_every=5)
+        for _ in range(8):
+            next(generator)
+        self.assertEqual(positions[self.files[0]]["line_number"], 5)
+        # the lines after the last publication are recorded when the reader is closed
+        generator.close()
+        self.assertEqual(positions[self.files[0]]["line_number"], 8)
+
+    def test_resume_from_text_mode_position(self):
+        # the states saved by the text mode reader
+        with open(self.files[0], encoding="utf-8") as f:
+            for _ in range(4):
+                f.readline()
+            position = f.tell()
+        positions = {self.files[0]: {"position": position, "line_number": 4}}
+        samples = self.read(positions, num_samples=1)
+        self.assertEqual(samples[0]["text"], self.lines[self.files[0]][4])
+        self.assertEqual(samples[0]["line_info"]["line_number"], 5)
+
+
+class TestJsonlPositions(unittest.TestCase):
+    def test_dict_interface(self):
+        with JsonlPositions(["a.jsonl", "b.jsonl"]) as positions:
+            self.assertFalse(positions)
+            self.assertIsNone(positions.get("a.jsonl"))
+            positions["b.jsonl"] = {"position": 120, "line_number": 3}
+            positions["unknown.jsonl"] = {"position": 1, "line_number": 1}
+            self.assertEqual(
+                dict(positions.items()), {"b.jsonl": {"position": 120, "line_number": 3}}
+            )
+            with self.assertRaises(KeyError):
+                positions["a.jsonl"]
+            copy = pickle.loads(pickle.dumps(positions))
+            copy.write("a.jsonl", 10, 1)
+            self.assertEqual(positions["a.jsonl"], {"position": 10, "line_number": 1})
+            copy.close()
+
+    def test_half_written_state(self):
+        with JsonlPositions(["a.jsonl", "b.jsonl"]) as positions:
+            positions.write("a.jsonl", 10, 1)
+            self.assertEqual(positions["a.jsonl"], {"position": 10, "line_number": 1})
+            # a worker that died after the first store of a write
+            positions.values[0] += 1
+            positions.values[1] = 20
+            positions.values[3] += 1
+            self.assertEqual(positions["a.jsonl"], {"position": 10, "line_number": 1})
+            with self.assertRaises(RuntimeError):
+                positions.get("b.jsonl")
+            # the next reader of the file writes it again
+            positions.write("a.jsonl", 30, 3)
+            self.assertEqual(positions["a.jsonl"], {"position": 30, "line_number": 3})
+
+    def test_written_by_spawned_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file = os.path.join(directory, "file.jsonl")
+            write_jsonl(file, 10, "file")
+            with open(file, encoding="utf-8") as f:
+                expected = sum(len(f.readline().encode("utf-8")) for _ in range(3))
+            with JsonlPositions([file]) as positions:
+                context = multiprocessing.get_context("spawn")
+                queue = context.Queue()
+                process = context.Process(target=read_in_child, args=(positions, file, queue))
+                process.start()
+                line_numbers = list(iter(queue.get, None))
+                process.join()
+                self.assertEqual(line_numbers, [1, 2, 3])
+                self.assertEqual(positions[file], {"position": expected, "line_number": 3})
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
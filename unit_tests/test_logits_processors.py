@@ -0,0 +1,95 @@
+import unittest
+import torch
+from transformers import AutoTokenizer
+from chemlactica.utils.logits_processors import (
+    DuplicateSMILESLogitsProcessor,
+    SMILESGrammarLogitsProcessor,
+    TokenTrie,
+)
+
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+VALID_SMILES = [
+    "CCO", "c1ccccc1O", "CC(=O)OC1=CC=CC=C1C(=O)O", "C[C@H](N)C(=O)O", "[13CH3]Cl",
+    "OC(=O)/C=C\\Br", "[Na+].[Cl-]", "c1ccc2c(c1)CC%10CC2.C%10", "C1CC2(CC1)OCCO2",
+]
+
+
+class TestSMILESGrammarLogitsProcessor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+        cls.processor = SMILESGrammarLogitsProcessor(tokenizer=cls.tokenizer)
+        cls.start_id = cls.tokenizer.convert_tokens_to_ids("[START_SMILES]")
+        cls.end_id = cls.tokenizer.convert_tokens_to_ids("[END_SMILES]")
+
+    def process(self, smiles):
+        input_ids = [self.start_id] + self.tokenizer(smiles, add_special_tokens=False)["input_ids"]
+        return self.processor(torch.tensor([input_ids]), torch.zeros(1, len(self.tokenizer)))[0]
+
+    def test_valid_smiles_are_not_blocked(self):
+        for smiles in VALID_SMILES:
+            token_ids = self.tokenizer(smiles, add_special_tokens=False)["input_ids"]
+            token_ids.append(self.end_id)
+            for i, token_id in enumerate(token_ids):
+                prefix = self.tokenizer.decode(token_ids[:i])
+                self.assertGreater(self.process(prefix)[token_id], -float("inf"), msg=smiles)
+
+    def test_end_needs_closed_smiles(self):
+        for smiles in ["C1CC", "C(C", "CC(", "C[NH", "C%1", "CC="]:
+            self.assertEqual(self.process(smiles)[self.end_id], -float("inf"), msg=smiles)
+        self.assertEqual(self.process("")[self.end_id], -float("inf"))
+        close_branch_id = self.tokenizer.convert_tokens_to_ids(")")
+        self.assertEqual(self.process("CC")[close_branch_id], -float("inf"))
+
+    def test_rows_without_start_are_unchanged(self):
+        input_ids = torch.tensor([self.tokenizer("CC(", add_special_tokens=False)["input_ids"]])
+        scores = self.processor(input_ids, torch.zeros(1, len(self.tokenizer)))
+        self.assertTrue((scores == 0).all())
+
+
+class TestDuplicateSMILESLogitsProcessor(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+        cls.start_id = cls.tokenizer.convert_tokens_to_ids("[START_SMILES]")
+        cls.end_id = cls.tokenizer.convert_tokens_to_ids("[END_SMILES]")
+
+    def process(self, processor, smiles):
+        input_ids = [self.start_id] + self.tokenizer(smiles, add_special_tokens=False)["input_ids"]
+        return processor(torch.tensor([input_ids]), torch.zeros(1, len(self.tokenizer)))[0]
+
+    def test_trie(self):
+        trie = TokenTrie()
+        self.assertTrue(trie.add([5, 6, 7]))
+        self.assertTrue(trie.add([5, 8]))
+        self.assertFalse(trie.add([5, 6, 7]))
+        self.assertEqual(len(trie), 2)
+        self.assertEqual(trie.num_nodes, 5)
+        node = trie.child(trie.child(0, 5), 6)
+        self.assertFalse(trie.terminal[node])
+        self.assertTrue(trie.terminal[trie.child(node, 7)])
+        self.assertEqual(trie.child(node, 8), -1)
+
+    def test_end_is_blocked_after_known_smiles(self):
+        processor = DuplicateSMILESLogitsProcessor(tokenizer=self.tokenizer)
+        processor.add(VALID_SMILES)
+        for smiles in VALID_SMILES:
+            scores = self.process(processor, smiles)
+            self.assertEqual(scores[self.end_id], -float("inf"), msg=smiles)
+            self.assertTrue((scores[:self.end_id] == 0).all())
+        for smiles in ["CC", "CCOC", "c1ccccc1"]:
+            self.assertTrue((self.process(processor, smiles) == 0).all(), msg=smiles)
+        self.assertEqual(processor.stats()["penalized"], len(VALID_SMILES))
+
+    def test_penalty_and_added_molecules(self):
+        processor = DuplicateSMILESLogitsProcessor(tokenizer=self.tokenizer, penalty=2.0)
+        processor.add(["CCO"])
+        self.assertEqual(self.process(processor, "CCN")[self.end_id], 0)
+        processor.add(["CCN"])
+        self.assertEqual(self.process(processor, "CCN")[self.end_id], -2.0)
+        self.assertEqual(self.process(processor, "CCO")[self.end_id], -2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
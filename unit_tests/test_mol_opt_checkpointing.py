@@ -0,0 +1,130 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import torch
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.checkpointing import OptimizationCheckpointer, load_checkpoint
+from chemlactica.mol_opt.example_run import create_run
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool, set_seed
+from unit_tests.mol_opt_fixtures import (
+    TOKENIZER_PATH, CountingOracle, RandomGenerator, create_config
+)
+
+
+class TestPoolState(unittest.TestCase):
+    def test_round_trip(self):
+        pool = Pool(5, validation_perc=0.2)
+        entries = []
+        for i, smiles in enumerate(["CCO", "c1ccccc1", "CCN", "CCCC", "OCCO", "c1ccncc1"]):
+            entries.append(OptimEntry(
+                MoleculeEntry(smiles, score=i), [MoleculeEntry("CC", score=1)]
+            ))
+        entries[0].last_entry.similar_mol_entries = [entries[1].last_entry]
+        pool.add(entries)
+
+        restored = Pool(5, validation_perc=0.2)
+        restored.load_state_dict(pool.state_dict())
+        self.assertEqual(
+            [(e.last_entry.smiles, e.last_entry.score) for e in restored.optim_entries],
+            [(e.last_entry.smiles, e.last_entry.score) for e in pool.optim_entries]
+        )
+        self.assertEqual(
+            [e.entry_status for e in restored.optim_entries],
+            [e.entry_status for e in pool.optim_entries]
+        )
+        self.assertEqual(restored.num_valid_entries, pool.num_valid_entries)
+        self.assertEqual(restored.optim_entries[0].mol_entries[0].smiles, "CC")
+        train_entries, valid_entries = restored.get_train_valid_entries()
+        self.assertEqual(len(train_entries) + len(valid_entries), 5)
+
+
+class TestOptimizationCheckpointer(unittest.TestCase):
+    def test_weights_are_written_when_changed(self):
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpointer = OptimizationCheckpointer(checkpoint_dir)
+            checkpointer.save({"step": 0})
+            checkpointer.save({"step": 1}, {"model": {"w": torch.ones(2)}}, weights_version=1)
+            checkpointer.save({"step": 2})
+            checkpointer.save({"step": 3}, {"model": {"w": torch.zeros(2)}}, weights_version=2)
+            checkpointer.close()
+            state, weights = load_checkpoint(checkpoint_dir)
+            self.assertEqual(state["step"], 3)
+            self.assertTrue((weights["model"]["w"] == 0).all())
+            self.assertEqual(sorted(os.listdir(checkpoint_dir)), ["state.pt", "weights-2.pt"])
+
+
+class RecordingCheckpointer(OptimizationCheckpointer):
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.instances.append(self)
+
+
+class TestResume(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+
+    def run_optimize(self, config, oracle):
+        set_seed(0)
+        optimize(RandomGenerator(self.tokenizer), self.tokenizer, oracle, config)
+        return oracle
+
+    def test_resume_matches_uninterrupted_run(self):
+        self.check_resume()
+
+    def test_resume_with_nearest_similars(self):
+        # the similars index is rebuilt from the scored molecules
+        self.check_resume(similars_strategy="nearest")
+
+    def check_resume(self, **kwargs):
+        with tempfile.TemporaryDirectory() as log_dir:
+            full_run = self.run_optimize(create_config(log_dir, **kwargs), CountingOracle(60))
+
+            checkpoint_dir = os.path.join(log_dir, "checkpoint")
+            config = create_config(log_dir, checkpoint_dir=checkpoint_dir, **kwargs)
+            with mock.patch(
+                "chemlactica.mol_opt.optimization.OptimizationCheckpointer", RecordingCheckpointer
+            ):
+                with self.assertRaises(RuntimeError):
+                    self.run_optimize(config, CountingOracle(60, fail_after=50))
+            RecordingCheckpointer.instances.pop().close()
+            state, _ = load_checkpoint(checkpoint_dir)
+            self.assertEqual(len(state["mol_buffer"]), 40)
+
+            config = create_config(
+                log_dir, checkpoint_dir=checkpoint_dir, resume_from=checkpoint_dir, **kwargs
+            )
+            resumed_run = self.run_optimize(config, CountingOracle(60))
+            self.assertEqual(resumed_run.num_calls, 20)
+            self.assertEqual(resumed_run.mol_buffer, full_run.mol_buffer)
+
+            # the final snapshot of a finished run does not score anything
+            finished_run = self.run_optimize(config, CountingOracle(60))
+            self.assertEqual(finished_run.num_calls, 0)
+
+
+class TestCreateRun(unittest.TestCase):
+    def test_checkpointing_is_opt_in(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            checkpoint_dir = os.path.join(output_dir, "checkpoint_2")
+            os.makedirs(checkpoint_dir)
+            open(os.path.join(checkpoint_dir, "state.pt"), "w").close()
+            config = create_run({}, output_dir, 2)["config"]
+            self.assertNotIn("checkpoint_dir", config)
+            self.assertNotIn("resume_from", config)
+            config = create_run({}, output_dir, 2, checkpoint=True)["config"]
+            self.assertEqual(config["checkpoint_dir"], checkpoint_dir)
+            self.assertNotIn("resume_from", config)
+            with mock.patch("builtins.print") as print_mock:
+                config = create_run({}, output_dir, 2, resume=True)["config"]
+            self.assertEqual(config["resume_from"], checkpoint_dir)
+            self.assertIn("resuming", print_mock.call_args[0][0])
+            self.assertNotIn("resume_from", create_run({}, output_dir, 3, resume=True)["config"])
+
+
+if __name__ == "__main__":
+    unittest.main()
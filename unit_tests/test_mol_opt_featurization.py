@@ -0,0 +1,47 @@
+import unittest
+from rdkit import Chem, DataStructs
+from rdkit.Chem import AllChem
+from chemlactica.mol_opt.featurization import FeaturizationCache, MoleculeFeatures
+from chemlactica.mol_opt.utils import MoleculeEntry
+
+
+class TestFeaturizationCache(unittest.TestCase):
+    def test_aliases_share_features(self):
+        cache = FeaturizationCache()
+        features = cache.featurize("OCC")
+        self.assertEqual(features.smiles, "CCO")
+        self.assertIs(cache.featurize("CCO"), features)
+        self.assertIs(cache.featurize("OCC"), features)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_invalid_smiles_cached(self):
+        cache = FeaturizationCache()
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                cache.featurize("C1CC")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru_eviction(self):
+        cache = FeaturizationCache(maxsize=2)
+        cache.featurize("CCO")
+        cache.featurize("CCN")
+        cache.featurize("CCO")
+        cache.featurize("CCC")
+        self.assertEqual(list(cache.entries), ["CCO", "CCC"])
+
+    def test_packed_fingerprint_roundtrip(self):
+        smiles = "CC(=O)OC1=CC=CC=C1C(=O)O"
+        expected = AllChem.GetMorganFingerprintAsBitVect(Chem.MolFromSmiles(smiles), 2, nBits=2048)
+        packed = FeaturizationCache().featurize(smiles).packed_fingerprint
+        features = MoleculeFeatures(smiles, packed_fingerprint=packed)
+        self.assertEqual(DataStructs.TanimotoSimilarity(features.morgan_fingerprint, expected), 1.0)
+        self.assertEqual(features.morgan_fingerprint.GetNumOnBits(), expected.GetNumOnBits())
+
+    def test_molecule_entry(self):
+        entry = MoleculeEntry("C1=CC=CC=C1O", score=1.0)
+        self.assertEqual(entry.smiles, "Oc1ccccc1")
+        self.assertEqual(entry.mol.GetNumAtoms(), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
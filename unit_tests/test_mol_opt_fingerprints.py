@@ -0,0 +1,127 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from rdkit import Chem
+from rdkit.Chem import AllChem
+from chemlactica.mol_opt.fingerprints import (
+    FingerprintIndex, bulk_tanimoto, pack_bit_vectors, pack_fingerprint,
+    tanimoto_aggregate, tanimoto_top_k
+)
+
+
+def random_packed(num_rows, num_bits, rng):
+    density = rng.uniform(0.01, 0.1, size=(num_rows, 1))
+    packed = pack_bit_vectors(rng.random((num_rows, num_bits)) < density)
+    packed[0] = 0
+    return packed
+
+
+def dense_tanimoto(query_words, stock_words):
+    return np.stack([bulk_tanimoto(query, stock_words) for query in query_words])
+
+
+class TestTiledTanimoto(unittest.TestCase):
+    def test_pack_bit_vectors_matches_pack_fingerprint(self):
+        fingerprint = AllChem.GetMorganFingerprintAsBitVect(
+            Chem.MolFromSmiles("CC(=O)Oc1ccccc1C(=O)O"), 2, nBits=2048
+        )
+        bits = np.array(list(fingerprint.ToBitString()), dtype=np.uint8)
+        self.assertTrue(np.array_equal(
+            pack_bit_vectors(bits[None])[0], pack_fingerprint(fingerprint)
+        ))
+        # rows are padded with zero bits to whole words
+        self.assertEqual(pack_bit_vectors(np.ones((2, 100))).shape, (2, 2))
+
+    def test_aggregate_matches_dense(self):
+        rng = np.random.default_rng(0)
+        query = random_packed(37, 2048, rng)
+        stock = random_packed(501, 2048, rng)
+        similarities = dense_tanimoto(query, stock)
+        for tile_size, num_threads in [(1024, 1), (64, 1), (50, 4)]:
+            np.testing.assert_allclose(
+                tanimoto_aggregate(
+                    query, stock, agg="max", tile_size=tile_size, num_threads=num_threads
+                ),
+                similarities.max(axis=1), rtol=1e-6
+            )
+            np.testing.assert_allclose(
+                tanimoto_aggregate(
+                    query, stock, agg="mean", p=3, tile_size=tile_size, num_threads=num_threads
+                ),
+                (similarities ** 3).mean(axis=1) ** (1 / 3), rtol=1e-6
+            )
+
+    def test_top_k_matches_dense(self):
+        rng = np.random.default_rng(1)
+        query = random_packed(40, 256, rng)
+        stock = random_packed(300, 256, rng)
+        expected = np.sort(dense_tanimoto(query, stock), axis=1)[:, ::-1][:, :5]
+        for tile_size, num_threads in [(1024, 1), (32, 3)]:
+            similarities, indices = tanimoto_top_k(
+                query, stock, 5, tile_size=tile_size, num_threads=num_threads
+            )
+            np.testing.assert_allclose(similarities, expected, rtol=1e-6)
+            for row, (row_indices, row_similarities) in enumerate(zip(indices, similarities)):
+                np.testing.assert_allclose(
+                    bulk_tanimoto(query[row], stock[row_indices]), row_similarities, rtol=1e-6
+                )
+        similarities, indices = tanimoto_top_k(query, stock[:3], 10)
+        self.assertEqual(similarities.shape, (40, 3))
+
+    def test_memory_mapped_stock(self):
+        rng = np.random.default_rng(2)
+        query = random_packed(10, 2048, rng)
+        stock = random_packed(700, 2048, rng)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stock.npy")
+            np.save(path, stock)
+            mapped_stock = np.load(path, mmap_mode="r")
+            np.testing.assert_allclose(
+                tanimoto_aggregate(query, mapped_stock, tile_size=128, num_threads=2),
+                tanimoto_aggregate(query, stock), rtol=1e-6
+            )
+            del mapped_stock
+
+
+class TestFingerprintIndex(unittest.TestCase):
+    def test_search_matches_brute_force(self):
+        rng = np.random.default_rng(3)
+        fingerprints = random_packed(500, 2048, rng)
+        index = FingerprintIndex(capacity=16, block_size=64, query_chunk_size=7)
+        for start in range(0, 500, 90):
+            rows = index.add(fingerprints[start:start + 90])
+            self.assertEqual(list(rows), list(range(start, min(start + 90, 500))))
+        self.assertEqual(len(index), 500)
+
+        # the first fingerprint is empty and has similarity 1 with itself
+        queries = np.concatenate([fingerprints[:20], random_packed(5, 2048, rng), fingerprints[:1]])
+        exclude_rows = list(range(20)) + [-1] * 6
+        similarities, rows = index.search(queries, 4, exclude_rows=exclude_rows)
+        for query, exclude_row, query_similarities, query_rows in zip(
+            queries, exclude_rows, similarities, rows
+        ):
+            expected = bulk_tanimoto(query, fingerprints)
+            if exclude_row >= 0:
+                expected[exclude_row] = -1
+            np.testing.assert_allclose(
+                query_similarities, np.sort(expected)[::-1][:4], rtol=1e-6
+            )
+            np.testing.assert_allclose(expected[query_rows], query_similarities, rtol=1e-6)
+        self.assertEqual((rows[-1, 0], similarities[-1, 0]), (0, 1.0))
+
+    def test_fewer_rows_than_k(self):
+        rng = np.random.default_rng(4)
+        fingerprints = random_packed(3, 256, rng)
+        index = FingerprintIndex(num_bits=256)
+        self.assertEqual(index.search(fingerprints, 2)[1].shape, (3, 0))
+        index.add(fingerprints)
+        similarities, rows = index.search(fingerprints[:2], 5, exclude_rows=[0, -1])
+        self.assertEqual(rows.shape, (2, 3))
+        self.assertEqual(rows[0, -1], -1)
+        self.assertNotIn(0, rows[0])
+        self.assertEqual(sorted(rows[1]), [0, 1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.instrumentation import PhaseTimer
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.utils import set_seed
+from unit_tests.mol_opt_fixtures import (
+    TOKENIZER_PATH, CountingOracle, RandomGenerator, create_config
+)
+
+
+class FakeAimRun:
+    def __init__(self):
+        self.tracked = []
+
+    def track(self, value, name, step=None, context=None):
+        self.tracked.append((name, step, context, value))
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_nested_phases_are_exclusive(self):
+        timer = PhaseTimer()
+        with timer.phase("outer"):
+            time.sleep(0.02)
+            with timer.phase("inner"):
+                time.sleep(0.02)
+        with timer.phase("inner"):
+            pass
+        record = timer.end_iteration(0)
+        self.assertEqual(record["calls"], {"outer": 1, "inner": 2})
+        self.assertGreaterEqual(record["times"]["inner"], 0.02)
+        self.assertLess(record["times"]["outer"], 0.035)
+        self.assertLessEqual(sum(record["times"].values()), record["wall_time"])
+
+    def test_jsonl_aim_and_summary(self):
+        aim_run = FakeAimRun()
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, "timings.jsonl")
+            timer = PhaseTimer(path, aim_run=aim_run)
+            for iteration in range(2):
+                with timer.phase("oracle"):
+                    pass
+                timer.add("fine_tuning", 0.5)
+                timer.count("valid", 3)
+                timer.end_iteration(iteration, pool_size=10)
+            timer.close()
+            with open(path) as file:
+                records = [json.loads(line) for line in file]
+        self.assertEqual([record["iteration"] for record in records], [0, 1])
+        self.assertEqual(records[1]["times"]["fine_tuning"], 0.5)
+        self.assertEqual(records[1]["counters"], {"valid": 3})
+        self.assertEqual(records[1]["pool_size"], 10)
+        self.assertIn(("phase_time", 1, {"phase": "oracle"}), [t[:3] for t in aim_run.tracked])
+        self.assertIn(("valid", 0, {"subset": "optimize"}, 3), aim_run.tracked)
+        summary = timer.summary()
+        self.assertIn("fine_tuning", summary)
+        self.assertIn("valid: 6", summary)
+
+
+class TestOptimizeTimings(unittest.TestCase):
+    def test_optimize_writes_timings(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        with tempfile.TemporaryDirectory() as log_dir:
+            config = create_config(log_dir, timings_path=os.path.join(log_dir, "timings.jsonl"))
+            oracle = CountingOracle(60)
+            set_seed(0)
+            optimize(RandomGenerator(tokenizer), tokenizer, oracle, config)
+            with open(config["timings_path"]) as file:
+                records = [json.loads(line) for line in file]
+        self.assertGreater(len(records), 1)
+        phases = set().union(*(record["times"] for record in records))
+        for phase in ["prompt_building", "tokenization", "generate", "decode", "parse",
+                      "oracle", "pool_add", "log_writing"]:
+            self.assertIn(phase, phases)
+        self.assertEqual(records[-1]["oracle_calls"], 60)
+        self.assertEqual(sum(record["counters"].get("submitted", 0) for record in records), 60)
+
+    def test_memory_cleanup_once_per_candidate_batch(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        with tempfile.TemporaryDirectory() as log_dir:
+            config = create_config(
+                log_dir, timings_path=os.path.join(log_dir, "timings.jsonl"),
+                generation_bucketing_factor=2
+            )
+            set_seed(0)
+            optimize(RandomGenerator(tokenizer), tokenizer, CountingOracle(60), config)
+            with open(config["timings_path"]) as file:
+                records = [json.loads(line) for line in file]
+        num_calls = {
+            phase: sum(record["calls"].get(phase, 0) for record in records)
+            for phase in ["generate", "memory_cleanup"]
+        }
+        self.assertGreater(num_calls["memory_cleanup"], 0)
+        self.assertEqual(num_calls["generate"], 2 * num_calls["memory_cleanup"])
+
+
+if __name__ == "__main__":
+    unittest.main()
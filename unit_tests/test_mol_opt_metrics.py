@@ -0,0 +1,151 @@
+import random
+import unittest
+import numpy as np
+import torch
+from chemlactica.mol_opt.fingerprints import pack_bit_vectors
+from chemlactica.mol_opt.metrics import (
+    TopAUC, average_agg_tanimoto, internal_diversity, top_auc, top_auc_scores
+)
+
+
+def legacy_top_auc(buffer, top_n, finish, freq_log, max_oracle_calls):
+    # top_auc before the streaming implementation
+    sum = 0
+    prev = 0
+    called = 0
+    ordered_results = list(sorted(buffer.items(), key=lambda kv: kv[1][1], reverse=False))
+    for idx in range(freq_log, min(len(buffer), max_oracle_calls), freq_log):
+        temp_result = ordered_results[:idx]
+        temp_result = list(sorted(temp_result, key=lambda kv: kv[1][0], reverse=True))[:top_n]
+        top_n_now = np.mean([item[1][0] for item in temp_result])
+        sum += freq_log * (top_n_now + prev) / 2
+        prev = top_n_now
+        called = idx
+    temp_result = list(sorted(ordered_results, key=lambda kv: kv[1][0], reverse=True))[:top_n]
+    top_n_now = np.mean([item[1][0] for item in temp_result])
+    sum += (len(buffer) - called) * (top_n_now + prev) / 2
+    if finish and len(buffer) < max_oracle_calls:
+        sum += (max_oracle_calls - len(buffer)) * top_n_now
+    return sum / max_oracle_calls
+
+
+def legacy_average_agg_tanimoto(stock_vecs, gen_vecs, batch_size=5000, agg='max', p=1):
+    # average_agg_tanimoto before the packed fingerprint kernels
+    agg_tanimoto = np.zeros(len(gen_vecs))
+    total = np.zeros(len(gen_vecs))
+    for j in range(0, stock_vecs.shape[0], batch_size):
+        x_stock = torch.tensor(stock_vecs[j:j + batch_size]).float()
+        for i in range(0, gen_vecs.shape[0], batch_size):
+            y_gen = torch.tensor(gen_vecs[i:i + batch_size]).float()
+            y_gen = y_gen.transpose(0, 1)
+            tp = torch.mm(x_stock, y_gen)
+            jac = (tp / (x_stock.sum(1, keepdim=True) +
+                         y_gen.sum(0, keepdim=True) - tp)).cpu().numpy()
+            jac[np.isnan(jac)] = 1
+            if p != 1:
+                jac = jac**p
+            if agg == 'max':
+                agg_tanimoto[i:i + y_gen.shape[1]] = np.maximum(
+                    agg_tanimoto[i:i + y_gen.shape[1]], jac.max(0))
+            elif agg == 'mean':
+                agg_tanimoto[i:i + y_gen.shape[1]] += jac.sum(0)
+                total[i:i + y_gen.shape[1]] += jac.shape[0]
+    if agg == 'mean':
+        agg_tanimoto /= total
+    if p != 1:
+        agg_tanimoto = (agg_tanimoto)**(1/p)
+    return np.mean(agg_tanimoto)
+
+
+def random_bit_vectors(num_vectors, dim, rng):
+    density = rng.uniform(0.005, 0.1, size=(num_vectors, 1))
+    vectors = (rng.random((num_vectors, dim)) < density).astype(np.uint8)
+    # empty fingerprints have similarity 1 with each other
+    vectors[:3] = 0
+    return vectors
+
+
+def random_buffer(num_calls, rng):
+    # rounded scores so that there are ties
+    return {f"mol{i}": [round(rng.random(), 2), i + 1] for i in range(num_calls)}
+
+
+class TestTopAUC(unittest.TestCase):
+    def test_matches_legacy_implementation(self):
+        rng = random.Random(0)
+        for num_calls in [1, 5, 99, 100, 101, 250, 1000, 1200]:
+            buffer = random_buffer(num_calls, rng)
+            for top_n in [1, 10, 100]:
+                for finish in [False, True]:
+                    expected = legacy_top_auc(buffer, top_n, finish, 100, 1000)
+                    self.assertAlmostEqual(top_auc(buffer, top_n, finish, 100, 1000), expected)
+
+                    stream = TopAUC(top_n, freq_log=100, max_oracle_calls=1000)
+                    calls = list(buffer.values())
+                    # a few calls reported out of order
+                    rng.shuffle(calls[:3])
+                    for score, call_index in calls:
+                        stream.add(score, call_index)
+                    self.assertAlmostEqual(stream.value(finish), expected)
+
+    def test_streaming_matches_after_every_call(self):
+        rng = random.Random(1)
+        buffer = random_buffer(350, rng)
+        stream = TopAUC(10, freq_log=50, max_oracle_calls=300)
+        partial_buffer = {}
+        for smiles, (score, call_index) in buffer.items():
+            stream.add(score)
+            partial_buffer[smiles] = [score, call_index]
+            self.assertAlmostEqual(
+                stream.value(), legacy_top_auc(partial_buffer, 10, False, 50, 300)
+            )
+
+    def test_scores_in_call_order(self):
+        scores = np.random.default_rng(0).random(5000)
+        buffer = {i: [score, i + 1] for i, score in enumerate(scores)}
+        self.assertAlmostEqual(
+            top_auc_scores(scores, 100, True, 100, 10000),
+            legacy_top_auc(buffer, 100, True, 100, 10000)
+        )
+
+
+class TestTanimotoMetrics(unittest.TestCase):
+    def test_matches_legacy_implementation(self):
+        rng = np.random.default_rng(0)
+        stock = random_bit_vectors(300, 2048, rng)
+        generated = random_bit_vectors(70, 2048, rng)
+        for agg in ["max", "mean"]:
+            for p in [1, 2]:
+                expected = legacy_average_agg_tanimoto(stock, generated, agg=agg, p=p)
+                self.assertAlmostEqual(
+                    average_agg_tanimoto(stock, generated, agg=agg, p=p), expected, places=6
+                )
+                self.assertAlmostEqual(
+                    average_agg_tanimoto(
+                        pack_bit_vectors(stock), pack_bit_vectors(generated),
+                        agg=agg, p=p, num_threads=3
+                    ),
+                    expected, places=6
+                )
+
+    def test_internal_diversity(self):
+        rng = np.random.default_rng(1)
+        fingerprints = random_bit_vectors(200, 1000, rng)
+        expected = 1 - legacy_average_agg_tanimoto(fingerprints, fingerprints, agg='mean')
+        self.assertAlmostEqual(internal_diversity(fingerprints), expected, places=6)
+        self.assertAlmostEqual(
+            internal_diversity(pack_bit_vectors(fingerprints)), expected, places=6
+        )
+
+    def test_count_vectors_use_dense_path(self):
+        rng = np.random.default_rng(2)
+        stock = rng.integers(0, 4, size=(50, 64))
+        generated = rng.integers(0, 4, size=(20, 64))
+        self.assertAlmostEqual(
+            average_agg_tanimoto(stock, generated),
+            legacy_average_agg_tanimoto(stock, generated), places=6
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import tempfile
+import unittest
+import torch
+from transformers import AutoTokenizer, OPTConfig, OPTForCausalLM
+from chemlactica.mol_opt.multi_run import (
+    RowSlicedLogitsProcessor, RunScheduler, _GenerateRequest, optimize_runs
+)
+from unit_tests.mol_opt_fixtures import CountingOracle, RandomGenerator, create_config
+
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+RUN_PROMPTS = [["[START_SMILES]CC", "[START_SMILES]c1ccccc1"], ["</s>[START_SMILES]CCO"]]
+
+
+class TestRowSlicedLogitsProcessor(unittest.TestCase):
+    def test_processors_and_temperatures_per_run(self):
+        def block_first(input_ids, scores):
+            scores[:, 0] = -float("inf")
+            return scores
+
+        processor = RowSlicedLogitsProcessor(
+            [slice(0, 1), slice(1, 3)], [block_first, None], [None, 2.0]
+        )
+        scores = processor(torch.zeros(3, 1, dtype=torch.long), torch.ones(3, 2))
+        self.assertEqual(scores[0].tolist(), [-float("inf"), 1.0])
+        self.assertEqual(scores[1:].tolist(), [[0.5, 0.5], [0.5, 0.5]])
+
+
+class TestRunScheduler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+
+    def test_merged_batch_matches_separate_generation(self):
+        torch.manual_seed(0)
+        model = OPTForCausalLM(OPTConfig(
+            vocab_size=len(self.tokenizer), hidden_size=16, num_hidden_layers=2, ffn_dim=32,
+            num_attention_heads=2, word_embed_proj_dim=16, max_position_embeddings=256
+        )).eval()
+        scheduler = RunScheduler(2, self.tokenizer.pad_token_id)
+        batches = [
+            self.tokenizer(
+                prompts, return_tensors="pt", padding=True, return_token_type_ids=False
+            )
+            for prompts in RUN_PROMPTS
+        ]
+        generation_kwargs = {"max_new_tokens": 6, "do_sample": False}
+        requests = [
+            _GenerateRequest(
+                model, batch["input_ids"], batch["attention_mask"], dict(generation_kwargs)
+            )
+            for batch in batches
+        ]
+        scheduler._generate_group(requests)
+        for batch, request in zip(batches, requests):
+            expected = model.generate(**batch, **generation_kwargs)
+            self.assertTrue(torch.equal(request.output, expected[:, :request.output.shape[1]]))
+
+    def test_runs_share_generate_calls(self):
+        model = RandomGenerator(self.tokenizer)
+        num_generate_calls = 0
+        generate = model.generate
+
+        def counting_generate(*args, **kwargs):
+            nonlocal num_generate_calls
+            num_generate_calls += 1
+            return generate(*args, **kwargs)
+        model.generate = counting_generate
+
+        results = []
+        for _ in range(2):
+            with tempfile.TemporaryDirectory() as log_dir:
+                runs = [
+                    {
+                        "oracle": CountingOracle(40),
+                        "config": create_config(os.path.join(log_dir, str(seed))),
+                        "seed": seed,
+                    }
+                    for seed in [1, 2, 3]
+                ]
+                for run in runs:
+                    os.makedirs(os.path.dirname(run["config"]["log_dir"]))
+                num_generate_calls = 0
+                scheduler = optimize_runs(model, self.tokenizer, runs, seed=0)
+            self.assertTrue(all(len(run["oracle"]) == 40 for run in runs))
+            self.assertEqual(scheduler.num_generate_calls, num_generate_calls)
+            # at least two runs per batch on average
+            self.assertLessEqual(2 * scheduler.num_generate_calls, scheduler.num_requests)
+            results.append([run["oracle"].mol_buffer for run in runs])
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0][0], results[0][1])
+
+
+if __name__ == "__main__":
+    unittest.main()
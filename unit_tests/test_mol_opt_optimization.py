@@ -0,0 +1,262 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.optimization import (
+    GeneratedMoleculeParser, NearestSimilars, extract_generated_smiles, optimize
+)
+from chemlactica.mol_opt.oracles import CachedOracle, OracleCache, ThreadPoolOracle
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool, set_seed, tanimoto_dist_func
+from unit_tests.mol_opt_fixtures import (
+    TOKENIZER_PATH, CountingOracle, RandomGenerator, create_config
+)
+
+
+GENERATED_TEXTS = [
+    "CCO[END_SMILES]</s><pad><pad>",
+    "c1ccccc1",
+    "OCC[END_SMILES]",
+    "C1CC[END_SMILES]",
+    "NN[END_SMILES]",
+    "[END_SMILES]",
+]
+
+
+def contains_carbon(smiles):
+    return "C" in smiles
+
+
+class TestGeneratedMoleculeParser(unittest.TestCase):
+    def test_extract_generated_smiles(self):
+        self.assertEqual(extract_generated_smiles("CCO[END_SMILES]</s>"), "CCO")
+        self.assertEqual(extract_generated_smiles("CC[START_SMILES]N[END_SMILES]"), "N")
+        self.assertIsNone(extract_generated_smiles("CCO"))
+
+    def test_worker_pool_matches_in_process(self):
+        expected = ["CCO", None, "CCO", None, None, None]
+        for num_processes in [1, 2]:
+            parser = GeneratedMoleculeParser(contains_carbon, num_processes)
+            molecules = parser(GENERATED_TEXTS * 3)
+            parser.close()
+            self.assertEqual([m and m.smiles for m in molecules], expected * 3)
+            self.assertEqual(molecules[0].fingerprint.GetNumOnBits(), 6)
+
+    def test_worker_pool_started_from_a_thread(self):
+        # optimize_runs builds the parsers inside its threads
+        with ThreadPoolExecutor(1) as executor:
+            parser = executor.submit(GeneratedMoleculeParser, contains_carbon, 2).result()
+        molecules = parser(GENERATED_TEXTS)
+        parser.close()
+        self.assertEqual([m and m.smiles for m in molecules], [
+            "CCO", None, "CCO", None, None, None
+        ])
+
+    def test_unpicklable_validate_smiles(self):
+        with self.assertRaises(ValueError):
+            GeneratedMoleculeParser(lambda smiles: True, 2)
+
+
+class LengthOracle:
+    def __init__(self):
+        self.mol_buffer = {}
+        self.takes_entry = False
+
+    def __call__(self, smiles_list):
+        for smiles in smiles_list:
+            self.mol_buffer.setdefault(smiles, [len(smiles), len(self.mol_buffer) + 1])
+        return [self.mol_buffer[smiles][0] for smiles in smiles_list]
+
+    def __len__(self):
+        return len(self.mol_buffer)
+
+
+class TestThreadPoolOracle(unittest.TestCase):
+    def test_submit_scores_in_order(self):
+        oracle = ThreadPoolOracle(LengthOracle())
+        futures = [oracle.submit(["C" * i, "N" * i]) for i in range(1, 6)]
+        self.assertEqual([f.result() for f in futures], [[i, i] for i in range(1, 6)])
+        oracle.shutdown()
+        self.assertEqual(len(oracle), 10)
+        self.assertEqual(list(oracle.mol_buffer)[:2], ["C", "N"])
+        self.assertFalse(oracle.takes_entry)
+
+
+def fill_cache(path, smiles_list):
+    cache = OracleCache(path)
+    for smiles in smiles_list:
+        cache.put("oracle", {smiles: len(smiles)})
+
+
+class TestCachedOracle(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_cached_scores_count_as_calls(self):
+        first = LengthOracle()
+        CachedOracle(first, OracleCache(self.path))(["CCO", "CCN", "c1ccccc1"])
+
+        second = LengthOracle()
+        cached_oracle = CachedOracle(second, OracleCache(self.path))
+        # non-canonical SMILES are looked up by their canonical form
+        self.assertEqual(cached_oracle(["OCC", "CCCC", "c1ccccc1"]), [3, 4, 8])
+        self.assertEqual(list(second.mol_buffer), ["CCCC", "CCO", "c1ccccc1"])
+        self.assertEqual(second.mol_buffer["c1ccccc1"], [8, 3])
+        self.assertEqual(cached_oracle.stats()["hits"], 2)
+        self.assertEqual(len(cached_oracle), 3)
+
+        # a run that does not count the hits, and another oracle version
+        free_oracle = CachedOracle(LengthOracle(), OracleCache(self.path), count_hits=False)
+        self.assertEqual(free_oracle(["CCO", "NN"]), [3, 2])
+        self.assertEqual(list(free_oracle.mol_buffer), ["NN"])
+        self.assertEqual(free_oracle.free_hits, {"CCO": 3})
+        other_version = CachedOracle(LengthOracle(), OracleCache(self.path), oracle_key="v2")
+        other_version(["CCO"])
+        self.assertEqual(other_version.stats()["misses"], 1)
+
+    def test_counted_hits_are_logged(self):
+        smiles_list = ["C" * n for n in range(1, 8)]
+        CachedOracle(LengthOracle(), OracleCache(self.path))(smiles_list[:4])
+        oracle = LengthOracle()
+        logged = []
+        oracle.log_intermediate = lambda: logged.append(len(oracle.mol_buffer))
+        cached_oracle = CachedOracle(oracle, OracleCache(self.path))
+        cached_oracle.log_interval = 3
+        # two scored molecules then four hits, which cross the boundary at 3 and 6
+        cached_oracle(smiles_list[4:6] + smiles_list[:4])
+        self.assertEqual(len(oracle.mol_buffer), 6)
+        self.assertEqual(logged, [3, 6])
+
+    def test_submit(self):
+        CachedOracle(LengthOracle(), OracleCache(self.path))(["CCO", "CCN"])
+        self.assertFalse(hasattr(CachedOracle(LengthOracle(), OracleCache(self.path)), "submit"))
+        inner = ThreadPoolOracle(LengthOracle())
+        cached_oracle = CachedOracle(inner, OracleCache(self.path))
+        futures = [cached_oracle.submit(["CCO", "CCCC"]), cached_oracle.submit(["CCN"])]
+        self.assertEqual([future.result() for future in futures], [[3, 4], [3]])
+        inner.shutdown()
+        self.assertEqual(list(cached_oracle.mol_buffer), ["CCCC", "CCO", "CCN"])
+
+    def test_processes_share_the_cache(self):
+        smiles_lists = [["C" * n for n in range(1, 30)], ["C" * n for n in range(15, 45)]]
+        processes = [
+            multiprocessing.get_context("fork").Process(
+                target=fill_cache, args=(self.path, smiles_list)
+            )
+            for smiles_list in smiles_lists
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEqual(process.exitcode, 0)
+        cache = OracleCache(self.path)
+        self.assertEqual(len(cache), 44)
+        self.assertEqual(cache.get("oracle", ["CCC", "N"]), {"CCC": 3})
+
+    def test_second_run_reads_the_cache(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        oracles = []
+        for _ in range(2):
+            config = create_config(self.directory.name, oracle_cache_path=self.path)
+            oracles.append(CountingOracle(60))
+            set_seed(0)
+            optimize(RandomGenerator(tokenizer), tokenizer, oracles[-1], config)
+        self.assertEqual(oracles[0].num_calls, 60)
+        self.assertEqual(oracles[1].num_calls, 0)
+        self.assertEqual(oracles[1].mol_buffer, oracles[0].mol_buffer)
+
+    def test_free_hits_are_not_submitted_again(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        cached_oracles = []
+        for count_hits in [True, False]:
+            cached_oracles.append(
+                CachedOracle(CountingOracle(60), OracleCache(self.path), count_hits=count_hits)
+            )
+            set_seed(0)
+            optimize(
+                RandomGenerator(tokenizer), tokenizer,
+                cached_oracles[-1], create_config(self.directory.name)
+            )
+        free_run = cached_oracles[1]
+        # the molecules of the first run are free, the second one scores 60 others
+        self.assertEqual(free_run.oracle.num_calls, 60)
+        self.assertGreater(len(free_run.free_hits), 0)
+        self.assertFalse(set(free_run.free_hits) & set(free_run.mol_buffer))
+        # every cached molecule is returned once
+        self.assertEqual(free_run.stats()["hits"], len(free_run.free_hits))
+
+    def test_close_closes_the_connections_of_all_threads(self):
+        cache = OracleCache(self.path)
+        cache.put("oracle", {"CCO": 3})
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            barrier = threading.Barrier(3)
+
+            def get(_):
+                barrier.wait()
+                return cache.get("oracle", ["CCO"])
+            self.assertEqual(list(executor.map(get, range(3))), [{"CCO": 3}] * 3)
+        connections = list(cache.connections)
+        self.assertEqual(len(connections), 4)
+        cache.close()
+        for connection in connections:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                connection.execute("SELECT 1")
+        # the cache opens a new connection when it is used after close
+        self.assertEqual(cache.get("oracle", ["CCO"]), {"CCO": 3})
+        cache.close()
+
+
+SMILES = [
+    "CCO", "CCCO", "CCCCO", "CCN", "CCCN", "c1ccccc1", "c1ccccc1O", "c1ccccc1CO",
+    "c1ccncc1", "CC(=O)O", "CC(=O)OC", "C1CCCCC1", "C1CCCCC1O", "OCCO", "NCCN",
+]
+
+
+class TestNearestSimilars(unittest.TestCase):
+    def test_nearest_scored_molecules(self):
+        entries = [MoleculeEntry(smiles, score=i) for i, smiles in enumerate(SMILES)]
+        nearest_similars = NearestSimilars()
+        nearest_similars.add(entries[:8])
+        nearest_similars.add(entries[8:] + entries[:2])
+        self.assertEqual(len(nearest_similars), len(SMILES))
+
+        queries = [entries[6], MoleculeEntry("CCCCCO"), entries[6]]
+        similars = nearest_similars(queries, 3)
+        for query, query_similars in zip(queries, similars):
+            expected = sorted(
+                (tanimoto_dist_func(query.fingerprint, entry.fingerprint) for entry in entries
+                 if entry != query),
+                reverse=True
+            )[:3]
+            self.assertNotIn(query, query_similars)
+            self.assertEqual(len(query_similars), 3)
+            for entry, similarity in zip(query_similars, expected):
+                self.assertAlmostEqual(
+                    tanimoto_dist_func(query.fingerprint, entry.fingerprint), similarity
+                )
+        self.assertEqual(similars[0], similars[2])
+
+    def test_neighbourhoods(self):
+        entries = [MoleculeEntry(smiles, score=i) for i, smiles in enumerate(SMILES)]
+        nearest_similars = NearestSimilars()
+        nearest_similars.add(entries)
+        pool = Pool(4, validation_perc=0.25)
+        self.assertEqual(nearest_similars.neighbourhoods(pool, 2, 3), [[], []])
+        pool.add([OptimEntry(entry, []) for entry in entries[:4]])
+        for neighbourhood in nearest_similars.neighbourhoods(pool, 5, 3):
+            self.assertEqual(len(neighbourhood), 3)
+            anchor = neighbourhood[0]
+            self.assertIn(anchor, [optim_entry.last_entry for optim_entry in pool.optim_entries])
+            self.assertEqual(neighbourhood[1:], nearest_similars([anchor], 2)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import bisect
+import random
+import unittest
+from unittest import mock
+import numpy as np
+from rdkit import DataStructs
+from chemlactica.mol_opt.fingerprints import bulk_tanimoto, pack_fingerprints
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, Pool, EntryStatus
+
+
+SMILES = [
+    "CCO", "CCN", "CCC", "CCCO", "CCCN", "CCCC", "c1ccccc1", "c1ccccc1O",
+    "c1ccccc1N", "c1ccccc1C", "c1ccccc1CO", "c1ccccc1CN", "CC(=O)O", "CC(=O)N",
+    "CC(=O)OC1=CC=CC=C1C(=O)O", "c1ccc2ccccc2c1", "C1CCCCC1", "C1CCNCC1",
+    "C1CCOCC1", "OC1CCCCC1", "NC1CCCCC1", "c1ccncc1", "c1ccoc1", "c1ccsc1",
+    "CC(C)O", "CC(C)N", "CC(C)C", "OCCO", "NCCN", "OCCN",
+]
+
+
+def make_optim_entry(smiles, score):
+    return OptimEntry(MoleculeEntry(smiles, score=score), [])
+
+
+def reference_add(optim_entries, entries, size, diversity_score):
+    # the pairwise deduplication Pool.add used before the fingerprint matrix
+    optim_entries = sorted(optim_entries + entries, key=lambda x: x.last_entry, reverse=True)
+    new_optim_entries = []
+    for entry in optim_entries:
+        insert = True
+        for e in new_optim_entries:
+            if (
+                entry.last_entry == e.last_entry
+                or DataStructs.TanimotoSimilarity(
+                    entry.last_entry.fingerprint, e.last_entry.fingerprint
+                ) > diversity_score
+            ):
+                insert = False
+                break
+        if insert:
+            new_optim_entries.append(entry)
+    return new_optim_entries[:size]
+
+
+class TestBulkTanimoto(unittest.TestCase):
+    def test_matches_rdkit(self):
+        fingerprints = [MoleculeEntry(smiles).fingerprint for smiles in SMILES]
+        packed = pack_fingerprints(fingerprints)
+        for i, fingerprint in enumerate(fingerprints):
+            expected = DataStructs.BulkTanimotoSimilarity(fingerprint, fingerprints)
+            np.testing.assert_allclose(bulk_tanimoto(packed[i], packed), expected)
+
+
+class TestPoolAdd(unittest.TestCase):
+    def test_matches_pairwise_deduplication(self):
+        rng = random.Random(0)
+        for diversity_score in [1.0, 0.6, 0.3]:
+            pool = Pool(8, validation_perc=0.2)
+            reference = []
+            for _ in range(6):
+                entries = [
+                    make_optim_entry(smiles, round(rng.random(), 1))
+                    for smiles in rng.sample(SMILES, 7)
+                ]
+                reference = reference_add(reference, entries, pool.size, diversity_score)
+                pool.add(entries, diversity_score=diversity_score)
+                self.assertEqual(
+                    [(e.last_entry.smiles, e.last_entry.score) for e in pool.optim_entries],
+                    [(e.last_entry.smiles, e.last_entry.score) for e in reference],
+                )
+                self.assertEqual(len(pool.fingerprints), len(pool))
+
+    def test_bisect_without_key(self):
+        # bisect has no key argument before python 3.10
+        bisect_left = bisect.bisect_left
+        with mock.patch("bisect.bisect_left", lambda a, x: bisect_left(a, x)):
+            pool = Pool(4, validation_perc=0.2)
+            pool.add([make_optim_entry(smiles, i / 10) for i, smiles in enumerate(SMILES[:8])])
+            pool.add([make_optim_entry("CCO", 0.95), make_optim_entry("CCN", 0.05)])
+        self.assertEqual(
+            [e.last_entry.smiles for e in pool.optim_entries],
+            ["CCO", "Oc1ccccc1", "c1ccccc1", "CCCC"]
+        )
+        self.assertEqual(
+            [key.mol_entry for key in pool.sort_keys],
+            [e.last_entry for e in pool.optim_entries]
+        )
+
+    def test_same_molecule_with_higher_score(self):
+        pool = Pool(4, validation_perc=0.2)
+        pool.add([make_optim_entry("CCO", 0.5), make_optim_entry("CCN", 0.4)])
+        pool.add([make_optim_entry("OCC", 0.9)])
+        self.assertEqual(
+            [(e.last_entry.smiles, e.last_entry.score) for e in pool.optim_entries],
+            [("CCO", 0.9), ("CCN", 0.4)],
+        )
+        self.assertIs(pool.smiles_index["CCO"], pool.optim_entries[0])
+
+    def test_fewer_entries_than_validation_size(self):
+        pool = Pool(20, validation_perc=0.2)
+        pool.add([make_optim_entry("CCO", 0.5), make_optim_entry("CCN", 0.4)])
+        train_entries, valid_entries = pool.get_train_valid_entries()
+        self.assertEqual((len(train_entries), len(valid_entries)), (0, 2))
+        pool.add([make_optim_entry(smiles, 0.1) for smiles in SMILES[2:10]])
+        train_entries, valid_entries = pool.get_train_valid_entries()
+        self.assertEqual((len(train_entries), len(valid_entries)), (5, 5))
+
+    def test_validation_entries(self):
+        pool = Pool(10, validation_perc=0.2)
+        pool.add([make_optim_entry(smiles, i) for i, smiles in enumerate(SMILES[:12])])
+        train_entries, valid_entries = pool.get_train_valid_entries()
+        self.assertEqual(len(valid_entries), pool.num_validation_entries)
+        self.assertEqual(len(train_entries) + len(valid_entries), len(pool))
+        self.assertTrue(all(e.entry_status == EntryStatus.valid for e in valid_entries))
+
+
+if __name__ == "__main__":
+    unittest.main()
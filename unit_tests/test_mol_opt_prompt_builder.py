@@ -0,0 +1,85 @@
+import random
+import unittest
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry
+from chemlactica.mol_opt.prompt_builder import PromptBuilder
+
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+SMILES = [
+    "CCO", "c1ccccc1O", "CC(=O)OC1=CC=CC=C1C(=O)O", "c1ccc2ccccc2c1", "C1CCNCC1",
+    "OC1CCCCC1", "c1ccncc1", "CC(C)N", "OCCN", "c1ccsc1",
+]
+CONFIG = {
+    "eos_token": "</s>",
+    "strategy": ["rej-sample-v2"],
+    "sim_range": [0.4, 0.9],
+    "max_possible_oracle_score": 800,
+}
+
+
+def create_optim_entries(num_entries, rng):
+    optim_entries = []
+    for _ in range(num_entries):
+        mol_entries = [
+            MoleculeEntry(smiles, score=rng.random() * 100) for smiles in rng.sample(SMILES, 3)
+        ]
+        for mol_entry in mol_entries:
+            mol_entry.similar_mol_entries = [
+                MoleculeEntry(smiles) for smiles in rng.sample(SMILES, 2)
+            ]
+        last_entry = MoleculeEntry("")
+        last_entry.similar_mol_entries = [MoleculeEntry(smiles) for smiles in rng.sample(SMILES, 2)]
+        optim_entries.append(OptimEntry(last_entry, mol_entries))
+    return optim_entries
+
+
+def create_prompts_segments(optim_entries, seed):
+    random.seed(seed)
+    return [
+        optim_entry.to_prompt_segments(
+            is_generation=True, include_oracle_score=True, config=CONFIG, max_score=50
+        )
+        for optim_entry in optim_entries
+    ]
+
+
+class TestPromptBuilder(unittest.TestCase):
+    def setUp(self):
+        self.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        self.optim_entries = create_optim_entries(16, random.Random(0))
+
+    def test_matches_tokenizer(self):
+        random.seed(1)
+        prompts = [
+            optim_entry.to_prompt(
+                is_generation=True, include_oracle_score=True, config=CONFIG, max_score=50
+            )
+            for optim_entry in self.optim_entries
+        ]
+        expected = self.tokenizer(prompts, return_tensors="pt", padding=True)
+        prompt_builder = PromptBuilder(self.tokenizer, max_length=2048)
+        data = prompt_builder(create_prompts_segments(self.optim_entries, seed=1))
+        self.assertFalse(prompt_builder.use_tokenizer)
+        self.assertTrue((data["input_ids"] == expected["input_ids"]).all())
+        self.assertTrue((data["attention_mask"] == expected["attention_mask"]).all())
+
+        data = prompt_builder(create_prompts_segments(self.optim_entries, seed=1))
+        self.assertTrue((data["input_ids"] == expected["input_ids"]).all())
+        self.assertGreater(prompt_builder.stats()["hits"], 0)
+
+    def test_drops_leading_segments(self):
+        prompt_builder = PromptBuilder(self.tokenizer, max_length=80)
+        prompts_segments = create_prompts_segments(self.optim_entries, seed=1)
+        data = prompt_builder(prompts_segments)
+        self.assertLessEqual(data["input_ids"].shape[1], 80)
+        for input_ids, attention_mask, segments in zip(
+                data["input_ids"], data["attention_mask"], prompts_segments
+        ):
+            prompt = self.tokenizer.decode(input_ids[attention_mask.bool()])
+            self.assertTrue(prompt.startswith("</s>"))
+            self.assertTrue(prompt.endswith("".join(segments[-1])))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import io
+import os
+import random
+import tempfile
+import unittest
+from transformers import AutoTokenizer
+from chemlactica.mol_opt.optimization import optimize
+from chemlactica.mol_opt.run_log import PoolDiffer, RunLogWriter, format_run_log, read_run_log
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry, set_seed
+from unit_tests.mol_opt_fixtures import (
+    TOKENIZER_PATH, CountingOracle, RandomGenerator, create_config
+)
+
+
+def create_optim_entries(molecules):
+    return [OptimEntry(MoleculeEntry(smiles, score=score), []) for smiles, score in molecules]
+
+
+class TestPoolDiffer(unittest.TestCase):
+    def test_diffs_rebuild_snapshots(self):
+        rng = random.Random(0)
+        scores = {f"C{'C' * i}O": rng.random() for i in range(60)}
+        writer, reader = PoolDiffer(), PoolDiffer()
+        pool = []
+        for step in range(20):
+            pool = sorted(
+                set(pool) | set(rng.sample(sorted(scores.items()), 5)),
+                key=lambda entry: entry[1], reverse=True
+            )[:10]
+            if step == 10:
+                # the molecules that stayed are reordered here and back in the next step,
+                # the snapshots are written whole
+                pool = pool[::-1]
+            diff = writer.diff(list(pool))
+            self.assertEqual(reader.apply(diff), pool)
+            if step in [0, 10, 11]:
+                self.assertIn("entries", diff)
+            else:
+                self.assertNotIn("entries", diff)
+
+
+class TestRunLogWriter(unittest.TestCase):
+    def write_log(self, path, log_format):
+        run_log = RunLogWriter(path, log_format=log_format, max_queue_size=2)
+        run_log.generated([("CCO", 0.5), ("CCN", 0.25)])
+        run_log.pool(create_optim_entries([("CCO", 0.5), ("CCN", 0.25)]), 0)
+        run_log.generated([("CCCl", 0.75)])
+        run_log.pool(create_optim_entries([("CCCl", 0.75), ("CCO", 0.5)]), 1)
+        run_log.training(
+            create_optim_entries([("CCCl", 0.75)]), create_optim_entries([("CCO", 0.5)]), 1
+        )
+        run_log.close()
+
+    def test_jsonl_formats_as_text(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            text_path = os.path.join(log_dir, "results.log")
+            jsonl_path = os.path.join(log_dir, "results.jsonl")
+            self.write_log(text_path, "text")
+            self.write_log(jsonl_path, "jsonl")
+            events = list(read_run_log(jsonl_path))
+            output = io.StringIO()
+            format_run_log(jsonl_path, output)
+            with open(text_path) as file:
+                text = file.read()
+        self.assertEqual(events[3], {
+            "event": "pool", "iteration": 1, "removed": ["CCN"], "added": [[0, "CCCl", 0.75]]
+        })
+        self.assertEqual(output.getvalue(), text)
+        self.assertTrue(text.startswith("generated smiles: CCO, score: 0.5000\n"))
+        self.assertIn(
+            "Pool\n\t0 smiles: CCCl, score: 0.7500\n\t1 smiles: CCO, score: 0.5000\n", text
+        )
+
+    def test_truncated_last_line_is_skipped(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            path = os.path.join(log_dir, "results.jsonl")
+            self.write_log(path, "jsonl")
+            with open(path, "a") as file:
+                file.write('{"event": "generated", "molec')
+            self.assertEqual(len(list(read_run_log(path))), 5)
+
+
+class TestOptimizeRunLog(unittest.TestCase):
+    def test_jsonl_log_matches_text_log(self):
+        tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, padding_side="left")
+        texts = []
+        with tempfile.TemporaryDirectory() as log_dir:
+            for log_format in ["text", "jsonl"]:
+                config = create_config(log_dir, log_format=log_format)
+                config["log_dir"] = os.path.join(log_dir, f"results.{log_format}")
+                set_seed(0)
+                optimize(RandomGenerator(tokenizer), tokenizer, CountingOracle(60), config)
+                output = io.StringIO()
+                if log_format == "jsonl":
+                    format_run_log(config["log_dir"], output)
+                    texts.append(output.getvalue())
+                else:
+                    with open(config["log_dir"]) as file:
+                        texts.append(file.read())
+        self.assertEqual(texts[0].count("generated smiles"), 60)
+        self.assertEqual(texts[0], texts[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
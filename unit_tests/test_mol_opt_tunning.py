@@ -0,0 +1,148 @@
+import unittest
+import torch
+from transformers import AutoTokenizer, OPTConfig, OPTForCausalLM
+from chemlactica.mol_opt.tunning import FineTuningEngine, ModelSnapshot
+from chemlactica.mol_opt.utils import MoleculeEntry, OptimEntry
+
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+TRAIN_CONFIG = {
+    "train_batch_size": 2,
+    "gradient_accumulation_steps": 2,
+    "global_gradient_norm": 1.0,
+    "max_seq_length": 128,
+    "num_train_epochs": 3,
+    "max_tokens_per_batch": 40,
+}
+PROMPT_CONFIG = {"strategy": ["rej-sample-v2"], "eos_token": "</s>"}
+
+
+class TiedModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embed = torch.nn.Embedding(10, 4)
+        self.hidden = torch.nn.Linear(4, 4)
+        self.head = torch.nn.Linear(4, 10, bias=False)
+        self.head.weight = self.embed.weight
+        self.register_buffer("steps", torch.zeros(1))
+
+
+@torch.no_grad()
+def perturb(model):
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        tensor.add_(1.0)
+
+
+class TestModelSnapshot(unittest.TestCase):
+    def test_restores_in_place(self):
+        model = TiedModel()
+        expected = {key: value.clone() for key, value in model.state_dict().items()}
+        data_ptrs = [param.data_ptr() for param in model.parameters()]
+        snapshot = ModelSnapshot()
+        snapshot.save(model)
+        # the tied embedding is stored once
+        self.assertEqual(len(snapshot.buffers), 4)
+
+        buffer_ptrs = [buffer.data_ptr() for buffer in snapshot.buffers.values()]
+        perturb(model)
+        snapshot.save(model)
+        self.assertEqual([buffer.data_ptr() for buffer in snapshot.buffers.values()], buffer_ptrs)
+
+        perturb(model)
+        snapshot.restore(model)
+        self.assertEqual([param.data_ptr() for param in model.parameters()], data_ptrs)
+        for key, value in model.state_dict().items():
+            self.assertTrue(torch.equal(value, expected[key] + 1.0), msg=key)
+
+    def test_trainable_only(self):
+        model = TiedModel()
+        model.embed.weight.requires_grad_(False)
+        snapshot = ModelSnapshot(device="cpu", trainable_only=True)
+        snapshot.save(model)
+        self.assertEqual(list(snapshot.buffers), ["hidden.weight", "hidden.bias"])
+        expected = model.hidden.weight.clone()
+        with torch.no_grad():
+            model.hidden.weight.zero_()
+        snapshot.restore(model)
+        self.assertTrue(torch.equal(model.hidden.weight, expected))
+
+    def test_on_model_device(self):
+        model = TiedModel()
+        expected = model.hidden.weight.clone()
+        snapshot = ModelSnapshot(device=None)
+        snapshot.save(model)
+        self.assertEqual(snapshot.buffers["hidden.weight"].device, model.hidden.weight.device)
+        with torch.no_grad():
+            model.hidden.weight.zero_()
+        snapshot.restore(model)
+        self.assertTrue(torch.equal(model.hidden.weight, expected))
+
+    def test_restore_without_save(self):
+        model = TiedModel()
+        expected = model.hidden.weight.clone()
+        snapshot = ModelSnapshot()
+        snapshot.save(model)
+        snapshot.clear()
+        with torch.no_grad():
+            model.hidden.weight.zero_()
+        snapshot.restore(model)
+        self.assertFalse(torch.equal(model.hidden.weight, expected))
+
+
+class TestFineTuningEngine(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+
+    def create_engine(self):
+        torch.manual_seed(0)
+        model = OPTForCausalLM(OPTConfig(
+            vocab_size=len(self.tokenizer), hidden_size=16, num_hidden_layers=1, ffn_dim=32,
+            num_attention_heads=2, word_embed_proj_dim=16, max_position_embeddings=256
+        ))
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-2)
+        lr_scheduler = torch.optim.lr_scheduler.ConstantLR(optimizer, factor=1.0)
+        return FineTuningEngine(model, self.tokenizer, optimizer, lr_scheduler, TRAIN_CONFIG)
+
+    def prompts_segments(self, smiles_list):
+        return [
+            OptimEntry(MoleculeEntry(smiles, score=0.5), []).to_prompt_segments(
+                is_generation=False, include_oracle_score=True,
+                config=PROMPT_CONFIG, max_score=1.0
+            )
+            for smiles in smiles_list
+        ]
+
+    def test_loss_matches_model_loss(self):
+        engine = self.create_engine()
+        examples = engine.prompt_builder.prompts_ids(self.prompts_segments(["CCO", "c1ccccc1O"]))
+        # the shorter example is padded, the loss is over the real tokens only
+        self.assertNotEqual(len(examples[0]), len(examples[1]))
+        self.assertEqual(len(engine._micro_batches(examples)), 1)
+        engine.model.eval()
+        with torch.no_grad():
+            expected = [
+                engine.model(input_ids=torch.tensor([example]), labels=torch.tensor([example])).loss
+                for example in examples
+            ]
+        num_tokens = [len(example) - 1 for example in examples]
+        expected_loss = sum(loss * n for loss, n in zip(expected, num_tokens)) / sum(num_tokens)
+        self.assertAlmostEqual(engine.evaluate(examples), expected_loss.item(), places=4)
+
+    def test_rounds_reduce_loss_and_reuse_token_ids(self):
+        engine = self.create_engine()
+        train_segments = self.prompts_segments(["CCO", "CCN", "CCC", "CCCl", "c1ccccc1"])
+        validation_segments = self.prompts_segments(["CCO", "CCN"])
+        initial_loss = engine.evaluate(engine.prompt_builder.prompts_ids(validation_segments))
+        best_loss = engine.train(train_segments, validation_segments)
+        self.assertLess(best_loss, initial_loss)
+        self.assertEqual(engine.num_steps, 3 * 2)
+
+        misses = engine.prompt_builder.stats()["misses"]
+        engine.train(train_segments + self.prompts_segments(["CCBr"]), validation_segments)
+        # only the SMILES of the new entry is tokenized
+        self.assertEqual(engine.prompt_builder.stats()["misses"], misses + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import torch
+from transformers import AutoTokenizer, OPTConfig, OPTForCausalLM
+import numpy as np
+from chemlactica.utils.numerical_eval import (
+    END_PROPERTY_TAG, PropertyDistribution, fit_temperature, generate_property_texts,
+    parse_property_value, predict_properties, predict_properties_sharded, property_prompt,
+    read_properties, shard_indices
+)
+
+TOKENIZER_PATH = "chemlactica/tokenizer/ChemLacticaTokenizer66"
+SMILES = ["CCO", "c1ccccc1CC(=O)O", "CN1CCC[C@H]1c2cccnc2", "O", "CC(C)Cc1ccc(cc1)C(C)C(=O)O"]
+
+
+class TestParsePropertyValue(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_property_value("[PROPERTY]activity 1.25[/PROPERTY]"), 1.25)
+        self.assertIsNone(parse_property_value("[PROPERTY]activity 1.25"))
+        self.assertIsNone(parse_property_value("[PROPERTY]activity x[/PROPERTY]"))
+
+
+class TestBatchedGeneration(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH)
+        torch.manual_seed(0)
+        cls.model = OPTForCausalLM(OPTConfig(
+            vocab_size=len(cls.tokenizer), hidden_size=16, num_hidden_layers=2, ffn_dim=32,
+            num_attention_heads=2, word_embed_proj_dim=16, max_position_embeddings=256
+        )).eval()
+        # some rows stop at [/PROPERTY] right away, others run to max_new_tokens
+        end_token_id = cls.tokenizer.encode(END_PROPERTY_TAG)[0]
+        with torch.no_grad():
+            cls.model.lm_head.weight[end_token_id] *= 20
+
+    def test_matches_one_prompt_at_a_time(self):
+        prompts = [property_prompt(smiles, "</s>") for smiles in SMILES]
+        texts = generate_property_texts(
+            self.model, self.tokenizer, prompts, batch_size=2, max_new_tokens=8
+        )
+        end_token_id = self.tokenizer.encode(END_PROPERTY_TAG)[0]
+        stopped = 0
+        for prompt, text in zip(prompts, texts):
+            data = self.tokenizer(prompt, return_tensors="pt")
+            output = self.model.generate(
+                data.input_ids, do_sample=False, eos_token_id=end_token_id, max_new_tokens=8,
+                pad_token_id=self.tokenizer.pad_token_id
+            )
+            self.assertEqual(text, self.tokenizer.batch_decode(output)[0])
+            stopped += text.endswith(END_PROPERTY_TAG)
+        self.assertTrue(0 < stopped < len(prompts))
+
+    def test_unequal_shards_are_padded_and_gathered(self):
+        predictions = predict_properties(self.model, self.tokenizer, SMILES, "</s>", batch_size=2)
+        self.assertEqual(shard_indices(5, 0, 2), ([0, 2, 4], 3))
+        self.assertEqual(shard_indices(5, 1, 2), ([1, 3, 3], 2))
+        self.assertEqual(shard_indices(1, 1, 2), ([0], 0))
+
+        generate = self.model.generate
+        calls = {0: [], 1: []}
+        gathered = {}
+
+        def recording_generate(rank):
+            def inner(**kwargs):
+                calls[rank].append(kwargs.pop("synced_gpus"))
+                return generate(**kwargs)
+            return inner
+
+        def gather(rank):
+            # the ranks run one after the other, the last one gets the results of both
+            def inner(results):
+                gathered[rank] = results
+                return [result for key in sorted(gathered) for result in gathered[key]]
+            return inner
+
+        try:
+            for rank in [1, 0]:
+                self.model.generate = recording_generate(rank)
+                sharded = predict_properties_sharded(
+                    self.model, self.tokenizer, SMILES, "</s>", rank, 2, gather=gather(rank),
+                    batch_size=2
+                )
+        finally:
+            del self.model.generate
+        self.assertEqual(sharded, predictions)
+        self.assertEqual([len(gathered[rank]) for rank in [0, 1]], [3, 2])
+        # the padded shard runs as many generate calls as the full one, all synced
+        self.assertEqual(calls[0], [True, True])
+        self.assertEqual(calls[1], calls[0])
+
+
+class TestReadProperties(TestBatchedGeneration):
+    def teacher_forced_log_prob(self, smiles, number_text):
+        prompt_ids = self.tokenizer(property_prompt(smiles, "</s>") + " ")["input_ids"]
+        number_ids = self.tokenizer.convert_tokens_to_ids(list(number_text))
+        number_ids.append(self.tokenizer.encode(END_PROPERTY_TAG)[0])
+        with torch.no_grad():
+            logits = self.model(torch.tensor([prompt_ids + number_ids])).logits[0]
+        log_probs = torch.log_softmax(logits[len(prompt_ids) - 1:-1], dim=-1)
+        return log_probs[torch.arange(len(number_ids)), torch.tensor(number_ids)].sum().item()
+
+    def test_log_probs_match_teacher_forcing(self):
+        distributions = read_properties(
+            self.model, self.tokenizer, SMILES, "</s>", batch_size=3, num_beams=4, max_tokens=3
+        )
+        for smiles, distribution in zip(SMILES, distributions):
+            self.assertGreater(len(distribution.values), 0)
+            alone = read_properties(
+                self.model, self.tokenizer, [smiles], "</s>", num_beams=4, max_tokens=3
+            )[0]
+            np.testing.assert_allclose(alone.log_probs, distribution.log_probs, rtol=1e-4)
+            for value, log_prob in zip(distribution.values, distribution.log_probs):
+                if value > 0 and value == int(value):
+                    self.assertAlmostEqual(
+                        log_prob, self.teacher_forced_log_prob(smiles, str(int(value))), places=3
+                    )
+
+
+class TestPropertyDistribution(unittest.TestCase):
+    def test_estimates_and_temperature(self):
+        distribution = PropertyDistribution(np.array([1.0, 2.0]), np.log([0.3, 0.1]))
+        self.assertAlmostEqual(distribution.coverage, 0.4)
+        self.assertEqual(distribution.mode(), 1.0)
+        self.assertAlmostEqual(distribution.mean(), 1.25)
+        self.assertAlmostEqual(distribution.std(), 0.4330127)
+        self.assertGreater(distribution.std(temperature=10.0), distribution.std())
+        # over-confident distributions are flattened
+        distributions = [
+            PropertyDistribution(
+                np.array([center - 1, center, center + 1]), np.log([0.01, 0.98, 0.01])
+            )
+            for center in range(20)
+        ]
+        targets = [center + (1 if center % 2 else -1) for center in range(20)]
+        self.assertGreater(fit_temperature(distributions, targets), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()